@@ -90,4 +90,96 @@ REST_FRAMEWORK = {
         'rest_framework.parsers.MultiPartParser',
         'rest_framework.parsers.FormParser',
     ],
-}
\ No newline at end of file
+}
+
+# Cellpose: os modelos são carregados uma vez por processo worker e reaproveitados entre os jobs
+LEVEDURAS_CELLPOSE_GPU = True
+LEVEDURAS_CELLPOSE_AQUECER = True   # workers carregam os modelos ao iniciar, antes do primeiro job
+LEVEDURAS_CELLPOSE_MODELOS_AQUECER = ['cyto']
+
+# Fila de processamento (python manage.py processar_fila)
+LEVEDURAS_FILA_WORKERS = 2          # processos worker
+LEVEDURAS_FILA_MAX = 100            # jobs pendentes + em processamento antes de responder 429
+LEVEDURAS_FILA_INTERVALO = 2        # segundos entre consultas à fila vazia
+LEVEDURAS_FILA_TIMEOUT = 3600       # segundos até um job em processamento ser considerado abandonado
+LEVEDURAS_FILA_INTERVALO_RECUPERACAO = 60  # segundos entre as buscas do supervisor por jobs abandonados
+LEVEDURAS_FILA_TENTATIVAS = 3       # recuperações antes de marcar o job como erro
+LEVEDURAS_FILA_NOTIFICACAO = ('127.0.0.1', 8765)  # primeira porta UDP dos workers, uma por worker (None desativa)
+
+# Características morfológicas: 'mascara' (contorno do Cellpose) ou 'recorte' (re-segmentação legada do recorte)
+LEVEDURAS_MODO_CARACTERISTICAS = 'mascara'
+
+# Pós-processamento por levedura (recorte, características, codificação) em threads;
+# cada thread recebe blocos deste número de leveduras. 1 worker = serial
+LEVEDURAS_POS_PROCESSAMENTO_WORKERS = 4
+LEVEDURAS_POS_PROCESSAMENTO_BLOCO = 64
+
+# Leveduras segmentadas são inseridas com bulk_create em lotes deste tamanho
+LEVEDURAS_BULK_TAMANHO_LOTE = 500
+
+# Codificação dos recortes de leveduras: 'png', 'webp' ou 'jpeg'
+LEVEDURAS_RECORTE_FORMATO = 'png'
+LEVEDURAS_RECORTE_PNG_COMPRESSAO = 3    # 0 (rápido, maior) a 9 (lento, menor)
+LEVEDURAS_RECORTE_QUALIDADE = 90        # WebP/JPEG
+
+# Armazenamento dos recortes: 'arquivos' (um arquivo por levedura) ou 'pacote' (um ZIP por imagem)
+LEVEDURAS_ARMAZENAMENTO_RECORTES = 'arquivos'
+
+# Decodificação: True decodifica toda imagem direto em um canal (os recortes também ficam em cinza);
+# com False apenas imagens de um canal são decodificadas assim
+LEVEDURAS_DECODIFICAR_CINZA = False
+# Maior imagem (altura x largura) aceita; o worker eleva a proteção do Pillow contra
+# 'decompression bombs' até este valor, os processos web mantêm o limite padrão
+LEVEDURAS_MAX_PIXELS = 65536 * 65536
+
+# Miniatura gerada pelo worker ao reivindicar o job
+LEVEDURAS_PREVIEW_LADO = 512        # maior lado, em pixels
+LEVEDURAS_PREVIEW_QUALIDADE = 80    # JPEG
+
+# Segmentação em blocos para imagens muito grandes
+LEVEDURAS_BLOCOS_MODO = 'auto'                  # 'auto', 'sempre' ou 'nunca'
+LEVEDURAS_BLOCOS_LIMIAR_PIXELS = 8192 * 8192    # no modo 'auto', usa blocos acima deste tamanho
+LEVEDURAS_BLOCOS_MEMORIA_MB = 2048              # orçamento de memória da inferência de um bloco
+LEVEDURAS_BLOCOS_TAMANHO = None                 # lado do bloco em pixels (None = derivado do orçamento)
+LEVEDURAS_BLOCOS_SOBREPOSICAO = 256             # deve ser maior que o diâmetro de uma levedura
+LEVEDURAS_BLOCOS_DIRETORIO = None               # onde gravar a máscara temporária (None = diretório temporário do sistema)
+
+# Inferência em resolução reduzida: a imagem é reduzida até o diâmetro esperado das leveduras
+# (em µm, convertido por MICRONS_PER_PIXEL) ficar com LEVEDURAS_DIAMETRO_ALVO_PIXELS, e as máscaras
+# voltam à resolução original para os recortes e as características. None desativa
+LEVEDURAS_DIAMETRO_ESPERADO_MICRONS = None
+LEVEDURAS_DIAMETRO_ALVO_PIXELS = 30     # diâmetro de treino dos modelos do Cellpose
+LEVEDURAS_ESCALA_COMPARAR = False       # roda também a resolução completa e registra a diferença (dobra a inferência)
+
+# Máscara de rótulos completa gravada por imagem (npz comprimido), lida por overlays e por
+# recalcular_caracteristicas; a leitura descomprime para um cache local mapeado em memória
+LEVEDURAS_MASCARAS_ATIVO = True
+LEVEDURAS_MASCARAS_CACHE_DIRETORIO = None   # None = diretório temporário do sistema
+LEVEDURAS_MASCARAS_CACHE_MAX_MB = 4096
+LEVEDURAS_OVERLAY_LADO = 2048               # maior lado padrão do PNG de overlay
+LEVEDURAS_OVERLAY_LADO_MAXIMO = 2048        # maior 'lado' aceito no overlay (acima disso, 400)
+
+# Upload em lote: imagens do mesmo lote são segmentadas juntas numa chamada do Cellpose
+LEVEDURAS_LOTE_MAX_IMAGENS = 384    # imagens aceitas por requisição
+LEVEDURAS_LOTE_TAMANHO = 8          # imagens reivindicadas de uma vez por um worker
+LEVEDURAS_LOTE_ZIP_MAX_MEMBRO = 512 * 1024 ** 2   # maior imagem descomprimida aceita dentro do zip
+LEVEDURAS_LOTE_ZIP_MAX_TOTAL = 4 * 1024 ** 3      # soma das imagens descomprimidas do zip
+
+# Upload retomável em fragmentos (/api/analises/<id>/uploads/)
+LEVEDURAS_UPLOAD_TAMANHO_FRAGMENTO = 8 * 1024 * 1024   # tamanho sugerido aos clientes
+LEVEDURAS_UPLOAD_TAMANHO_MAXIMO = 4 * 1024 ** 3        # maior arquivo aceito
+LEVEDURAS_UPLOAD_TIMEOUT_FRAGMENTO = 600              # segundos até a reserva de um fragmento interrompido expirar
+
+# Cache de segmentação por conteúdo da imagem + parâmetros
+LEVEDURAS_CACHE_ATIVO = True
+LEVEDURAS_CACHE_MAX_MB = 2048       # acima disso, as entradas usadas há mais tempo são removidas
+
+# Estatísticas de população ficam no cache do Django até novas leveduras entrarem na seleção
+LEVEDURAS_ESTATISTICAS_CACHE_TIMEOUT = 3600  # segundos
+
+# Exportação em stream: leveduras lidas do banco por consulta
+LEVEDURAS_EXPORTACAO_TAMANHO_BLOCO = 5000
+
+# Métricas (/api/metricas/): janela, em segundos, e máximo de jobs usados nos quantis de latência
+LEVEDURAS_METRICAS_JANELA = 300
+LEVEDURAS_METRICAS_MAX_JOBS = 1000
@@ -0,0 +1,18 @@
+# Configurações do benchmark do pipeline (python manage.py benchmark_pipeline --settings=levedura_analysis.settings_benchmark):
+# banco SQLite e MEDIA_ROOT temporários, para nunca gravar no banco de produção
+import tempfile
+
+from .settings import *  # noqa: F401,F403
+
+DIRETORIO_BENCHMARK = tempfile.mkdtemp(prefix='leveduras_benchmark_')
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(DIRETORIO_BENCHMARK, 'benchmark.sqlite3'),
+    }
+}
+MEDIA_ROOT = os.path.join(DIRETORIO_BENCHMARK, 'media')
+
+LEVEDURAS_CELLPOSE_AQUECER = False
+LEVEDURAS_CACHE_ATIVO = False
@@ -0,0 +1,314 @@
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+# Estágios medidos, na ordem do pipeline
+ETAPAS = (
+    'decodificacao', 'inferencia', 'regioes', 'caracteristicas_mascara',
+    'caracteristicas_recorte', 'codificacao', 'pos_processamento_paralelo', 'persistencia',
+)
+
+
+def gerar_campo_sintetico(altura, largura, celulas, semente=0):
+    """
+    Campo sintético de leveduras: elipses escuras de tamanho, orientação e
+    intensidade variados sobre um fundo claro com ruído. Retorna a imagem RGB uint8.
+    """
+    rng = np.random.default_rng(semente)
+    fundo = rng.normal(200, 6, size=(altura, largura)).clip(0, 255).astype(np.uint8)
+    margem = 25
+    for _ in range(celulas):
+        centro = (int(rng.integers(margem, max(margem + 1, largura - margem))),
+                  int(rng.integers(margem, max(margem + 1, altura - margem))))
+        eixos = (int(rng.integers(8, 20)), int(rng.integers(8, 20)))
+        cv2.ellipse(fundo, centro, eixos, float(rng.uniform(0, 180)), 0, 360, int(rng.integers(30, 70)), -1)
+    return cv2.cvtColor(fundo, cv2.COLOR_GRAY2RGB)
+
+
+class ModeloStub:
+    """
+    Substituto do CellposeModel para o benchmark: Otsu seguido de componentes
+    conexos, com a mesma interface de eval (imagem ou lista de imagens)
+    """
+
+    def _segmentar(self, imagem):
+        if imagem.ndim == 3:
+            imagem = cv2.cvtColor(imagem, cv2.COLOR_RGB2GRAY)
+        _, binaria = cv2.threshold(imagem, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        _, rotulos = cv2.connectedComponents(binaria)
+        return rotulos.astype(np.uint32)
+
+    def eval(self, x, **kwargs):
+        if isinstance(x, list):
+            masks = [self._segmentar(imagem) for imagem in x]
+            return masks, [None] * len(masks), [None] * len(masks)
+        return self._segmentar(x), None, None
+
+
+def pico_rss_mb():
+    # ru_maxrss é dado em KiB no Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Medicao:
+    """
+    Acumula tempo e, com 'memoria', pico de memória (tracemalloc) de uma etapa ao longo
+    das repetições. O tracemalloc intercepta cada alocação e infla o tempo das etapas em
+    Python puro: tempos e memória devem vir de execuções separadas.
+    """
+
+    def __init__(self, memoria=False):
+        self.memoria = memoria
+        self.tempo = 0.0
+        self.pico_bytes = 0
+        self.imagens = 0
+        self.leveduras = 0
+        self.bytes = 0
+
+    def medir(self, funcao, *args, leveduras=0, bytes_processados=0):
+        if self.memoria:
+            tracemalloc.reset_peak()
+            antes, _ = tracemalloc.get_traced_memory()
+        inicio = time.perf_counter()
+        resultado = funcao(*args)
+        self.tempo += time.perf_counter() - inicio
+        if self.memoria:
+            _, pico = tracemalloc.get_traced_memory()
+            self.pico_bytes = max(self.pico_bytes, pico - antes)
+        self.imagens += 1
+        self.leveduras += leveduras
+        self.bytes += bytes_processados
+        return resultado
+
+    def resultado(self):
+        def por_segundo(quantidade):
+            return quantidade / self.tempo if self.tempo > 0 else None
+
+        return {
+            'tempo_total_s': self.tempo,
+            'tempo_por_imagem_s': self.tempo / self.imagens if self.imagens else None,
+            'imagens_por_s': por_segundo(self.imagens),
+            'leveduras_por_s': por_segundo(self.leveduras) if self.leveduras else None,
+            'mb_por_s': por_segundo(self.bytes / 2 ** 20) if self.bytes else None,
+            'pico_memoria_mb': self.pico_bytes / 2 ** 20 if self.memoria else None,
+        }
+
+
+def recortes_das_regioes(imagem, regioes, padding=5):
+    """Mesmo recorte com padding usado em pos_processar_segmentacao"""
+    recortes = []
+    for regiao in regioes:
+        x, y, w, h = regiao['bounding_box']
+        x_start, y_start = max(0, x - padding), max(0, y - padding)
+        x_end, y_end = min(imagem.shape[1], x + w + padding), min(imagem.shape[0], y + h + padding)
+        recortes.append(np.ascontiguousarray(imagem[y_start:y_end, x_start:x_end]))
+    return recortes
+
+
+def pos_processar_em_paralelo(imagem, regioes, workers, tamanho_bloco):
+    """
+    Recorte, características e codificação de cada levedura em blocos distribuídos
+    entre threads, como em pos_processar_segmentacao (sem gravar no storage)
+    """
+    from .recortes import codificar_recorte
+    from .views import extrair_caracteristicas_levedura
+
+    def processar_bloco(bloco):
+        processadas = []
+        for recorte in recortes_das_regioes(imagem, bloco):
+            processadas.append((extrair_caracteristicas_levedura(recorte), codificar_recorte(recorte)[0]))
+        return processadas
+
+    blocos = [regioes[inicio:inicio + tamanho_bloco] for inicio in range(0, len(regioes), tamanho_bloco)]
+    workers = min(workers, len(blocos))
+    if workers <= 1:
+        return [item for bloco in blocos for item in processar_bloco(bloco)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [item for processadas in executor.map(processar_bloco, blocos) for item in processadas]
+
+
+def executar_benchmark(altura=2048, largura=2048, densidade=100, imagens=3, semente=0,
+                       modelo='stub', etapas=ETAPAS, diametro_microns=None, diametro_alvo=None,
+                       memoria=False):
+    """
+    Executa cada etapa do pipeline isoladamente sobre 'imagens' campos sintéticos
+    de altura x largura com 'densidade' células por megapixel.
+
+    Com 'diametro_microns' a inferência roda em resolução reduzida (views.inferir_mascaras)
+    e cada imagem também é segmentada em resolução completa, fora da medição, para
+    registrar a diferença entre os dois resultados.
+
+    A decodificação lê o campo gravado como PNG em um arquivo temporário, pelo mesmo
+    decodificar_imagem do pipeline. 'pos_processamento_paralelo' mede recorte,
+    características e codificação juntos, nas threads de LEVEDURAS_POS_PROCESSAMENTO_WORKERS.
+
+    Com 'memoria' o pico de memória de cada etapa é medido pelo tracemalloc; os tempos
+    dessa execução incluem o custo do rastreamento e não devem ser comparados aos de
+    uma execução sem ele.
+
+    A persistência grava no banco configurado e no MEDIA_ROOT; o comando
+    benchmark_pipeline só a executa contra SQLite.
+    """
+    from .caracteristicas import extrair_caracteristicas_mascara
+    from .decodificacao import converter_cinza, decodificar_imagem
+    from .escala import calcular_escala, comparar_mascaras, configuracao_escala
+    from .models import AnaliseLevedura, ImagemMicroscopica
+    from .recortes import codificar_recorte
+    from .regioes import extrair_regioes
+    from .views import (
+        MICRONS_PER_PIXEL, MODEL_TYPE, extrair_caracteristicas_levedura, inferir_mascaras,
+        persistir_leveduras_segmentadas, pos_processamento_workers, salvar_levedura_segmentada
+    )
+
+    celulas = int(densidade * altura * largura / 1e6)
+    workers = pos_processamento_workers()
+    tamanho_bloco = getattr(settings, 'LEVEDURAS_POS_PROCESSAMENTO_BLOCO', 64)
+    medicoes = {etapa: Medicao(memoria) for etapa in etapas}
+    total_leveduras = 0
+
+    escala = None
+    comparacoes = []
+    if diametro_microns:
+        config_escala = configuracao_escala()
+        config_escala['diametro_microns'] = diametro_microns
+        if diametro_alvo:
+            config_escala['diametro_alvo'] = diametro_alvo
+        escala = calcular_escala(MICRONS_PER_PIXEL, config_escala)
+
+    if modelo == 'stub':
+        modelo_segmentacao = ModeloStub()
+        tempo_carregamento = 0.0
+    else:
+        from cellpose import models
+        inicio = time.perf_counter()
+        modelo_segmentacao = models.CellposeModel(gpu=False, model_type=MODEL_TYPE)
+        tempo_carregamento = time.perf_counter() - inicio
+
+    analise = None
+    if 'persistencia' in etapas:
+        analise = AnaliseLevedura.objects.create(nome_amostra='benchmark')
+
+    diretorio = tempfile.mkdtemp(prefix='benchmark_leveduras_')
+    if memoria:
+        tracemalloc.start()
+    try:
+        for indice in range(imagens):
+            imagem_rgb = gerar_campo_sintetico(altura, largura, celulas, semente + indice)
+            caminho = os.path.join(diretorio, f'campo_{indice}.png')
+            if not cv2.imwrite(caminho, cv2.cvtColor(imagem_rgb, cv2.COLOR_RGB2BGR)):
+                raise ValueError("Erro ao gravar o campo sintético")
+
+            if 'decodificacao' in medicoes:
+                imagem = medicoes['decodificacao'].medir(
+                    decodificar_imagem, caminho, bytes_processados=os.path.getsize(caminho)
+                )
+            else:
+                imagem = imagem_rgb
+            os.remove(caminho)
+            imagem_cinza = converter_cinza(imagem)
+
+            def inferir():
+                return inferir_mascaras(modelo_segmentacao, imagem_cinza, escala)
+
+            masks = medicoes['inferencia'].medir(inferir) if 'inferencia' in medicoes else inferir()
+            if escala is not None:
+                comparacoes.append(comparar_mascaras(masks, inferir_mascaras(modelo_segmentacao, imagem_cinza)))
+            regioes = (
+                medicoes['regioes'].medir(extrair_regioes, masks)
+                if 'regioes' in medicoes else extrair_regioes(masks)
+            )
+            quantidade = len(regioes)
+            total_leveduras += quantidade
+            if 'regioes' in medicoes:
+                medicoes['regioes'].leveduras += quantidade
+
+            caracteristicas = extrair_caracteristicas_mascara(masks, regioes, MICRONS_PER_PIXEL)
+            if 'caracteristicas_mascara' in medicoes:
+                caracteristicas = medicoes['caracteristicas_mascara'].medir(
+                    extrair_caracteristicas_mascara, masks, regioes, MICRONS_PER_PIXEL, leveduras=quantidade
+                )
+
+            recortes = recortes_das_regioes(imagem, regioes)
+            if 'caracteristicas_recorte' in medicoes:
+                medicoes['caracteristicas_recorte'].medir(
+                    lambda: [extrair_caracteristicas_levedura(recorte) for recorte in recortes],
+                    leveduras=quantidade
+                )
+            if 'codificacao' in medicoes:
+                codificados = medicoes['codificacao'].medir(
+                    lambda: [codificar_recorte(recorte)[0] for recorte in recortes],
+                    leveduras=quantidade
+                )
+                medicoes['codificacao'].bytes += sum(len(conteudo) for conteudo in codificados)
+            if 'pos_processamento_paralelo' in medicoes:
+                medicoes['pos_processamento_paralelo'].medir(
+                    pos_processar_em_paralelo, imagem, regioes, workers, tamanho_bloco, leveduras=quantidade
+                )
+
+            if 'persistencia' in medicoes:
+                imagem_micro = ImagemMicroscopica.objects.create(
+                    analise=analise, imagem=f'benchmark/campo_{indice}.png', status_processamento='processando'
+                )
+
+                def persistir():
+                    leveduras = [
+                        salvar_levedura_segmentada(
+                            recorte, regiao['levedura_id'], analise, imagem_micro,
+                            regiao['bounding_box'], caracteristicas.get(regiao['levedura_id'])
+                        )
+                        for regiao, recorte in zip(regioes, recortes)
+                    ]
+                    persistir_leveduras_segmentadas(imagem_micro, leveduras)
+
+                medicoes['persistencia'].medir(persistir, leveduras=quantidade)
+    finally:
+        if memoria:
+            tracemalloc.stop()
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    resultado = {
+        'configuracao': {
+            'altura': altura,
+            'largura': largura,
+            'densidade_celulas_por_mpx': densidade,
+            'celulas_desenhadas_por_imagem': celulas,
+            'imagens': imagens,
+            'semente': semente,
+            'modelo': modelo,
+            'memoria_rastreada': memoria,
+            'pos_processamento_workers': workers,
+            'pos_processamento_bloco': tamanho_bloco,
+        },
+        'ambiente': {
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'banco': connection.vendor,
+        },
+        'leveduras_segmentadas': total_leveduras,
+        'tempo_carregamento_modelo_s': tempo_carregamento,
+        'etapas': {etapa: medicao.resultado() for etapa, medicao in medicoes.items()},
+        'pico_rss_mb': pico_rss_mb(),
+    }
+    if escala is not None and comparacoes:
+        # Médias por imagem da diferença em relação à resolução completa
+        resultado['escala'] = {
+            **escala,
+            **{
+                campo: float(np.mean([c[campo] for c in comparacoes if c[campo] is not None]))
+                if any(c[campo] is not None for c in comparacoes) else None
+                for campo in comparacoes[0]
+            },
+        }
+    return resultado
@@ -0,0 +1,333 @@
+import math
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from django.conf import settings
+from scipy import ndimage
+
+# Estimativa de memória do Cellpose por pixel do bloco (imagem, fluxos, probabilidades e ativações)
+BYTES_POR_PIXEL_INFERENCIA = 100
+
+# Strips/tiles decodificados mantidos por TiffSobDemanda (os recortes vizinhos reusam os mesmos)
+TAMANHO_CACHE_SEGMENTOS = 64 * 1024 * 1024
+
+
+def configuracao_blocos():
+    return {
+        'modo': getattr(settings, 'LEVEDURAS_BLOCOS_MODO', 'auto'),
+        'limiar_pixels': getattr(settings, 'LEVEDURAS_BLOCOS_LIMIAR_PIXELS', 8192 * 8192),
+        'memoria_mb': getattr(settings, 'LEVEDURAS_BLOCOS_MEMORIA_MB', 2048),
+        'tamanho': getattr(settings, 'LEVEDURAS_BLOCOS_TAMANHO', None),
+        'sobreposicao': getattr(settings, 'LEVEDURAS_BLOCOS_SOBREPOSICAO', 256),
+        'diretorio': getattr(settings, 'LEVEDURAS_BLOCOS_DIRETORIO', None),
+    }
+
+
+def limite_pixels():
+    """Maior imagem (altura x largura) aceita para decodificação"""
+    return getattr(settings, 'LEVEDURAS_MAX_PIXELS', 65536 * 65536)
+
+
+def verificar_pixels(altura, largura):
+    """Recusa (ValueError) imagens acima de LEVEDURAS_MAX_PIXELS antes de decodificá-las"""
+    limite = limite_pixels()
+    if limite and altura * largura > limite:
+        raise ValueError(f"Imagem de {largura}x{altura} pixels excede o limite de {limite} pixels")
+
+
+def permitir_imagens_grandes():
+    """
+    Eleva a proteção do Pillow contra 'decompression bombs' até LEVEDURAS_MAX_PIXELS.
+    Só o processo worker, que decodifica as imagens de microscopia, chama isto: nos
+    processos web vale o limite padrão do Pillow
+    """
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = limite_pixels() or None
+
+
+def tamanho_bloco(config=None):
+    """
+    Lado do bloco quadrado que cabe no orçamento de memória configurado
+    """
+    if config is None:
+        config = configuracao_blocos()
+    if config['tamanho']:
+        return config['tamanho']
+
+    orcamento = config['memoria_mb'] * 1024 * 1024
+    lado = int(math.sqrt(orcamento / BYTES_POR_PIXEL_INFERENCIA))
+    # O bloco precisa ser maior que a sobreposição para avançar
+    return max(lado, 2 * config['sobreposicao'] + 1)
+
+
+def dimensoes_imagem(caminho):
+    """Altura e largura da imagem lendo apenas o cabeçalho do arquivo"""
+    from PIL import Image
+
+    try:
+        with Image.open(caminho) as imagem:
+            largura, altura = imagem.size
+    except Image.DecompressionBombError as e:
+        # Acima do limite do Pillow no processo (o worker o eleva a LEVEDURAS_MAX_PIXELS)
+        raise ValueError(str(e))
+    verificar_pixels(altura, largura)
+    return altura, largura
+
+
+def usar_blocos(caminho, config=None):
+    """Decide se a imagem deve ser segmentada em blocos"""
+    if config is None:
+        config = configuracao_blocos()
+    if config['modo'] in ('sempre', 'nunca'):
+        return config['modo'] == 'sempre'
+
+    altura, largura = dimensoes_imagem(caminho)
+    return altura * largura > config['limiar_pixels']
+
+
+def abrir_imagem_mapeada(caminho):
+    """
+    Abre a imagem mapeada em memória, sem decodificá-la inteira.
+
+    Funciona para TIFFs não comprimidos; para os demais formatos retorna None
+    e a imagem precisa ser decodificada normalmente.
+    """
+    if not caminho.lower().endswith(('.tif', '.tiff')):
+        return None
+    try:
+        import tifffile
+        return tifffile.memmap(caminho, mode='r')
+    except ImportError:
+        return None
+    except ValueError:
+        # TIFF comprimido ou em blocos: não pode ser mapeado diretamente
+        return None
+
+
+class TiffSobDemanda:
+    """
+    TIFF comprimido ou em tiles lido sob demanda: cada acesso lê e decodifica só os
+    strips/tiles da página que intersectam a janela pedida (TiffPage.decode), sem
+    decodificar a imagem inteira.
+
+    Aceita fatias com passo positivo nos dois primeiros eixos, como img[y0:y1, x0:x1]
+    ou img[::passo, ::passo], e devolve um ndarray. Pode ser lido por várias threads.
+    """
+
+    def __init__(self, caminho, pagina):
+        self.shape = pagina.shape
+        self.ndim = len(pagina.shape)
+        self.dtype = pagina.dtype
+        self._decodificar = pagina.decode
+        self._jpegtables = pagina.jpegtables
+        self._offsets = pagina.dataoffsets
+        self._bytecounts = pagina.databytecounts
+        self._altura_segmento, self._largura_segmento = pagina.chunks[:2]
+        self._colunas_segmentos = pagina.chunked[1] if len(pagina.chunked) > 1 else 1
+        self._cache = OrderedDict()
+        self._bytes_cache = 0
+        self._lock = threading.Lock()
+        self._descritor = os.open(caminho, os.O_RDONLY)
+
+    def fechar(self):
+        if self._descritor is not None:
+            os.close(self._descritor)
+            self._descritor = None
+
+    def __del__(self):
+        self.fechar()
+
+    def _segmento(self, indice):
+        with self._lock:
+            segmento = self._cache.get(indice)
+            if segmento is not None:
+                self._cache.move_to_end(indice)
+                return segmento
+
+        if self._bytecounts[indice]:
+            # pread não depende da posição do arquivo, então as threads não disputam o descritor
+            dados = os.pread(self._descritor, self._bytecounts[indice], self._offsets[indice])
+            segmento, _, _ = self._decodificar(dados, indice, jpegtables=self._jpegtables)
+            # (profundidade, linhas, colunas, amostras) -> (linhas, colunas[, amostras])
+            segmento = segmento[0] if self.ndim == 3 else segmento[0, ..., 0]
+        else:
+            # Tile esparso: não gravado no arquivo
+            segmento = np.zeros((self._altura_segmento, self._largura_segmento) + self.shape[2:], self.dtype)
+
+        with self._lock:
+            self._cache[indice] = segmento
+            self._bytes_cache += segmento.nbytes
+            while self._bytes_cache > TAMANHO_CACHE_SEGMENTOS and len(self._cache) > 1:
+                _, removido = self._cache.popitem(last=False)
+                self._bytes_cache -= removido.nbytes
+        return segmento
+
+    def __getitem__(self, chave):
+        if not isinstance(chave, tuple):
+            chave = (chave,)
+        fatias = chave[:2] + (slice(None),) * (2 - len(chave[:2]))
+        resto = chave[2:]
+        if not all(isinstance(fatia, slice) for fatia in fatias):
+            raise IndexError("TiffSobDemanda aceita apenas fatias nos dois primeiros eixos")
+
+        (y0, y1, passo_y), (x0, x1, passo_x) = (
+            fatia.indices(total) for fatia, total in zip(fatias, self.shape[:2])
+        )
+        if passo_y < 1 or passo_x < 1:
+            raise IndexError("TiffSobDemanda aceita apenas passos positivos")
+        linhas = np.arange(y0, y1, passo_y)
+        colunas = np.arange(x0, x1, passo_x)
+
+        saida = np.zeros((len(linhas), len(colunas)) + self.shape[2:], self.dtype)
+        if len(linhas) and len(colunas):
+            altura, largura = self._altura_segmento, self._largura_segmento
+            for linha_segmento in range(linhas[0] // altura, linhas[-1] // altura + 1):
+                topo = linha_segmento * altura
+                a, b = np.searchsorted(linhas, (topo, topo + altura))
+                if a == b:
+                    continue
+                for coluna_segmento in range(colunas[0] // largura, colunas[-1] // largura + 1):
+                    esquerda = coluna_segmento * largura
+                    c, d = np.searchsorted(colunas, (esquerda, esquerda + largura))
+                    if c == d:
+                        continue
+                    segmento = self._segmento(linha_segmento * self._colunas_segmentos + coluna_segmento)
+                    saida[a:b, c:d] = segmento[
+                        linhas[a] - topo:linhas[b - 1] - topo + 1:passo_y,
+                        colunas[c] - esquerda:colunas[d - 1] - esquerda + 1:passo_x
+                    ]
+        return saida[(slice(None), slice(None)) + resto] if resto else saida
+
+
+def abrir_imagem_sob_demanda(caminho):
+    """
+    Abre a imagem sem decodificá-la inteira: TIFFs não comprimidos são mapeados em
+    memória e os comprimidos ou em tiles são lidos por segmento (TiffSobDemanda).
+
+    Retorna None para os demais formatos e para TIFFs com várias páginas, planos
+    separados ou profundidade, que precisam ser decodificados normalmente.
+    """
+    mapeada = abrir_imagem_mapeada(caminho)
+    if mapeada is not None or not caminho.lower().endswith(('.tif', '.tiff')):
+        return mapeada
+    try:
+        import tifffile
+    except ImportError:
+        return None
+
+    try:
+        with tifffile.TiffFile(caminho) as tif:
+            serie = tif.series[0]
+            pagina = tif.pages[0]
+            if (len(serie.pages) != 1 or pagina.imagedepth != 1 or len(pagina.shape) not in (2, 3)
+                    or (len(pagina.shape) == 3 and pagina.planarconfig != 1)):
+                return None
+            return TiffSobDemanda(caminho, pagina)
+    except (tifffile.TiffFileError, ValueError, IndexError):
+        return None
+
+
+def intervalos_blocos(total, tamanho, sobreposicao):
+    """
+    Divide um eixo em blocos sobrepostos.
+
+    Retorna tuplas (inicio, fim, inicio_nucleo, fim_nucleo). Os núcleos particionam
+    o eixo: cada levedura pertence ao bloco cujo núcleo contém o seu centroide.
+    """
+    if tamanho >= total:
+        return [(0, total, 0, total)]
+
+    passo = tamanho - sobreposicao
+    inicios = list(range(0, total - tamanho, passo)) + [total - tamanho]
+
+    intervalos = []
+    for i, inicio in enumerate(inicios):
+        fim = inicio + tamanho
+        inicio_nucleo = 0 if i == 0 else intervalos[-1][3]
+        # A fronteira entre dois núcleos fica no meio da faixa sobreposta
+        fim_nucleo = total if i == len(inicios) - 1 else (inicios[i + 1] + fim) // 2
+        intervalos.append((inicio, fim, inicio_nucleo, fim_nucleo))
+    return intervalos
+
+
+def segmentar_em_blocos(imagem, inferir, config=None, progresso=None):
+    """
+    Segmenta a imagem bloco a bloco e costura os rótulos numa máscara global.
+
+    'imagem' pode ser um array mapeado em memória ou um TiffSobDemanda: apenas um
+    bloco por vez é materializado. 'inferir' recebe o bloco em escala de cinza e
+    devolve a máscara de rótulos do bloco. Cada levedura é gravada apenas pelo bloco cujo
+    núcleo contém o seu centroide; com sobreposição maior que o diâmetro das
+    células, esse bloco a contém inteira e as cópias cortadas nos vizinhos são descartadas.
+    'progresso', se informado, recebe a fração de blocos concluídos.
+
+    Retorna (máscara global mapeada em disco, caminho do arquivo da máscara).
+    """
+    if config is None:
+        config = configuracao_blocos()
+    lado = tamanho_bloco(config)
+    sobreposicao = config['sobreposicao']
+    altura, largura = imagem.shape[:2]
+
+    descritor, caminho_mascara = tempfile.mkstemp(suffix='.npy', dir=config['diretorio'])
+    os.close(descritor)
+    masks = np.lib.format.open_memmap(caminho_mascara, mode='w+', dtype=np.uint32, shape=(altura, largura))
+
+    blocos_y = intervalos_blocos(altura, lado, sobreposicao)
+    blocos_x = intervalos_blocos(largura, lado, sobreposicao)
+    total_blocos = len(blocos_y) * len(blocos_x)
+    print(f"Segmentação em {total_blocos} blocos de até {lado}x{lado} px "
+          f"(sobreposição de {sobreposicao} px)")
+
+    blocos_concluidos = 0
+    proximo_rotulo = 1
+    for y0, y1, ny0, ny1 in blocos_y:
+        for x0, x1, nx0, nx1 in blocos_x:
+            if progresso is not None:
+                progresso(blocos_concluidos / total_blocos)
+            blocos_concluidos += 1
+
+            bloco = np.asarray(imagem[y0:y1, x0:x1])
+            if bloco.ndim == 3:
+                bloco = cv2.cvtColor(bloco, cv2.COLOR_RGB2GRAY)
+
+            rotulos = inferir(bloco)
+            fatias = ndimage.find_objects(rotulos)
+            if not fatias:
+                continue
+
+            indices = np.arange(1, len(fatias) + 1)
+            centroides = ndimage.center_of_mass(rotulos > 0, rotulos, indices)
+
+            for rotulo, fatia, (cy, cx) in zip(indices, fatias, centroides):
+                if fatia is None:
+                    continue
+
+                # Só o bloco dono do centroide grava a levedura (elimina duplicatas nas costuras)
+                cy, cx = cy + y0, cx + x0
+                if not (ny0 <= cy < ny1 and nx0 <= cx < nx1):
+                    continue
+
+                regiao = rotulos[fatia] == rotulo
+                destino = masks[y0 + fatia[0].start:y0 + fatia[0].stop, x0 + fatia[1].start:x0 + fatia[1].stop]
+                destino[regiao & (destino == 0)] = proximo_rotulo
+                proximo_rotulo += 1
+
+            masks.flush()
+
+    print(f"Costura concluída: {proximo_rotulo - 1} leveduras")
+    return masks, caminho_mascara
+
+
+def remover_mascara_temporaria(caminho_mascara):
+    """Apaga o arquivo temporário da máscara global"""
+    try:
+        os.unlink(caminho_mascara)
+    except OSError as e:
+        print(f"Erro ao remover máscara temporária {caminho_mascara}: {str(e)}")
+
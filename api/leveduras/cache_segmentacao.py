@@ -0,0 +1,139 @@
+import hashlib
+import json
+import tempfile
+
+import numpy as np
+from django.conf import settings
+from django.core.files import File
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .mascaras import escrever_npz, mascara_referenciada
+from .models import CacheSegmentacao, ImagemMicroscopica
+
+TAMANHO_LEITURA = 1024 * 1024
+
+
+def cache_ativo():
+    return getattr(settings, 'LEVEDURAS_CACHE_ATIVO', True)
+
+
+def hash_arquivo(arquivo):
+    """SHA-256 do conteúdo do arquivo, lido em blocos"""
+    sha256 = hashlib.sha256()
+    with arquivo.open('rb') as f:
+        for bloco in iter(lambda: f.read(TAMANHO_LEITURA), b''):
+            sha256.update(bloco)
+    return sha256.hexdigest()
+
+
+def chave_cache(hash_imagem, parametros):
+    """Chave do cache: conteúdo da imagem mais todos os parâmetros que afetam o resultado"""
+    serializado = json.dumps(parametros, sort_keys=True)
+    return hashlib.sha256(f"{hash_imagem}:{serializado}".encode()).hexdigest()
+
+
+def buscar(chave):
+    """
+    Retorna (máscara, características por levedura_id, nome do arquivo da máscara no
+    storage) em caso de acerto, ou None
+    """
+    entrada = CacheSegmentacao.objects.filter(chave=chave).first()
+    if entrada is None:
+        return None
+
+    try:
+        with entrada.mascara.open('rb') as f:
+            masks = np.load(f)['masks']
+    except (OSError, KeyError, ValueError) as e:
+        # Arquivo perdido ou corrompido: descarta a entrada
+        print(f"Entrada de cache {chave[:12]} inválida: {str(e)}")
+        remover_entrada(entrada)
+        return None
+
+    CacheSegmentacao.objects.filter(id=entrada.id).update(
+        acertos=F('acertos') + 1,
+        ultimo_acesso=timezone.now()
+    )
+    caracteristicas = {int(levedura_id): valor for levedura_id, valor in entrada.caracteristicas.items()}
+    return masks, caracteristicas, entrada.mascara.name
+
+
+def armazenar(chave, hash_imagem, parametros, masks, caracteristicas, mascara=None):
+    """
+    Grava a entrada (máscara e características) e aplica a política de tamanho.
+
+    'mascara' é o nome no storage da máscara já gravada da imagem
+    (ImagemMicroscopica.mascara): a entrada passa a referenciá-la em vez de gravar
+    outra cópia. Sem ela (LEVEDURAS_MASCARAS_ATIVO = False) a máscara é gravada aqui.
+    """
+    entrada = CacheSegmentacao(
+        chave=chave,
+        hash_imagem=hash_imagem,
+        parametros=parametros,
+        caracteristicas={str(levedura_id): valor for levedura_id, valor in caracteristicas.items()},
+    )
+    if mascara:
+        entrada.mascara.name = mascara
+    else:
+        with tempfile.TemporaryFile() as arquivo:
+            escrever_npz(arquivo, masks)
+            arquivo.seek(0)
+            entrada.mascara.save(f"{chave}.npz", File(arquivo), save=False)
+    entrada.tamanho_bytes = entrada.mascara.size
+
+    try:
+        with transaction.atomic():
+            entrada.save()
+    except IntegrityError:
+        # Outro worker armazenou a mesma chave ao mesmo tempo
+        if not mascara:
+            entrada.mascara.storage.delete(entrada.mascara.name)
+        return None
+
+    despejar()
+    return entrada
+
+
+def remover_entrada(entrada):
+    # A máscara continua no storage enquanto alguma imagem a referenciar
+    if entrada.mascara.name and not mascara_referenciada(entrada.mascara.name, exceto_cache=entrada.id):
+        entrada.mascara.storage.delete(entrada.mascara.name)
+    entrada.delete()
+
+
+def despejar():
+    """Remove as entradas usadas há mais tempo até o cache caber em LEVEDURAS_CACHE_MAX_MB"""
+    limite = getattr(settings, 'LEVEDURAS_CACHE_MAX_MB', 2048) * 1024 * 1024
+    total = CacheSegmentacao.objects.aggregate(total=Sum('tamanho_bytes'))['total'] or 0
+
+    removidas = 0
+    for entrada in CacheSegmentacao.objects.order_by('ultimo_acesso').iterator():
+        if total <= limite:
+            break
+        total -= entrada.tamanho_bytes
+        remover_entrada(entrada)
+        removidas += 1
+
+    if removidas:
+        print(f"Cache de segmentação: {removidas} entrada(s) removida(s)")
+    return removidas
+
+
+def estatisticas_cache():
+    """Taxa de acerto (pelas imagens processadas) e ocupação do cache"""
+    acertos = ImagemMicroscopica.objects.filter(metadata__cache='acerto').count()
+    falhas = ImagemMicroscopica.objects.filter(metadata__cache='falha').count()
+    ocupacao = CacheSegmentacao.objects.aggregate(total=Sum('tamanho_bytes'), acertos=Sum('acertos'))
+
+    return {
+        'ativo': cache_ativo(),
+        'acertos': acertos,
+        'falhas': falhas,
+        'taxa_acerto': acertos / (acertos + falhas) if acertos + falhas else None,
+        'entradas': CacheSegmentacao.objects.count(),
+        'tamanho_bytes': ocupacao['total'] or 0,
+        'limite_bytes': getattr(settings, 'LEVEDURAS_CACHE_MAX_MB', 2048) * 1024 * 1024,
+        'acertos_entradas_atuais': ocupacao['acertos'] or 0,
+    }
@@ -0,0 +1,173 @@
+import math
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .regioes import lotes_de_linhas
+
+MODOS_CARACTERISTICAS = ('mascara', 'recorte')
+
+# Contornos menores que isso (em pixels²) são descartados
+AREA_MINIMA_PIXELS = 50
+
+
+def modo_caracteristicas(imagem_micro=None):
+    """
+    Modo de extração de características: 'mascara' usa o contorno do Cellpose,
+    'recorte' re-segmenta cada recorte (comportamento legado)
+    """
+    modo = None
+    if imagem_micro is not None and imagem_micro.metadata:
+        modo = imagem_micro.metadata.get('modo_caracteristicas')
+    if modo is None:
+        modo = getattr(settings, 'LEVEDURAS_MODO_CARACTERISTICAS', 'mascara')
+    if modo not in MODOS_CARACTERISTICAS:
+        raise ValueError(f"Modo de características inválido: {modo}")
+    return modo
+
+
+def caracteristicas_contorno(contour, microns_por_pixel):
+    """
+    Calcula as características morfológicas de um contorno
+    """
+    area_pixels = cv2.contourArea(contour)
+    area_microns2 = area_pixels * (microns_por_pixel ** 2)
+
+    perimetro_pixels = cv2.arcLength(contour, closed=True)
+    perimetro_microns = perimetro_pixels * microns_por_pixel
+
+    # Circularidade
+    circularidade = (4 * np.pi * area_pixels) / (perimetro_pixels ** 2) if perimetro_pixels > 0 else 0.0
+
+    # Solidez
+    hull = cv2.convexHull(contour)
+    area_hull = cv2.contourArea(hull)
+    solidez = area_pixels / area_hull if area_hull > 0 else 0.0
+
+    # Diâmetro equivalente (diâmetro de um círculo com a mesma área)
+    diametro_equivalente_pixels = 2 * math.sqrt(area_pixels / math.pi)
+    diametro_equivalente_microns = diametro_equivalente_pixels * microns_por_pixel
+
+    # Eixos e relação de aspecto
+    eixo_maior_microns = 0
+    eixo_menor_microns = 0
+    relacao_aspecto = 0
+    angulacao_graus = 0
+
+    if len(contour) >= 5:
+        (center_ellipse, axes_ellipse, angle_ellipse) = cv2.fitEllipse(contour)
+        eixo_menor_pixels = min(axes_ellipse)
+        eixo_maior_pixels = max(axes_ellipse)
+
+        eixo_maior_microns = eixo_maior_pixels * microns_por_pixel
+        eixo_menor_microns = eixo_menor_pixels * microns_por_pixel
+        relacao_aspecto = eixo_maior_pixels / eixo_menor_pixels if eixo_menor_pixels > 0 else 0
+        angulacao_graus = angle_ellipse
+
+    # Centroide
+    M = cv2.moments(contour)
+    cx, cy = 0, 0
+    if M["m00"] != 0:
+        cx = int(M["m10"] / M["m00"])
+        cy = int(M["m01"] / M["m00"])
+
+    return {
+        'area_pixels': float(area_pixels),
+        'area_microns': float(area_microns2),
+        'perimetro_pixels': float(perimetro_pixels),
+        'perimetro_microns': float(perimetro_microns),
+        'circularidade': float(circularidade),
+        'solidez': float(solidez),
+        'diametro_equivalente_microns': float(diametro_equivalente_microns),
+        'eixo_maior_microns': float(eixo_maior_microns),
+        'eixo_menor_microns': float(eixo_menor_microns),
+        'relacao_aspecto': float(relacao_aspecto),
+        'angulacao_graus': float(angulacao_graus),
+        'centroide_x': cx,
+        'centroide_y': cy,
+        'microns_por_pixel': microns_por_pixel
+    }
+
+
+# Colunas de LeveduraSegmentada preenchidas a partir do JSON de características
+COLUNAS_CARACTERISTICAS = {
+    'diametro_equivalente': 'diametro_equivalente_microns',
+    'circularidade': 'circularidade',
+    'solidez': 'solidez',
+    'relacao_aspecto': 'relacao_aspecto',
+    'area_pixels': 'area_pixels',
+    'area_microns': 'area_microns',
+    'perimetro_microns': 'perimetro_microns',
+    'eixo_maior_microns': 'eixo_maior_microns',
+    'eixo_menor_microns': 'eixo_menor_microns',
+    'angulacao_graus': 'angulacao_graus',
+    'centroide_x': 'centroide_x',
+    'centroide_y': 'centroide_y',
+}
+
+
+def colunas_caracteristicas(caracteristicas):
+    """Valores das colunas de características de uma levedura (None quando não extraídas)"""
+    caracteristicas = caracteristicas or {}
+    return {coluna: caracteristicas.get(chave) for coluna, chave in COLUNAS_CARACTERISTICAS.items()}
+
+
+def centroides_mascara(masks, total_rotulos):
+    """
+    Centroides (x, y) de todos os rótulos em coordenadas da imagem, calculados
+    de forma vetorizada a partir dos momentos de primeira ordem dos pixels
+    """
+    contagem = np.zeros(total_rotulos + 1, dtype=np.float64)
+    soma_x = np.zeros(total_rotulos + 1, dtype=np.float64)
+    soma_y = np.zeros(total_rotulos + 1, dtype=np.float64)
+    _, largura = masks.shape
+
+    for inicio, faixa in lotes_de_linhas(masks):
+        rotulos = faixa.ravel()
+        indices = np.flatnonzero(rotulos)
+        rotulos = rotulos[indices]
+        ys, xs = np.divmod(indices, largura)
+
+        contagem += np.bincount(rotulos, minlength=total_rotulos + 1)[:total_rotulos + 1]
+        soma_x += np.bincount(rotulos, weights=xs, minlength=total_rotulos + 1)[:total_rotulos + 1]
+        soma_y += np.bincount(rotulos, weights=ys + inicio, minlength=total_rotulos + 1)[:total_rotulos + 1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return soma_x / contagem, soma_y / contagem
+
+
+def extrair_caracteristicas_mascara(masks, regioes, microns_por_pixel):
+    """
+    Extrai as características de todas as leveduras diretamente da máscara do Cellpose.
+
+    Retorna um dicionário levedura_id -> características (ou None para contornos
+    pequenos demais). O centroide é dado em coordenadas da imagem inteira.
+    """
+    if not regioes:
+        return {}
+
+    total_rotulos = max(regiao['levedura_id'] for regiao in regioes)
+    centroides_x, centroides_y = centroides_mascara(masks, total_rotulos)
+
+    caracteristicas = {}
+    for regiao in regioes:
+        levedura_id = regiao['levedura_id']
+        contour = regiao['contorno']
+        if cv2.contourArea(contour) < AREA_MINIMA_PIXELS:
+            caracteristicas[levedura_id] = None
+            continue
+
+        try:
+            resultado = caracteristicas_contorno(contour, microns_por_pixel)
+        except Exception as e:
+            print(f"Erro ao extrair características da levedura {levedura_id}: {str(e)}")
+            caracteristicas[levedura_id] = None
+            continue
+
+        resultado['area_pixels_mascara'] = regiao['area_pixels']
+        resultado['centroide_x'] = int(centroides_x[levedura_id])
+        resultado['centroide_y'] = int(centroides_y[levedura_id])
+        caracteristicas[levedura_id] = resultado
+
+    return caracteristicas
@@ -0,0 +1,177 @@
+import math
+import os
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import Q
+
+from .blocos import abrir_imagem_mapeada, abrir_imagem_sob_demanda, verificar_pixels
+from .models import ImagemMicroscopica
+from .recortes import codificar_recorte
+
+# Modos do PIL com um único canal
+MODOS_CINZA = ('1', 'L', 'I', 'I;16', 'I;16B', 'I;16L', 'F')
+
+
+def configuracao_decodificacao():
+    return {
+        'cinza': getattr(settings, 'LEVEDURAS_DECODIFICAR_CINZA', False),
+        'preview_lado': getattr(settings, 'LEVEDURAS_PREVIEW_LADO', 512),
+        'preview_qualidade': getattr(settings, 'LEVEDURAS_PREVIEW_QUALIDADE', 80),
+    }
+
+
+def sondar_imagem(caminho):
+    """Formato, modo, altura e largura lendo apenas o cabeçalho (PIL)"""
+    from PIL import Image
+
+    try:
+        with Image.open(caminho) as imagem:
+            largura, altura = imagem.size
+            info = {'formato': imagem.format, 'modo': imagem.mode, 'altura': altura, 'largura': largura}
+    except Image.DecompressionBombError as e:
+        # Acima do limite do Pillow no processo (o worker o eleva a LEVEDURAS_MAX_PIXELS)
+        raise ValueError(str(e))
+    except OSError:
+        # Formato que o PIL não reconhece: o OpenCV ainda pode decodificar
+        return {'formato': None, 'modo': None, 'altura': None, 'largura': None}
+    verificar_pixels(altura, largura)
+    return info
+
+
+def _ler_opencv(caminho, flags):
+    img = cv2.imread(caminho, flags)
+    if img is None:
+        raise ValueError(f"Não foi possível decodificar a imagem {os.path.basename(caminho)}")
+    return img
+
+
+def decodificar_imagem(caminho, info=None, cinza=None):
+    """
+    Decodifica a imagem com o leitor mais barato para o formato:
+
+    - TIFF não comprimido: mapeado em memória (tifffile), sem decodificar;
+    - demais TIFFs: tifffile, que preserva a profundidade e as páginas;
+    - imagens de um canal (ou cinza=True): OpenCV direto em um canal, na
+      profundidade original, sem expandir para RGB;
+    - imagens coloridas: OpenCV em RGB (alfa descartado), como o io.imread do Cellpose.
+
+    Com cinza=None vale LEVEDURAS_DECODIFICAR_CINZA; nesse caso os recortes também
+    ficam em escala de cinza.
+    """
+    if info is None:
+        info = sondar_imagem(caminho)
+    if cinza is None:
+        cinza = configuracao_decodificacao()['cinza']
+
+    if info['formato'] == 'TIFF':
+        img = abrir_imagem_mapeada(caminho)
+        if img is None:
+            try:
+                import tifffile
+                img = tifffile.imread(caminho)
+            except ImportError:
+                img = None
+        if img is not None:
+            return converter_cinza(img) if cinza else img
+
+    if cinza or info['modo'] in MODOS_CINZA:
+        return _ler_opencv(caminho, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_ANYDEPTH)
+
+    img = _ler_opencv(caminho, cv2.IMREAD_UNCHANGED)
+    if img.ndim == 3:
+        img = img[..., 2::-1] if img.shape[2] >= 3 else img[..., 0]
+    return np.ascontiguousarray(img)
+
+
+def converter_cinza(img):
+    if img.ndim == 3 and img.shape[2] >= 3:
+        return cv2.cvtColor(np.ascontiguousarray(img[..., :3]), cv2.COLOR_RGB2GRAY)
+    if img.ndim == 3:
+        return img[..., 0]
+    return img
+
+
+def _preview_jpeg(caminho, info, lado):
+    """JPEG decodificado já em resolução reduzida (escala da DCT do libjpeg)"""
+    from PIL import Image
+
+    with Image.open(caminho) as imagem:
+        modo = 'L' if imagem.mode == 'L' else 'RGB'
+        imagem.draft(modo, (max(1, info['largura'] * lado // max(info['altura'], info['largura'])),
+                            max(1, info['altura'] * lado // max(info['altura'], info['largura']))))
+        return np.asarray(imagem.convert(modo))
+
+
+def gerar_preview(caminho, lado=None, qualidade=None):
+    """
+    Miniatura JPEG da imagem, com o maior lado igual a 'lado'. Retorna (bytes, extensão).
+
+    JPEGs são decodificados em resolução reduzida e TIFFs (mapeados em memória ou
+    lidos por strip/tile) são amostrados com passo, sem materializar a imagem
+    inteira; os demais formatos precisam ser decodificados por completo.
+    """
+    config = configuracao_decodificacao()
+    lado = lado or config['preview_lado']
+    qualidade = qualidade or config['preview_qualidade']
+    info = sondar_imagem(caminho)
+
+    img = None
+    if info['formato'] == 'JPEG':
+        img = _preview_jpeg(caminho, info, lado)
+    elif info['formato'] == 'TIFF':
+        mapeada = abrir_imagem_sob_demanda(caminho)
+        if mapeada is not None and mapeada.ndim in (2, 3):
+            passo = max(1, math.floor(max(mapeada.shape[:2]) / lado))
+            img = np.ascontiguousarray(mapeada[::passo, ::passo])
+    if img is None:
+        img = decodificar_imagem(caminho, info, cinza=False)
+
+    if img.ndim == 3:
+        img = img[..., :3] if img.shape[2] >= 3 else img[..., 0]
+    img = np.ascontiguousarray(img)
+    if img.dtype not in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+        img = img.astype(np.float32)
+    escala = lado / max(img.shape[:2])
+    if escala < 1:
+        largura = max(1, round(img.shape[1] * escala))
+        altura = max(1, round(img.shape[0] * escala))
+        img = cv2.resize(img, (largura, altura), interpolation=cv2.INTER_AREA)
+
+    # codificar_recorte normaliza imagens de 16 bits ou float para 8 bits
+    conteudo, extensao, _ = codificar_recorte(
+        img, {'formato': 'jpeg', 'qualidade': qualidade, 'compressao_png': None}
+    )
+    return conteudo, extensao
+
+
+def salvar_preview(imagem_micro):
+    """
+    Gera e grava a miniatura da imagem microscópica; chamada pelo worker ao reivindicar
+    o job, nunca no caminho de uma requisição. Falhas não são propagadas: a imagem
+    fica sem preview e a interface usa url_imagem.
+    """
+    try:
+        conteudo, extensao = gerar_preview(imagem_micro.imagem.path)
+        imagem_micro.preview.save(f"preview_{imagem_micro.id}{extensao}", ContentFile(conteudo), save=False)
+        gravado = ImagemMicroscopica.objects.filter(id=imagem_micro.id).filter(
+            Q(preview__isnull=True) | Q(preview='')
+        ).update(preview=imagem_micro.preview.name)
+        if not gravado:
+            # Outro worker já gravou a miniatura (job devolvido à fila)
+            imagem_micro.preview.storage.delete(imagem_micro.preview.name)
+            imagem_micro.refresh_from_db(fields=['preview'])
+    except Exception as e:
+        print(f"Erro ao gerar preview da imagem {imagem_micro.id}: {str(e)}")
+
+
+def url_preview(imagem_micro):
+    """
+    URL da miniatura gravada ou, antes do worker gerá-la, do endpoint que a serve
+    (e redireciona para a imagem original enquanto ela não existir)
+    """
+    if imagem_micro.preview:
+        return imagem_micro.preview.url
+    return f'/api/analises/{imagem_micro.id}/preview/'
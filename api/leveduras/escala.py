@@ -0,0 +1,99 @@
+import cv2
+import numpy as np
+from django.conf import settings
+
+# Diâmetro das células, em pixels, com que os modelos do Cellpose foram treinados
+DIAMETRO_TREINO_PIXELS = 30
+
+
+def configuracao_escala():
+    return {
+        'diametro_microns': getattr(settings, 'LEVEDURAS_DIAMETRO_ESPERADO_MICRONS', None),
+        'diametro_alvo': getattr(settings, 'LEVEDURAS_DIAMETRO_ALVO_PIXELS', DIAMETRO_TREINO_PIXELS),
+        'comparar': getattr(settings, 'LEVEDURAS_ESCALA_COMPARAR', False),
+    }
+
+
+def calcular_escala(microns_por_pixel, config=None):
+    """
+    Fator de redução da imagem antes da inferência, derivado do diâmetro esperado
+    das células. Retorna None se o modo estiver desligado.
+
+    O fator leva o diâmetro esperado ao diâmetro alvo (nunca amplia a imagem); o
+    diâmetro resultante é passado ao Cellpose, que assim não precisa estimá-lo.
+    """
+    if config is None:
+        config = configuracao_escala()
+    if not config['diametro_microns']:
+        return None
+
+    diametro_pixels = config['diametro_microns'] / microns_por_pixel
+    fator = min(1.0, config['diametro_alvo'] / diametro_pixels)
+    return {
+        'diametro_microns': config['diametro_microns'],
+        'diametro_pixels': diametro_pixels,
+        'fator': fator,
+        'diametro_reduzido': diametro_pixels * fator,
+    }
+
+
+def reduzir_imagem(imagem, fator):
+    if fator >= 1:
+        return imagem
+    altura, largura = imagem.shape[:2]
+    tamanho = (max(1, round(largura * fator)), max(1, round(altura * fator)))
+    return cv2.resize(np.ascontiguousarray(imagem), tamanho, interpolation=cv2.INTER_AREA)
+
+
+def ampliar_mascara(masks, forma):
+    """
+    Amplia a máscara de rótulos para 'forma' (altura, largura) por vizinho mais
+    próximo. A indexação preserva os rótulos em qualquer dtype (o cv2.resize não
+    aceita uint32).
+    """
+    altura, largura = forma
+    if masks.shape[:2] == (altura, largura):
+        return masks
+    linhas = np.minimum((np.arange(altura) + 0.5) * masks.shape[0] / altura, masks.shape[0] - 1).astype(np.intp)
+    colunas = np.minimum((np.arange(largura) + 0.5) * masks.shape[1] / largura, masks.shape[1] - 1).astype(np.intp)
+    return masks[np.ix_(linhas, colunas)]
+
+
+def comparar_mascaras(masks, referencia, iou_minimo=0.5):
+    """
+    Diferença entre a máscara da inferência reduzida (já ampliada) e a da resolução
+    completa: contagens, IoU do primeiro plano e, para cada célula da referência, o
+    IoU com a célula da outra máscara que mais a sobrepõe
+    """
+    total = int(referencia.max()) + 1
+    primeiro_plano = masks > 0
+    primeiro_plano_ref = referencia > 0
+    uniao = np.count_nonzero(primeiro_plano | primeiro_plano_ref)
+
+    contagem = len(np.unique(masks[primeiro_plano]))
+    contagem_ref = len(np.unique(referencia[primeiro_plano_ref]))
+
+    # Interseções de cada par (célula da referência, célula da máscara) em uma passada
+    ambos = primeiro_plano & primeiro_plano_ref
+    pares, intersecoes = np.unique(
+        referencia[ambos].astype(np.int64) * (int(masks.max()) + 1) + masks[ambos], return_counts=True
+    )
+    rotulos_ref, rotulos = np.divmod(pares, int(masks.max()) + 1)
+    areas_ref = np.bincount(referencia.ravel(), minlength=total)
+    areas = np.bincount(masks.ravel())
+    ious = intersecoes / (areas_ref[rotulos_ref] + areas[rotulos] - intersecoes)
+
+    melhor_iou = np.zeros(total)
+    np.maximum.at(melhor_iou, rotulos_ref, ious)
+    melhor_iou = melhor_iou[np.unique(referencia[primeiro_plano_ref])] if contagem_ref else melhor_iou[:0]
+
+    return {
+        'leveduras': contagem,
+        'leveduras_resolucao_completa': contagem_ref,
+        'diferenca_contagem': contagem - contagem_ref,
+        'iou_primeiro_plano': float(np.count_nonzero(ambos) / uniao) if uniao else 1.0,
+        'iou_medio_celulas': float(melhor_iou.mean()) if melhor_iou.size else None,
+        'fracao_celulas_correspondidas': (
+            float(np.count_nonzero(melhor_iou >= iou_minimo) / melhor_iou.size) if melhor_iou.size else None
+        ),
+    }
@@ -0,0 +1,183 @@
+import hashlib
+import json
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Avg, Count, Max, Min, Q, StdDev
+
+from .exportacao import blocos_por_chave
+from .models import LeveduraSegmentada
+
+# Colunas de LeveduraSegmentada sobre as quais as estatísticas de população podem ser calculadas
+CAMPOS_ESTATISTICAS = (
+    'area_microns', 'diametro_equivalente', 'circularidade', 'solidez', 'relacao_aspecto',
+    'perimetro_microns', 'eixo_maior_microns', 'eixo_menor_microns',
+)
+CAMPOS_PADRAO = ('area_microns', 'circularidade', 'relacao_aspecto')
+PERCENTIS_PADRAO = (5, 25, 50, 75, 95)
+BINS_PADRAO = 30
+MAX_BINS = 500
+
+# Colunas pelas quais as estatísticas podem ser agrupadas
+AGRUPAMENTOS = {
+    'analise': 'analise_id',
+    'imagem': 'imagem_original_id',
+}
+
+# Linhas lidas do banco por vez ao montar os vetores NumPy
+LINHAS_POR_LEITURA = 20000
+
+
+def leveduras_selecionadas(analises_ids, imagens_ids):
+    filtro = Q(pk__in=[])
+    if analises_ids:
+        filtro |= Q(analise_id__in=analises_ids)
+    if imagens_ids:
+        filtro |= Q(imagem_original_id__in=imagens_ids)
+    return LeveduraSegmentada.objects.filter(filtro)
+
+
+def versao_dados(leveduras):
+    """Muda sempre que leveduras entram ou saem da seleção ou têm as características recalculadas"""
+    versao = leveduras.aggregate(total=Count('id'), ultima=Max('criado_em'), atualizacao=Max('atualizado_em'))
+    ultima = versao['ultima'].isoformat() if versao['ultima'] else ''
+    atualizacao = versao['atualizacao'].isoformat() if versao['atualizacao'] else ''
+    return f"{versao['total']}:{ultima}:{atualizacao}"
+
+
+def chave_cache_populacao(parametros, versao):
+    serializado = json.dumps(parametros, sort_keys=True, default=str)
+    return 'leveduras:populacao:' + hashlib.sha256(f"{serializado}:{versao}".encode()).hexdigest()
+
+
+def carregar_valores(leveduras, coluna_grupo, campos):
+    """
+    Lê (grupo, campos...) em blocos paginados por chave (blocos_por_chave, como na
+    exportação) e devolve (códigos dos grupos, rótulos, matriz de valores com NaN
+    para características ausentes). Cada grupo vira um código inteiro; rotulos[código]
+    é o id do grupo como string.
+    """
+    codigos = {}
+    blocos_codigos = []
+    blocos_valores = []
+    for bloco in blocos_por_chave(leveduras, [coluna_grupo] + list(campos), LINHAS_POR_LEITURA):
+        blocos_codigos.append(np.array(
+            [codigos.setdefault(linha[coluna_grupo], len(codigos)) for linha in bloco], dtype=np.int32
+        ))
+        valores = np.empty((len(bloco), len(campos)), dtype=np.float64)
+        for indice, campo in enumerate(campos):
+            # None (característica ausente) vira NaN
+            valores[:, indice] = np.array([linha[campo] for linha in bloco], dtype=np.float64)
+        blocos_valores.append(valores)
+
+    rotulos = [str(grupo) for grupo in codigos]
+    if not blocos_valores:
+        return np.empty(0, dtype=np.int32), rotulos, np.empty((0, len(campos)))
+    return np.concatenate(blocos_codigos), rotulos, np.concatenate(blocos_valores)
+
+
+def resumo_valores(valores, percentis):
+    """Contagem e percentis de um vetor, ignorando NaN"""
+    valores = valores[~np.isnan(valores)]
+    if valores.size == 0:
+        return {'contagem': 0, 'percentis': {f'{p:g}': None for p in percentis}}
+    return {
+        'contagem': int(valores.size),
+        'percentis': {f'{p:g}': float(v) for p, v in zip(percentis, np.percentile(valores, percentis))},
+    }
+
+
+def histograma(valores, bins):
+    valores = valores[~np.isnan(valores)]
+    if valores.size == 0:
+        return {'limites': [], 'contagens': []}
+    contagens, limites = np.histogram(valores, bins=bins)
+    return {'limites': limites.tolist(), 'contagens': contagens.tolist()}
+
+
+def calcular_estatisticas_populacao(leveduras, campos, agrupar, bins, percentis):
+    """
+    Estatísticas agregadas por grupo numa única consulta agrupada e histogramas e
+    percentis (geral e por grupo) numa passada NumPy sobre as colunas pedidas
+    """
+    coluna_grupo = AGRUPAMENTOS[agrupar]
+
+    agregados = {}
+    for campo in campos:
+        agregados[f'{campo}__media'] = Avg(campo)
+        agregados[f'{campo}__desvio_padrao'] = StdDev(campo)
+        agregados[f'{campo}__min'] = Min(campo)
+        agregados[f'{campo}__max'] = Max(campo)
+    linhas_grupos = leveduras.order_by().values(coluna_grupo).annotate(total_leveduras=Count('id'), **agregados)
+
+    grupos = {}
+    for linha in linhas_grupos:
+        grupos[str(linha[coluna_grupo])] = {
+            'total_leveduras': linha['total_leveduras'],
+            'campos': {
+                campo: {
+                    'media': linha[f'{campo}__media'],
+                    'desvio_padrao': linha[f'{campo}__desvio_padrao'],
+                    'min': linha[f'{campo}__min'],
+                    'max': linha[f'{campo}__max'],
+                }
+                for campo in campos
+            },
+        }
+
+    codigos_grupos, rotulos_grupos, valores = carregar_valores(leveduras, coluna_grupo, campos)
+
+    geral = {}
+    for indice, campo in enumerate(campos):
+        coluna = valores[:, indice]
+        geral[campo] = {**resumo_valores(coluna, percentis), 'histograma': histograma(coluna, bins)}
+
+    # Percentis por grupo: ordena pelo código do grupo e percorre fatias contíguas
+    if codigos_grupos.size:
+        ordem = np.argsort(codigos_grupos, kind='stable')
+        codigos_ordenados = codigos_grupos[ordem]
+        valores_ordenados = valores[ordem]
+        inicios = np.flatnonzero(np.r_[True, codigos_ordenados[1:] != codigos_ordenados[:-1]])
+        fins = np.r_[inicios[1:], codigos_ordenados.size]
+        for inicio, fim in zip(inicios, fins):
+            grupo = grupos.get(rotulos_grupos[codigos_ordenados[inicio]])
+            if grupo is None:
+                continue
+            for indice, campo in enumerate(campos):
+                grupo['campos'][campo]['percentis'] = resumo_valores(
+                    valores_ordenados[inicio:fim, indice], percentis
+                )['percentis']
+
+    return {
+        'total_leveduras': int(valores.shape[0]),
+        'agrupamento': agrupar,
+        'geral': geral,
+        'grupos': grupos,
+    }
+
+
+def estatisticas_populacao(analises_ids, imagens_ids, campos=CAMPOS_PADRAO, agrupar='analise',
+                           bins=BINS_PADRAO, percentis=PERCENTIS_PADRAO):
+    """
+    Estatísticas de população sobre um conjunto de análises e/ou imagens, guardadas
+    no cache do Django até novas leveduras entrarem na seleção
+    """
+    leveduras = leveduras_selecionadas(analises_ids, imagens_ids)
+    parametros = {
+        'analises': sorted(str(analise_id) for analise_id in analises_ids),
+        'imagens': sorted(int(imagem_id) for imagem_id in imagens_ids),
+        'campos': list(campos),
+        'agrupar': agrupar,
+        'bins': bins,
+        'percentis': list(percentis),
+    }
+    chave = chave_cache_populacao(parametros, versao_dados(leveduras))
+
+    resultado = cache.get(chave)
+    if resultado is not None:
+        return {**resultado, 'cache': True}
+
+    resultado = calcular_estatisticas_populacao(leveduras, list(campos), agrupar, bins, list(percentis))
+    cache.set(chave, resultado, getattr(settings, 'LEVEDURAS_ESTATISTICAS_CACHE_TIMEOUT', 3600))
+    return {**resultado, 'cache': False}
@@ -0,0 +1,256 @@
+import csv
+import json
+import tempfile
+import uuid
+import zipfile
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .caracteristicas import COLUNAS_CARACTERISTICAS
+from .models import LeveduraSegmentada
+from .recortes import LeitorRecortes, SaidaStream
+
+FORMATOS_EXPORTACAO = ('csv', 'parquet')
+
+# Colunas exportadas além das características
+COLUNAS_IDENTIFICACAO = ['id', 'analise_id', 'imagem_original_id', 'levedura_id', 'criado_em']
+COLUNAS_BOUNDING_BOX = ['bbox_x', 'bbox_y', 'bbox_largura', 'bbox_altura']
+COLUNAS_EXPORTACAO = COLUNAS_IDENTIFICACAO + COLUNAS_BOUNDING_BOX + list(COLUNAS_CARACTERISTICAS)
+
+
+class FiltroInvalido(ValueError):
+    pass
+
+
+def tamanho_bloco_exportacao():
+    return getattr(settings, 'LEVEDURAS_EXPORTACAO_TAMANHO_BLOCO', 5000)
+
+
+def _data(valor, nome):
+    """Data (filtra pelo dia) ou data e hora (filtra pelo instante)"""
+    try:
+        data = parse_date(valor)
+        if data is None:
+            data = parse_datetime(valor)
+            if data is not None and timezone.is_naive(data):
+                data = timezone.make_aware(data)
+    except ValueError:
+        data = None
+    if data is None:
+        raise FiltroInvalido(f"{nome} deve ser uma data (AAAA-MM-DD) ou data e hora ISO 8601")
+    return data
+
+
+def filtrar_leveduras(parametros):
+    """
+    Monta o queryset da exportação a partir dos filtros:
+    - analises, imagens: ids separados por vírgulas
+    - desde, ate: intervalo de criado_em
+    - <caracteristica>_min, <caracteristica>_max: faixas de valores
+    """
+    leveduras = LeveduraSegmentada.objects.all()
+
+    analises = [valor.strip() for valor in parametros.get('analises', '').split(',') if valor.strip()]
+    imagens = [valor.strip() for valor in parametros.get('imagens', '').split(',') if valor.strip()]
+    if analises or imagens:
+        filtro = Q(pk__in=[])
+        if analises:
+            try:
+                filtro |= Q(analise_id__in=[uuid.UUID(analise) for analise in analises])
+            except ValueError:
+                raise FiltroInvalido("analises deve conter UUIDs")
+        if imagens:
+            try:
+                filtro |= Q(imagem_original_id__in=[int(imagem) for imagem in imagens])
+            except ValueError:
+                raise FiltroInvalido("imagens deve conter ids inteiros")
+        leveduras = leveduras.filter(filtro)
+
+    if parametros.get('desde'):
+        desde = _data(parametros['desde'], 'desde')
+        leveduras = leveduras.filter(**{'criado_em__gte' if isinstance(desde, datetime) else 'criado_em__date__gte': desde})
+    if parametros.get('ate'):
+        ate = _data(parametros['ate'], 'ate')
+        leveduras = leveduras.filter(**{'criado_em__lte' if isinstance(ate, datetime) else 'criado_em__date__lte': ate})
+
+    for coluna in COLUNAS_CARACTERISTICAS:
+        for sufixo, lookup in (('_min', 'gte'), ('_max', 'lte')):
+            valor = parametros.get(coluna + sufixo)
+            if valor in (None, ''):
+                continue
+            try:
+                leveduras = leveduras.filter(**{f'{coluna}__{lookup}': float(valor)})
+            except ValueError:
+                raise FiltroInvalido(f"{coluna + sufixo} deve ser numérico")
+
+    return leveduras
+
+
+def blocos_por_chave(leveduras, colunas, tamanho_bloco=None):
+    """
+    Percorre as leveduras em blocos de dicionários (values) ordenados por
+    (imagem_original_id, levedura_id).
+
+    A paginação é por chave, coberta pelo índice composto, em vez de OFFSET ou de
+    um cursor aberto: a memória fica limitada a um bloco mesmo em bancos cujo
+    driver carrega o resultado inteiro (MySQL).
+    """
+    tamanho_bloco = tamanho_bloco or tamanho_bloco_exportacao()
+    colunas = list(dict.fromkeys(['imagem_original_id', 'levedura_id'] + list(colunas)))
+    leveduras = leveduras.order_by('imagem_original_id', 'levedura_id')
+
+    ultima = None
+    while True:
+        pagina = leveduras
+        if ultima is not None:
+            pagina = pagina.filter(
+                Q(imagem_original_id__gt=ultima['imagem_original_id']) |
+                Q(imagem_original_id=ultima['imagem_original_id'], levedura_id__gt=ultima['levedura_id'])
+            )
+        bloco = list(pagina.values(*colunas)[:tamanho_bloco])
+        if not bloco:
+            return
+        yield bloco
+        if len(bloco) < tamanho_bloco:
+            return
+        ultima = bloco[-1]
+
+
+def linhas_exportacao(leveduras, tamanho_bloco=None):
+    """Gera blocos de linhas (tuplas na ordem de COLUNAS_EXPORTACAO)"""
+    colunas_banco = COLUNAS_IDENTIFICACAO + ['bounding_box'] + list(COLUNAS_CARACTERISTICAS)
+    for bloco in blocos_por_chave(leveduras, colunas_banco, tamanho_bloco):
+        linhas = []
+        for valores in bloco:
+            bbox = valores['bounding_box'] or {}
+            linhas.append(
+                tuple(valores[coluna] for coluna in COLUNAS_IDENTIFICACAO) +
+                (bbox.get('x'), bbox.get('y'), bbox.get('width'), bbox.get('height')) +
+                tuple(valores[coluna] for coluna in COLUNAS_CARACTERISTICAS)
+            )
+        yield linhas
+
+
+class _Eco:
+    """Arquivo fictício: devolve o que recebe, para o csv.writer alimentar o stream"""
+
+    def write(self, valor):
+        return valor
+
+
+def gerar_csv(leveduras):
+    escritor = csv.writer(_Eco())
+    yield escritor.writerow(COLUNAS_EXPORTACAO)
+    for linhas in linhas_exportacao(leveduras):
+        yield ''.join(escritor.writerow(linha) for linha in linhas)
+
+
+def parquet_disponivel():
+    try:
+        import pyarrow  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def gerar_parquet(leveduras):
+    """Um row group do Parquet por bloco de linhas; requer pyarrow"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tipos = {
+        'id': pa.string(),
+        'analise_id': pa.string(),
+        'imagem_original_id': pa.int64(),
+        'levedura_id': pa.int64(),
+        'criado_em': pa.timestamp('us', tz='UTC'),
+        'bbox_x': pa.int64(),
+        'bbox_y': pa.int64(),
+        'bbox_largura': pa.int64(),
+        'bbox_altura': pa.int64(),
+        'centroide_x': pa.int64(),
+        'centroide_y': pa.int64(),
+    }
+    esquema = pa.schema([(coluna, tipos.get(coluna, pa.float64())) for coluna in COLUNAS_EXPORTACAO])
+
+    saida = SaidaStream()
+    escritor = pq.ParquetWriter(saida, esquema)
+    try:
+        for linhas in linhas_exportacao(leveduras):
+            colunas = list(zip(*linhas))
+            colunas[0] = [str(valor) for valor in colunas[0]]
+            colunas[1] = [str(valor) for valor in colunas[1]]
+            escritor.write_table(pa.Table.from_arrays(
+                [pa.array(valores, type=campo.type) for valores, campo in zip(colunas, esquema)],
+                schema=esquema
+            ))
+            yield saida.drenar()
+    finally:
+        escritor.close()
+    yield saida.drenar()
+
+
+def gerar_zip_recortes(leveduras, agrupar_por_imagem=False):
+    """
+    Gera, em stream, um ZIP com os recortes das leveduras e um manifesto
+    (manifesto.jsonl) com bounding box e características de cada uma.
+
+    O ZIP nunca é montado por inteiro: é escrito num destino sem seek (o zipfile
+    usa descritores de dados) e drenado após cada recorte. O manifesto é acumulado
+    num arquivo temporário em spool e anexado ao final.
+    """
+    colunas = [
+        'id', 'levedura_id', 'imagem_original_id', 'nome_arquivo', 'imagem',
+        'pacote_offset', 'pacote_tamanho', 'imagem_original__pacote_recortes',
+        'bounding_box', 'caracteristicas',
+    ]
+    limite_memoria = getattr(settings, 'LEVEDURAS_PACOTE_LIMITE_MEMORIA', 64 * 1024 * 1024)
+    saida = SaidaStream()
+    leitor = LeitorRecortes()
+
+    with tempfile.SpooledTemporaryFile(max_size=limite_memoria, mode='w+b') as manifesto:
+        with zipfile.ZipFile(saida, 'w', zipfile.ZIP_STORED) as arquivo_zip:
+            try:
+                for bloco in blocos_por_chave(leveduras, colunas):
+                    for valores in bloco:
+                        nome = valores['nome_arquivo']
+                        if agrupar_por_imagem:
+                            nome = f"imagem_{valores['imagem_original_id']}/{nome}"
+                        entrada = {
+                            'arquivo': nome,
+                            'id': str(valores['id']),
+                            'imagem_original_id': valores['imagem_original_id'],
+                            'levedura_id': valores['levedura_id'],
+                            'bounding_box': valores['bounding_box'],
+                            'caracteristicas': valores['caracteristicas'],
+                        }
+
+                        try:
+                            conteudo = leitor.ler(
+                                valores['imagem'], valores['imagem_original__pacote_recortes'],
+                                valores['pacote_offset'], valores['pacote_tamanho']
+                            )
+                            arquivo_zip.writestr(nome, conteudo)
+                        except (ValueError, OSError) as e:
+                            print(f"Recorte da levedura {valores['id']} indisponível: {str(e)}")
+                            entrada['arquivo'] = None
+                            entrada['erro'] = str(e)
+
+                        manifesto.write(json.dumps(entrada).encode() + b'\n')
+                        yield saida.drenar()
+            finally:
+                leitor.fechar()
+
+            manifesto.seek(0)
+            # Tamanho desconhecido ao abrir a entrada: sem ZIP64 forçado, um manifesto acima de
+            # 2 GiB só falharia no fim, com o stream já enviado
+            with arquivo_zip.open('manifesto.jsonl', 'w', force_zip64=True) as destino:
+                for parte in iter(lambda: manifesto.read(1024 * 1024), b''):
+                    destino.write(parte)
+                    yield saida.drenar()
+        yield saida.drenar()
@@ -0,0 +1,296 @@
+import os
+import select
+import socket
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ImagemMicroscopica
+
+# A fila de jobs é a própria tabela de ImagemMicroscopica: 'pendente' significa
+# aguardando um worker, 'processando' significa reivindicada pelo worker
+# identificado em task_id ("host:pid"). Novos jobs acordam os workers da máquina com
+# datagramas UDP enviados após o commit do upload, um para a porta de cada worker; a
+# consulta periódica à fila cobre notificações perdidas e workers em outras máquinas.
+
+
+class JobPerdido(Exception):
+    """
+    O job foi devolvido à fila (timeout) e reivindicado por outro worker enquanto este
+    ainda o processava; o resultado deste worker é descartado
+    """
+
+
+def configuracao_fila():
+    return {
+        'workers': getattr(settings, 'LEVEDURAS_FILA_WORKERS', 2),
+        'max_jobs': getattr(settings, 'LEVEDURAS_FILA_MAX', 100),
+        'intervalo': getattr(settings, 'LEVEDURAS_FILA_INTERVALO', 2),
+        'timeout': getattr(settings, 'LEVEDURAS_FILA_TIMEOUT', 3600),
+        'intervalo_recuperacao': getattr(settings, 'LEVEDURAS_FILA_INTERVALO_RECUPERACAO', 60),
+        'tentativas': getattr(settings, 'LEVEDURAS_FILA_TENTATIVAS', 3),
+        'tamanho_lote': getattr(settings, 'LEVEDURAS_LOTE_TAMANHO', 8),
+        'notificacao': getattr(settings, 'LEVEDURAS_FILA_NOTIFICACAO', ('127.0.0.1', 8765)),
+    }
+
+
+def identificador_worker():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def tamanho_fila():
+    """Quantidade de jobs aguardando um worker"""
+    return ImagemMicroscopica.objects.filter(status_processamento='pendente').count()
+
+
+def fila_cheia(novos_jobs=1):
+    """Indica se a fila não comporta mais 'novos_jobs' jobs pendentes ou em processamento"""
+    ativos = ImagemMicroscopica.objects.filter(
+        status_processamento__in=['pendente', 'processando']
+    ).count()
+    return ativos + novos_jobs > configuracao_fila()['max_jobs']
+
+
+def posicao_na_fila(imagem_micro):
+    """
+    Posição (1 = próximo) do job na fila, ou None se ele não estiver aguardando
+    """
+    if imagem_micro.status_processamento != 'pendente':
+        return None
+
+    anteriores = ImagemMicroscopica.objects.filter(status_processamento='pendente').filter(
+        Q(criado_em__lt=imagem_micro.criado_em) |
+        Q(criado_em=imagem_micro.criado_em, id__lt=imagem_micro.id)
+    ).count()
+    return anteriores + 1
+
+
+def portas_notificacao():
+    """
+    Endereços UDP dos workers da máquina: cada worker escuta a própria porta, a partir
+    da porta de LEVEDURAS_FILA_NOTIFICACAO, uma por worker de LEVEDURAS_FILA_WORKERS
+    """
+    config = configuracao_fila()
+    if not config['notificacao']:
+        return []
+    host, porta = config['notificacao']
+    return [(host, porta + indice) for indice in range(config['workers'])]
+
+
+def notificar_workers(novos_jobs=1):
+    """
+    Acorda os workers ociosos para 'novos_jobs' novos jobs; falhas são ignoradas (o polling cobre).
+
+    Todos os workers recebem o datagrama: uma porta compartilhada com SO_REUSEPORT
+    entregaria todas as notificações ao mesmo worker (o kernel escolhe pelo hash da
+    origem), possivelmente ocupado. Os que acordarem sem job pendente voltam a esperar.
+    """
+    enderecos = portas_notificacao()
+    if not enderecos or novos_jobs < 1:
+        return
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            for endereco in enderecos:
+                try:
+                    sock.sendto(b'job', endereco)
+                except ConnectionRefusedError:
+                    # ICMP de um envio anterior para uma porta sem worker
+                    continue
+    except OSError as e:
+        print(f"Erro ao notificar workers: {str(e)}")
+
+
+def enfileirar_apos_commit(novos_jobs=1):
+    """
+    Notifica os workers só depois que a transação do upload (linha e arquivo da
+    imagem) estiver confirmada; fora de transação a notificação é imediata
+    """
+    transaction.on_commit(lambda: notificar_workers(novos_jobs))
+
+
+def abrir_escuta_notificacoes():
+    """
+    Socket UDP em que o worker recebe as notificações, na primeira porta livre de
+    portas_notificacao(), ou None (o worker passa a depender só da consulta periódica)
+    """
+    enderecos = portas_notificacao()
+    for endereco in enderecos:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(endereco)
+        except OSError:
+            # Porta de outro worker
+            sock.close()
+            continue
+        sock.setblocking(False)
+        return sock
+    if enderecos:
+        print("Notificações da fila indisponíveis (todas as portas em uso), usando apenas consulta periódica")
+    return None
+
+
+def aguardar_notificacao(escuta, timeout):
+    """Espera uma notificação de novo job por até 'timeout' segundos"""
+    if escuta is None:
+        time.sleep(timeout)
+        return
+    prontos, _, _ = select.select([escuta], [], [], timeout)
+    if not prontos:
+        return
+    # Descarta as notificações acumuladas; a fila é consultada de qualquer forma
+    try:
+        while True:
+            escuta.recv(64)
+    except BlockingIOError:
+        pass
+
+
+def reivindicar_jobs(worker_id, limite=1):
+    """
+    Reivindica o job pendente mais antigo para o worker, sem disputar linhas travadas
+    por outros workers. Se o job pertencer a um lote, reivindica junto até 'limite'
+    jobs pendentes do mesmo lote.
+    """
+    with transaction.atomic():
+        pendentes = (
+            ImagemMicroscopica.objects
+            .select_for_update(skip_locked=True)
+            .filter(status_processamento='pendente')
+            .order_by('criado_em', 'id')
+        )
+        primeiro = pendentes.first()
+        if primeiro is None:
+            return []
+
+        jobs = [primeiro]
+        lote = (primeiro.metadata or {}).get('lote')
+        if lote and limite > 1:
+            jobs += list(pendentes.filter(metadata__lote=lote).exclude(id=primeiro.id)[:limite - 1])
+
+        agora = timezone.now()
+        for imagem_micro in jobs:
+            imagem_micro.status_processamento = 'processando'
+            imagem_micro.task_id = worker_id
+            imagem_micro.iniciado_em = agora
+            imagem_micro.progresso = 0
+        ImagemMicroscopica.objects.filter(id__in=[imagem_micro.id for imagem_micro in jobs]).update(
+            status_processamento='processando',
+            task_id=worker_id,
+            iniciado_em=agora,
+            progresso=0
+        )
+    return jobs
+
+
+def _processo_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _worker_morto(task_id):
+    """Só é possível afirmar que um worker morreu quando ele rodava nesta mesma máquina"""
+    if not task_id or ':' not in task_id:
+        return True
+    host, pid = task_id.rsplit(':', 1)
+    if host != socket.gethostname():
+        return False
+    try:
+        return not _processo_vivo(int(pid))
+    except ValueError:
+        return True
+
+
+def recuperar_jobs_orfaos():
+    """
+    Devolve para a fila os jobs deixados em 'processando' por workers que morreram
+    (ou que estouraram o timeout). Jobs que já esgotaram as tentativas vão para 'erro'.
+    """
+    config = configuracao_fila()
+    limite = timezone.now() - timedelta(seconds=config['timeout'])
+    recuperados = 0
+
+    with transaction.atomic():
+        em_processamento = (
+            ImagemMicroscopica.objects
+            .select_for_update(skip_locked=True)
+            .filter(status_processamento='processando')
+        )
+        for imagem_micro in em_processamento:
+            expirado = imagem_micro.iniciado_em is None or imagem_micro.iniciado_em < limite
+            if not expirado and not _worker_morto(imagem_micro.task_id):
+                continue
+
+            metadata = imagem_micro.metadata or {}
+            tentativas = metadata.get('tentativas', 0) + 1
+            metadata['tentativas'] = tentativas
+            imagem_micro.metadata = metadata
+            imagem_micro.task_id = None
+
+            if tentativas >= config['tentativas']:
+                imagem_micro.status_processamento = 'erro'
+                imagem_micro.erro_processamento = (
+                    f"Processamento interrompido {tentativas} vezes; job descartado"
+                )
+            else:
+                imagem_micro.status_processamento = 'pendente'
+                imagem_micro.progresso = 0
+                imagem_micro.iniciado_em = None
+            imagem_micro.save()
+            recuperados += 1
+            print(f"Job {imagem_micro.id} recuperado -> {imagem_micro.status_processamento}")
+
+    return recuperados
+
+
+def executar_worker(parar=None):
+    """
+    Laço principal de um processo worker: reivindica e processa jobs até 'parar' ser sinalizado
+    """
+    from .blocos import permitir_imagens_grandes
+    from .decodificacao import salvar_preview
+    from .modelos_cellpose import aquecer_modelos
+    from .views import processar_em_background, processar_lote_em_background
+
+    worker_id = identificador_worker()
+    config = configuracao_fila()
+    permitir_imagens_grandes()
+    if getattr(settings, 'LEVEDURAS_CELLPOSE_AQUECER', True):
+        aquecer_modelos()
+    escuta = abrir_escuta_notificacoes()
+    print(f"Worker {worker_id} iniciado")
+
+    try:
+        while parar is None or not parar.is_set():
+            close_old_connections()
+            jobs = reivindicar_jobs(worker_id, config['tamanho_lote'])
+            if not jobs:
+                aguardar_notificacao(escuta, config['intervalo'])
+                continue
+
+            # Miniaturas primeiro: a interface as exibe enquanto a segmentação roda
+            for imagem_micro in jobs:
+                if not imagem_micro.preview:
+                    salvar_preview(imagem_micro)
+
+            try:
+                if len(jobs) == 1:
+                    processar_em_background(str(jobs[0].id))
+                else:
+                    processar_lote_em_background([imagem_micro.id for imagem_micro in jobs])
+            except Exception as e:
+                # O erro já foi registrado no job; o worker segue para o próximo
+                print(f"Worker {worker_id}: jobs {[imagem_micro.id for imagem_micro in jobs]} falharam: {str(e)}")
+    finally:
+        if escuta is not None:
+            escuta.close()
+
+    print(f"Worker {worker_id} finalizado")
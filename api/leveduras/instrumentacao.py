@@ -0,0 +1,318 @@
+import resource
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import ImagemMicroscopica
+
+_PAGINA = None
+
+
+def _rss_atual_mb():
+    """RSS atual do processo (Linux); None onde /proc não existe"""
+    global _PAGINA
+    try:
+        with open('/proc/self/statm') as statm:
+            residentes = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    if _PAGINA is None:
+        _PAGINA = resource.getpagesize()
+    return residentes * _PAGINA / 2 ** 20
+
+
+def _pico_rss_mb():
+    """Pico de RSS (VmHWM) desde a última reinicialização; None onde /proc não existe"""
+    try:
+        with open('/proc/self/status') as status_processo:
+            for linha in status_processo:
+                if linha.startswith('VmHWM:'):
+                    return int(linha.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reiniciar_pico_rss():
+    """
+    Reinicia o VmHWM no RSS atual (Linux 4.0+). O ru_maxrss não pode ser reiniciado e
+    mediria o pico de toda a vida do worker, não o do job.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+# O VmHWM é do processo: antes de cada reinicialização o pico até ali é repassado a
+# todas as medições abertas (etapas aninhadas, em outras threads ou de outros jobs do
+# lote). Sem /proc/self/clear_refs o pico é o maior RSS observado nesses instantes.
+_medicoes_abertas = weakref.WeakSet()
+_medicoes_lock = threading.Lock()
+_pico_reiniciavel = None
+
+
+class MedicaoPico:
+    __slots__ = ('pico_rss_mb', '__weakref__')
+
+
+def _observar_pico():
+    pico = _pico_rss_mb() if _pico_reiniciavel else _rss_atual_mb()
+    if pico is None:
+        return
+    for medicao in list(_medicoes_abertas):
+        medicao.pico_rss_mb = max(medicao.pico_rss_mb, pico)
+
+
+def iniciar_pico_rss():
+    """Começa a medir o pico de RSS de um trecho; encerrar_pico_rss devolve o valor"""
+    global _pico_reiniciavel
+    medicao = MedicaoPico()
+    with _medicoes_lock:
+        _observar_pico()
+        if _pico_reiniciavel is not False:
+            _pico_reiniciavel = _reiniciar_pico_rss()
+        medicao.pico_rss_mb = _rss_atual_mb() or 0.0
+        _medicoes_abertas.add(medicao)
+    return medicao
+
+
+def pico_rss_parcial(medicao):
+    """Pico de RSS da medição até agora, sem encerrá-la"""
+    with _medicoes_lock:
+        _observar_pico()
+        return medicao.pico_rss_mb
+
+
+def encerrar_pico_rss(medicao):
+    with _medicoes_lock:
+        _observar_pico()
+        _medicoes_abertas.discard(medicao)
+        return medicao.pico_rss_mb
+
+
+class Instrumentacao:
+    """
+    Tempo de parede, tempo de CPU, memória e número de leveduras de cada etapa de um
+    job. Etapas repetidas (por levedura) são acumuladas. O pico de RSS é o do job e
+    de cada etapa, não o de toda a vida do processo worker.
+
+    Etapas medidas na thread que criou a instrumentação contam o CPU do processo (que
+    inclui as threads que elas disparam); etapas medidas em outras threads (o
+    pós-processamento em paralelo) contam só o CPU da própria thread, sem somar o
+    trabalho simultâneo das demais.
+
+    Etapas por levedura passam pico_rss=False: o pico de RSS é do processo, e medi-lo
+    em cada levedura custaria duas leituras do /proc sob um lock global; o pico delas
+    aparece na etapa que as engloba.
+    """
+
+    def __init__(self):
+        self.etapas = {}
+        self.inicio = time.perf_counter()
+        self._lock = threading.Lock()
+        self._thread = threading.get_ident()
+        self._medicao_job = iniciar_pico_rss()
+
+    @contextmanager
+    def etapa(self, nome, leveduras=None, pico_rss=True):
+        relogio_cpu = time.process_time if threading.get_ident() == self._thread else time.thread_time
+        medicao = iniciar_pico_rss() if pico_rss else None
+        inicio_parede = time.perf_counter()
+        inicio_cpu = relogio_cpu()
+        try:
+            yield
+        finally:
+            tempo = time.perf_counter() - inicio_parede
+            cpu = relogio_cpu() - inicio_cpu
+            pico = encerrar_pico_rss(medicao) if medicao is not None else None
+            self.registrar(nome, tempo, cpu, leveduras, pico_rss_mb=pico)
+
+    def registrar(self, nome, tempo, cpu=None, leveduras=None, pico_rss_mb=None, **extras):
+        with self._lock:
+            registro = self.etapas.setdefault(nome, {'tempo_s': 0.0, 'cpu_s': 0.0, 'chamadas': 0})
+            registro['tempo_s'] += tempo
+            if cpu is not None:
+                registro['cpu_s'] += cpu
+            registro['chamadas'] += 1
+            if leveduras is not None:
+                registro['leveduras'] = registro.get('leveduras', 0) + leveduras
+            if pico_rss_mb is not None:
+                registro['pico_rss_mb'] = max(registro.get('pico_rss_mb', 0.0), pico_rss_mb)
+            rss = _rss_atual_mb()
+            if rss is not None:
+                registro['rss_mb'] = rss
+            registro.update(extras)
+
+    def resumo(self):
+        pico_job = pico_rss_parcial(self._medicao_job)
+        with self._lock:
+            return {
+                'etapas': {nome: dict(registro) for nome, registro in self.etapas.items()},
+                'tempo_total_s': time.perf_counter() - self.inicio,
+                'pico_rss_mb': pico_job,
+            }
+
+
+@contextmanager
+def etapa(instrumentacao, nome, leveduras=None, pico_rss=True):
+    """Mede a etapa se houver instrumentação; sem ela, não faz nada"""
+    if instrumentacao is None:
+        yield
+    else:
+        with instrumentacao.etapa(nome, leveduras, pico_rss):
+            yield
+
+
+def registrar_instrumentacao(imagem_micro, instrumentacao):
+    """Grava o resumo da instrumentação no metadata da imagem"""
+    resumo = instrumentacao.resumo()
+    metadata = dict(imagem_micro.metadata or {})
+    metadata['instrumentacao'] = resumo
+    imagem_micro.metadata = metadata
+    ImagemMicroscopica.objects.filter(id=imagem_micro.id).update(metadata=metadata)
+    print(
+        f"Instrumentação da imagem {imagem_micro.id}: "
+        + ", ".join(f"{nome} {registro['tempo_s']:.2f}s" for nome, registro in resumo['etapas'].items())
+    )
+
+
+def _jobs_recentes():
+    """
+    (iniciado_em, concluido_em, metadata) dos jobs concluídos na janela
+    LEVEDURAS_METRICAS_JANELA, no máximo LEVEDURAS_METRICAS_MAX_JOBS, mais recentes primeiro
+    """
+    janela = getattr(settings, 'LEVEDURAS_METRICAS_JANELA', 300)
+    max_jobs = getattr(settings, 'LEVEDURAS_METRICAS_MAX_JOBS', 1000)
+    concluidos = ImagemMicroscopica.objects.filter(
+        status_processamento='concluido',
+        concluido_em__gte=timezone.now() - timedelta(seconds=janela)
+    )
+    return concluidos, list(
+        concluidos.order_by('-concluido_em')
+        .values_list('iniciado_em', 'concluido_em', 'metadata')[:max_jobs]
+    )
+
+
+def estatisticas_modelos():
+    """
+    Tempos de carregamento e de inferência de cada modelo Cellpose, agregados a partir
+    do metadata['modelo'] gravado pelos workers nos jobs recentes (os processos web não
+    carregam modelos). Em lotes a inferência é dividida entre as imagens.
+    """
+    _, recentes = _jobs_recentes()
+    por_modelo = {}
+    for _, concluido_em, metadata in recentes:
+        tempos = (metadata or {}).get('modelo')
+        if not tempos:
+            # Acerto no cache de segmentação: nenhuma inferência
+            continue
+        chave = (tempos.get('model_type'), tempos.get('dispositivo'))
+        registro = por_modelo.setdefault(chave, {
+            'jobs': 0, 'jobs_com_carregamento': 0, 'tempo_carregamento_total': 0.0,
+            'tempo_inferencia_total': 0.0, 'ultimo_job_em': concluido_em,
+        })
+        registro['jobs'] += 1
+        if tempos.get('tempo_carregamento'):
+            registro['jobs_com_carregamento'] += 1
+            registro['tempo_carregamento_total'] += tempos['tempo_carregamento']
+        registro['tempo_inferencia_total'] += tempos.get('tempo_inferencia', 0.0) / tempos.get('imagens_no_lote', 1)
+
+    resultado = []
+    for (model_type, dispositivo), registro in sorted(por_modelo.items(), key=lambda item: str(item[0])):
+        carregamentos = registro['jobs_com_carregamento']
+        tempo_carregamento_medio = registro['tempo_carregamento_total'] / carregamentos if carregamentos else None
+        resultado.append({
+            'model_type': model_type,
+            'dispositivo': dispositivo,
+            'jobs': registro['jobs'],
+            'jobs_com_carregamento': carregamentos,
+            'tempo_carregamento_medio': tempo_carregamento_medio,
+            'tempo_inferencia_total': registro['tempo_inferencia_total'],
+            'tempo_inferencia_medio': registro['tempo_inferencia_total'] / registro['jobs'],
+            'ultimo_job_em': registro['ultimo_job_em'],
+            # Tempo que seria gasto recarregando o modelo a cada job
+            'tempo_economizado_estimado': (tempo_carregamento_medio or 0.0) * (registro['jobs'] - carregamentos),
+        })
+    return resultado
+
+
+# Métricas no formato de exposição de texto do Prometheus
+
+QUANTIS = (0.5, 0.95)
+
+
+def _linha(nome, valor, rotulos=None):
+    if rotulos:
+        texto_rotulos = ','.join(f'{chave}="{valor_rotulo}"' for chave, valor_rotulo in rotulos.items())
+        return f"{nome}{{{texto_rotulos}}} {valor}"
+    return f"{nome} {valor}"
+
+
+def _sumario(linhas, nome, descricao, valores_por_rotulo, rotulo):
+    linhas.append(f"# HELP {nome} {descricao}")
+    linhas.append(f"# TYPE {nome} summary")
+    for valor_rotulo, valores in sorted(valores_por_rotulo.items()):
+        valores = np.asarray(valores, dtype=np.float64)
+        rotulos = {rotulo: valor_rotulo} if rotulo else {}
+        for quantil, valor in zip(QUANTIS, np.quantile(valores, QUANTIS)):
+            linhas.append(_linha(nome, f"{valor:.6f}", {**rotulos, 'quantile': quantil}))
+        linhas.append(_linha(f"{nome}_sum", f"{valores.sum():.6f}", rotulos))
+        linhas.append(_linha(f"{nome}_count", valores.size, rotulos))
+
+
+def metricas_prometheus():
+    """
+    Métricas calculadas a partir do banco (válidas com vários processos worker):
+    profundidade da fila, jobs concluídos por segundo e quantis de latência por
+    etapa dos jobs concluídos na janela LEVEDURAS_METRICAS_JANELA
+    """
+    janela = getattr(settings, 'LEVEDURAS_METRICAS_JANELA', 300)
+    linhas = []
+
+    contagens = dict(
+        ImagemMicroscopica.objects.order_by()
+        .values_list('status_processamento')
+        .annotate(total=Count('id'))
+    )
+    linhas.append("# HELP leveduras_jobs Jobs de segmentação por status")
+    linhas.append("# TYPE leveduras_jobs gauge")
+    for status_job, _ in ImagemMicroscopica.STATUS_CHOICES:
+        linhas.append(_linha('leveduras_jobs', contagens.get(status_job, 0), {'status': status_job}))
+
+    linhas.append("# HELP leveduras_fila_profundidade Jobs aguardando um worker")
+    linhas.append("# TYPE leveduras_fila_profundidade gauge")
+    linhas.append(_linha('leveduras_fila_profundidade', contagens.get('pendente', 0)))
+
+    # Os quantis usam no máximo os LEVEDURAS_METRICAS_MAX_JOBS jobs mais recentes da janela
+    concluidos, recentes = _jobs_recentes()
+    linhas.append(f"# HELP leveduras_jobs_por_segundo Jobs concluídos por segundo nos últimos {janela}s")
+    linhas.append("# TYPE leveduras_jobs_por_segundo gauge")
+    linhas.append(_linha('leveduras_jobs_por_segundo', f"{concluidos.count() / janela:.6f}"))
+
+    duracoes = [
+        (concluido_em - iniciado_em).total_seconds()
+        for iniciado_em, concluido_em, _ in recentes if iniciado_em and concluido_em
+    ]
+    if duracoes:
+        _sumario(linhas, 'leveduras_job_segundos', 'Duração dos jobs concluídos', {'': duracoes}, None)
+
+    tempos_etapas = {}
+    for _, _, metadata in recentes:
+        etapas = ((metadata or {}).get('instrumentacao') or {}).get('etapas', {})
+        for nome, registro in etapas.items():
+            tempos_etapas.setdefault(nome, []).append(registro['tempo_s'])
+    if tempos_etapas:
+        _sumario(linhas, 'leveduras_etapa_segundos', 'Tempo de parede de cada etapa do pipeline',
+                 tempos_etapas, 'etapa')
+
+    return '\n'.join(linhas) + '\n'
@@ -0,0 +1,81 @@
+import json
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from leveduras.benchmark import ETAPAS, executar_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Mede cada etapa do pipeline de segmentação sobre campos sintéticos e grava os '
+        'resultados em JSON. Use --settings=levedura_analysis.settings_benchmark (SQLite temporário).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--altura', type=int, default=2048)
+        parser.add_argument('--largura', type=int, default=2048)
+        parser.add_argument('--densidade', type=float, default=100, help='Células por megapixel')
+        parser.add_argument('--imagens', type=int, default=3, help='Campos sintéticos processados')
+        parser.add_argument('--semente', type=int, default=0)
+        parser.add_argument('--modelo', choices=['stub', 'cellpose'], default='stub',
+                            help="'stub' (limiarização, sem rede) ou o modelo Cellpose real na CPU")
+        parser.add_argument('--etapas', default=','.join(ETAPAS), help='Etapas separadas por vírgulas')
+        parser.add_argument('--diametro', type=float,
+                            help='Diâmetro esperado das células em µm: infere em resolução reduzida e '
+                                 'compara com a resolução completa')
+        parser.add_argument('--diametro-alvo', type=float,
+                            help='Diâmetro em pixels após a redução (padrão: LEVEDURAS_DIAMETRO_ALVO_PIXELS)')
+        parser.add_argument('--memoria', action='store_true',
+                            help='Mede o pico de memória de cada etapa com tracemalloc; os tempos dessa '
+                                 'execução incluem o custo do rastreamento')
+        parser.add_argument('--saida', default='benchmark_pipeline.json', help='Arquivo JSON de resultados')
+
+    def handle(self, *args, **options):
+        etapas = [etapa.strip() for etapa in options['etapas'].split(',') if etapa.strip()]
+        invalidas = [etapa for etapa in etapas if etapa not in ETAPAS]
+        if invalidas:
+            raise CommandError(f"Etapas inválidas: {', '.join(invalidas)} (disponíveis: {', '.join(ETAPAS)})")
+
+        if 'persistencia' in etapas:
+            if connection.vendor != 'sqlite':
+                raise CommandError(
+                    'A etapa de persistência só roda contra SQLite; use '
+                    '--settings=levedura_analysis.settings_benchmark ou remova-a de --etapas'
+                )
+            call_command('migrate', run_syncdb=True, verbosity=0)
+
+        resultado = executar_benchmark(
+            altura=options['altura'],
+            largura=options['largura'],
+            densidade=options['densidade'],
+            imagens=options['imagens'],
+            semente=options['semente'],
+            modelo=options['modelo'],
+            etapas=etapas,
+            diametro_microns=options['diametro'],
+            diametro_alvo=options['diametro_alvo'],
+            memoria=options['memoria'],
+        )
+
+        with open(options['saida'], 'w') as arquivo:
+            json.dump(resultado, arquivo, indent=2)
+
+        self.stdout.write(f"{resultado['leveduras_segmentadas']} leveduras em {options['imagens']} imagem(ns)")
+        for etapa, medicao in resultado['etapas'].items():
+            leveduras_por_s = medicao['leveduras_por_s']
+            pico = medicao['pico_memoria_mb']
+            self.stdout.write(
+                f"{etapa:<28} {medicao['tempo_por_imagem_s'] * 1000:9.1f} ms/imagem"
+                f"{'' if leveduras_por_s is None else f'  {leveduras_por_s:10.0f} leveduras/s'}"
+                f"{'' if pico is None else f'  pico {pico:8.1f} MB'}"
+            )
+        if 'escala' in resultado:
+            escala = resultado['escala']
+            self.stdout.write(
+                f"Resolução reduzida (fator {escala['fator']:.3f}): diferença média de "
+                f"{escala['diferenca_contagem']:+.1f} leveduras por imagem, IoU do primeiro plano "
+                f"{escala['iou_primeiro_plano']:.3f}, IoU médio por célula {escala['iou_medio_celulas'] or 0:.3f}"
+            )
+        self.stdout.write(f"Pico de RSS: {resultado['pico_rss_mb']:.1f} MB; resultados em {options['saida']}")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from leveduras.decodificacao import salvar_preview
+from leveduras.models import ImagemMicroscopica
+
+
+class Command(BaseCommand):
+    help = 'Gera a miniatura das imagens microscópicas enviadas antes do preview existir'
+
+    def handle(self, *args, **options):
+        total = 0
+        for imagem_micro in ImagemMicroscopica.objects.filter(preview__isnull=True).exclude(imagem='').iterator():
+            salvar_preview(imagem_micro)
+            total += 1
+        self.stdout.write(f"{total} imagem(ns) processada(s)")
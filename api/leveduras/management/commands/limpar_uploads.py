@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from leveduras.uploads import remover_uploads_abandonados
+
+
+class Command(BaseCommand):
+    help = 'Remove uploads fragmentados não concluídos e seus arquivos parciais'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horas', type=float, default=24, help='Horas sem receber fragmentos')
+
+    def handle(self, *args, **options):
+        total = remover_uploads_abandonados(options['horas'])
+        self.stdout.write(f"{total} upload(s) removido(s)")
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from leveduras.caracteristicas import COLUNAS_CARACTERISTICAS, colunas_caracteristicas
+from leveduras.models import LeveduraSegmentada
+
+
+class Command(BaseCommand):
+    help = 'Preenche as colunas de características de leveduras gravadas antes delas existirem, a partir do JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=1000, help='Leveduras atualizadas por bulk_update')
+
+    def handle(self, *args, **options):
+        tamanho_lote = options['lote']
+        colunas = list(COLUNAS_CARACTERISTICAS)
+        pendentes = (
+            LeveduraSegmentada.objects
+            .filter(perimetro_microns__isnull=True)
+            .exclude(caracteristicas={})
+            .only('id', 'caracteristicas')
+        )
+
+        lote = []
+        total = 0
+        for levedura in pendentes.iterator(chunk_size=tamanho_lote):
+            for coluna, valor in colunas_caracteristicas(levedura.caracteristicas).items():
+                setattr(levedura, coluna, valor)
+            lote.append(levedura)
+            if len(lote) >= tamanho_lote:
+                LeveduraSegmentada.objects.bulk_update(lote, colunas)
+                total += len(lote)
+                lote = []
+        if lote:
+            LeveduraSegmentada.objects.bulk_update(lote, colunas)
+            total += len(lote)
+
+        self.stdout.write(f"{total} levedura(s) atualizada(s)")
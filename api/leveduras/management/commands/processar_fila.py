@@ -0,0 +1,71 @@
+import multiprocessing
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from leveduras.fila import configuracao_fila, executar_worker, recuperar_jobs_orfaos
+
+
+def _iniciar_worker(parar):
+    # Cada processo abre as próprias conexões com o banco
+    connections.close_all()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    executar_worker(parar)
+
+
+class Command(BaseCommand):
+    help = 'Inicia o pool de workers que processa a fila de segmentação de imagens microscópicas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='Número de processos worker')
+
+    def handle(self, *args, **options):
+        config = configuracao_fila()
+        total_workers = options['workers'] or config['workers']
+
+        recuperados = recuperar_jobs_orfaos()
+        self.stdout.write(f"{recuperados} job(s) interrompido(s) devolvido(s) para a fila")
+
+        connections.close_all()
+        parar = multiprocessing.Event()
+        workers = []
+        for _ in range(total_workers):
+            processo = multiprocessing.Process(target=_iniciar_worker, args=(parar,))
+            processo.start()
+            workers.append(processo)
+        self.stdout.write(f"{total_workers} worker(s) em execução")
+        if config['notificacao'] and total_workers > config['workers']:
+            self.stdout.write(
+                f"Apenas {config['workers']} worker(s) recebem notificações (LEVEDURAS_FILA_WORKERS); "
+                f"os demais dependem da consulta periódica"
+            )
+
+        ultima_recuperacao = time.monotonic()
+        try:
+            while True:
+                time.sleep(config['intervalo'])
+                # Aplica o timeout e recupera jobs de workers mortos em qualquer máquina,
+                # não só quando um worker deste supervisor morre
+                if time.monotonic() - ultima_recuperacao >= config['intervalo_recuperacao']:
+                    recuperados = recuperar_jobs_orfaos()
+                    if recuperados:
+                        self.stdout.write(f"{recuperados} job(s) abandonado(s) devolvido(s) para a fila")
+                    connections.close_all()
+                    ultima_recuperacao = time.monotonic()
+
+                # Substitui workers que morreram e libera os jobs que eles seguravam
+                for i, processo in enumerate(workers):
+                    if not processo.is_alive():
+                        self.stdout.write(f"Worker {processo.pid} morreu; reiniciando")
+                        recuperar_jobs_orfaos()
+                        ultima_recuperacao = time.monotonic()
+                        connections.close_all()
+                        workers[i] = multiprocessing.Process(target=_iniciar_worker, args=(parar,))
+                        workers[i].start()
+        except KeyboardInterrupt:
+            self.stdout.write("Encerrando workers...")
+            parar.set()
+            for processo in workers:
+                processo.join()
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from leveduras.models import ImagemMicroscopica
+from leveduras.views import recalcular_caracteristicas
+
+
+class Command(BaseCommand):
+    help = (
+        'Recalcula as características das leveduras a partir da máscara gravada de cada imagem, '
+        'sem rodar o Cellpose de novo'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('imagens', nargs='*', type=int, help='IDs das imagens (padrão: todas com máscara)')
+
+    def handle(self, *args, **options):
+        imagens = ImagemMicroscopica.objects.filter(status_processamento='concluido').exclude(mascara='')
+        imagens = imagens.exclude(mascara__isnull=True)
+        if options['imagens']:
+            imagens = imagens.filter(id__in=options['imagens'])
+
+        total_imagens = total_leveduras = 0
+        for imagem_micro in imagens.iterator():
+            try:
+                atualizadas = recalcular_caracteristicas(imagem_micro)
+            except Exception as e:
+                self.stderr.write(f"Imagem {imagem_micro.id}: {str(e)}")
+                continue
+            total_imagens += 1
+            total_leveduras += atualizadas
+            self.stdout.write(f"Imagem {imagem_micro.id}: {atualizadas} levedura(s)")
+        self.stdout.write(f"{total_leveduras} levedura(s) atualizada(s) em {total_imagens} imagem(ns)")
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import resource
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+
+async def requisitar(host, porta, caminho, cabecalhos, timeout):
+    """GET HTTP/1.1 mínimo sobre asyncio; retorna o código de status"""
+    leitor, escritor = await asyncio.wait_for(asyncio.open_connection(host, porta), timeout)
+    try:
+        linhas = [f"GET {caminho} HTTP/1.1", f"Host: {host}:{porta}", "Connection: close"] + cabecalhos
+        escritor.write(("\r\n".join(linhas) + "\r\n\r\n").encode())
+        await escritor.drain()
+        linha_status = await asyncio.wait_for(leitor.readline(), timeout)
+        if not linha_status:
+            raise ConnectionError("Conexão fechada sem resposta")
+        # Consome o restante da resposta até o servidor fechar a conexão
+        while await asyncio.wait_for(leitor.read(65536), timeout):
+            pass
+        return int(linha_status.split()[1])
+    finally:
+        escritor.close()
+
+
+async def executar_carga(url, caminho, clientes, requisicoes, cabecalhos, timeout):
+    """'clientes' conexões simultâneas, cada uma fazendo 'requisicoes' GETs em sequência"""
+    partes = urlsplit(url)
+    host, porta = partes.hostname, partes.port or 80
+    latencias = []
+    codigos = Counter()
+    erros = Counter()
+
+    async def cliente():
+        for _ in range(requisicoes):
+            inicio = time.perf_counter()
+            try:
+                codigo = await requisitar(host, porta, caminho, cabecalhos, timeout)
+            except Exception as e:
+                erros[type(e).__name__] += 1
+                continue
+            latencias.append(time.perf_counter() - inicio)
+            codigos[codigo] += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(cliente() for _ in range(clientes)))
+    duracao = time.perf_counter() - inicio
+
+    resultado = {
+        'caminho': caminho,
+        'clientes': clientes,
+        'requisicoes': clientes * requisicoes,
+        'respostas': len(latencias),
+        'erros': dict(erros),
+        'codigos': {str(codigo): total for codigo, total in sorted(codigos.items())},
+        'duracao_s': duracao,
+        'requisicoes_por_s': len(latencias) / duracao if duracao > 0 else None,
+    }
+    if latencias:
+        p50, p95, p99 = np.percentile(latencias, [50, 95, 99])
+        resultado['latencia_s'] = {'p50': p50, 'p95': p95, 'p99': p99, 'max': max(latencias)}
+    return resultado
+
+
+class Command(BaseCommand):
+    help = (
+        'Teste de carga com muitos clientes simultâneos contra uma API em execução, para comparar '
+        'as views síncronas e as assíncronas (/api/async/) servidas por WSGI ou ASGI'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('caminhos', nargs='+',
+                            help='Caminhos testados em sequência, ex.: /api/async/analises/1/progresso/?aguardar=5')
+        parser.add_argument('--url', default='http://127.0.0.1:8000', help='Endereço do servidor')
+        parser.add_argument('--clientes', type=int, default=1000, help='Conexões simultâneas')
+        parser.add_argument('--requisicoes', type=int, default=1, help='Requisições por cliente')
+        parser.add_argument('--cabecalho', action='append', default=[],
+                            help='Cabeçalho extra, ex.: \'If-None-Match: "pendente-0"\' para o long-poll esperar')
+        parser.add_argument('--timeout', type=float, default=120, help='Timeout de cada requisição (s)')
+        parser.add_argument('--saida', help='Arquivo JSON com os resultados')
+
+    def handle(self, *args, **options):
+        if urlsplit(options['url']).scheme != 'http':
+            raise CommandError("Apenas URLs http:// são suportadas")
+
+        # Cada cliente simultâneo usa um descritor de arquivo
+        flexivel, rigido = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if flexivel < rigido:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (rigido, rigido))
+
+        resultados = []
+        for caminho in options['caminhos']:
+            resultado = asyncio.run(executar_carga(
+                options['url'], caminho, options['clientes'], options['requisicoes'],
+                options['cabecalho'], options['timeout']
+            ))
+            resultados.append(resultado)
+
+            latencia = resultado.get('latencia_s', {})
+            self.stdout.write(
+                f"{caminho}: {resultado['respostas']}/{resultado['requisicoes']} respostas em "
+                f"{resultado['duracao_s']:.2f}s ({resultado['requisicoes_por_s'] or 0:.1f} req/s), "
+                f"p50 {latencia.get('p50', 0):.3f}s, p99 {latencia.get('p99', 0):.3f}s, "
+                f"códigos {resultado['codigos']}, erros {resultado['erros']}"
+            )
+
+        if options['saida']:
+            with open(options['saida'], 'w') as arquivo:
+                json.dump(resultados, arquivo, indent=2)
@@ -0,0 +1,237 @@
+import hashlib
+import math
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files import File
+
+from .blocos import abrir_imagem_sob_demanda
+from .decodificacao import decodificar_imagem
+from .models import CacheSegmentacao, ImagemMicroscopica
+from .regioes import lotes_de_linhas
+
+# Nome do array dentro do npz (np.load(...)['masks'], como no cache de segmentação)
+MEMBRO_MASCARA = 'masks.npy'
+
+TAMANHO_LEITURA = 1024 * 1024
+
+# Cores (RGB) do overlay
+COR_CONTORNO = (255, 255, 0)
+COR_DESTAQUE = (255, 0, 0)
+
+
+def configuracao_mascaras():
+    return {
+        'ativo': getattr(settings, 'LEVEDURAS_MASCARAS_ATIVO', True),
+        'diretorio_cache': getattr(settings, 'LEVEDURAS_MASCARAS_CACHE_DIRETORIO', None),
+        'cache_max_mb': getattr(settings, 'LEVEDURAS_MASCARAS_CACHE_MAX_MB', 4096),
+        'overlay_lado': getattr(settings, 'LEVEDURAS_OVERLAY_LADO', 2048),
+        'overlay_lado_maximo': getattr(settings, 'LEVEDURAS_OVERLAY_LADO_MAXIMO', 2048),
+    }
+
+
+def dtype_mascara(masks):
+    """uint16 quando os rótulos cabem, como no cache de segmentação"""
+    return np.uint16 if int(masks.max()) < np.iinfo(np.uint16).max else np.uint32
+
+
+def escrever_npz(arquivo, masks):
+    """
+    Grava a máscara como um npz comprimido (legível por np.load) em faixas de linhas,
+    sem converter o array inteiro de uma vez: a máscara pode estar mapeada em disco
+    """
+    dtype = dtype_mascara(masks)
+    with zipfile.ZipFile(arquivo, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as npz:
+        with npz.open(MEMBRO_MASCARA, 'w', force_zip64=True) as membro:
+            np.lib.format.write_array_header_1_0(membro, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                'fortran_order': False,
+                'shape': tuple(masks.shape),
+            })
+            for _, faixa in lotes_de_linhas(masks):
+                membro.write(np.ascontiguousarray(faixa, dtype=dtype).tobytes())
+
+
+def salvar_mascara(imagem_micro, masks):
+    """
+    Grava a máscara de rótulos completa da imagem no campo 'mascara' (sem salvar o
+    modelo; persistir_leveduras_segmentadas grava a imagem junto com as leveduras)
+    """
+    with tempfile.TemporaryFile() as arquivo:
+        escrever_npz(arquivo, masks)
+        arquivo.seek(0)
+        imagem_micro.mascara.save(f"mascara_{imagem_micro.id}.npz", File(arquivo), save=False)
+
+
+def mascara_referenciada(nome, exceto_imagem=None, exceto_cache=None):
+    """
+    Indica se o arquivo de máscara é usado por alguma imagem ou entrada do cache de
+    segmentação: o cache referencia a máscara da imagem que o originou, e imagens que
+    acertam o cache referenciam a mesma máscara, sem cópias
+    """
+    imagens = ImagemMicroscopica.objects.filter(mascara=nome)
+    if exceto_imagem is not None:
+        imagens = imagens.exclude(id=exceto_imagem)
+    entradas = CacheSegmentacao.objects.filter(mascara=nome)
+    if exceto_cache is not None:
+        entradas = entradas.exclude(id=exceto_cache)
+    return imagens.exists() or entradas.exists()
+
+
+def remover_mascara(imagem_micro):
+    """Desfaz a máscara da imagem; o arquivo só é apagado se ninguém mais o referenciar"""
+    nome = imagem_micro.mascara.name
+    if nome:
+        if not mascara_referenciada(nome, exceto_imagem=imagem_micro.id):
+            imagem_micro.mascara.storage.delete(nome)
+        imagem_micro.mascara = None
+
+
+def url_mascara(imagem_micro):
+    return imagem_micro.mascara.url if imagem_micro.mascara else None
+
+
+def diretorio_cache_mascaras():
+    diretorio = configuracao_mascaras()['diretorio_cache']
+    return diretorio or os.path.join(tempfile.gettempdir(), 'leveduras_mascaras')
+
+
+def _identidade_mascara(arquivo):
+    """
+    Nome, tamanho e data de modificação do arquivo no storage: o nome sozinho se
+    repete quando uma máscara apagada é regravada (mascara_<id>.npz no reprocessamento),
+    e o cache local devolveria a máscara antiga
+    """
+    storage = arquivo.storage
+    try:
+        modificado = storage.get_modified_time(arquivo.name).timestamp()
+    except (NotImplementedError, OSError):
+        modificado = ''
+    return f"{arquivo.name}:{storage.size(arquivo.name)}:{modificado}"
+
+
+def carregar_mascara(imagem_micro):
+    """
+    Máscara de rótulos da imagem mapeada em memória (somente leitura), ou None se
+    a imagem não tiver máscara gravada.
+
+    O npz comprimido não pode ser mapeado: na primeira leitura o .npy é descomprimido
+    em stream para um cache local (LEVEDURAS_MASCARAS_CACHE_DIRETORIO), e as leituras
+    seguintes só mapeiam o arquivo.
+    """
+    if not imagem_micro.mascara:
+        return None
+
+    diretorio = diretorio_cache_mascaras()
+    nome = hashlib.sha256(_identidade_mascara(imagem_micro.mascara).encode()).hexdigest()[:32]
+    caminho = os.path.join(diretorio, f"{nome}.npy")
+
+    if os.path.exists(caminho):
+        os.utime(caminho)
+    else:
+        os.makedirs(diretorio, exist_ok=True)
+        temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with imagem_micro.mascara.open('rb') as origem, zipfile.ZipFile(origem) as npz, \
+                    npz.open(MEMBRO_MASCARA) as membro, open(temporario, 'wb') as destino:
+                shutil.copyfileobj(membro, destino, TAMANHO_LEITURA)
+            os.replace(temporario, caminho)
+        finally:
+            if os.path.exists(temporario):
+                os.remove(temporario)
+        despejar_cache_mascaras(manter=caminho)
+
+    return np.load(caminho, mmap_mode='r')
+
+
+def despejar_cache_mascaras(manter=None):
+    """Remove as máscaras descomprimidas usadas há mais tempo até o cache caber em LEVEDURAS_MASCARAS_CACHE_MAX_MB"""
+    diretorio = diretorio_cache_mascaras()
+    limite = configuracao_mascaras()['cache_max_mb'] * 1024 * 1024
+    arquivos = []
+    for nome in os.listdir(diretorio):
+        if not nome.endswith('.npy'):
+            continue
+        caminho = os.path.join(diretorio, nome)
+        try:
+            info = os.stat(caminho)
+        except FileNotFoundError:
+            continue
+        arquivos.append((info.st_mtime, info.st_size, caminho))
+
+    total = sum(tamanho for _, tamanho, _ in arquivos)
+    removidos = 0
+    for _, tamanho, caminho in sorted(arquivos):
+        if total <= limite:
+            break
+        if caminho == manter:
+            continue
+        try:
+            # Processos que já mapearam o arquivo continuam lendo o inode removido
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+        total -= tamanho
+        removidos += 1
+    return removidos
+
+
+def _imagem_8bits_rgb(img):
+    if img.ndim == 3:
+        img = img[..., :3] if img.shape[2] >= 3 else img[..., 0]
+    # Cópia: a imagem pode ser um mapeamento somente leitura, e o overlay é desenhado nela
+    img = np.array(img)
+    if img.dtype != np.uint8:
+        img = cv2.normalize(img.astype(np.float32), None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+    return img
+
+
+def gerar_overlay(imagem_micro, lado=None, levedura_id=None):
+    """
+    PNG com os contornos da máscara gravada desenhados sobre a imagem original,
+    com o maior lado reduzido a 'lado' por amostragem com passo (a máscara e as
+    imagens mapeadas não são lidas por inteiro), limitado a LEVEDURAS_OVERLAY_LADO_MAXIMO.
+    'levedura_id' destaca uma levedura. Retorna None se a imagem não tiver máscara.
+    """
+    masks = carregar_mascara(imagem_micro)
+    if masks is None:
+        return None
+
+    config = configuracao_mascaras()
+    lado = min(lado or config['overlay_lado'], config['overlay_lado_maximo'])
+    passo = max(1, math.ceil(max(masks.shape) / lado))
+    rotulos = np.ascontiguousarray(masks[::passo, ::passo])
+
+    img = abrir_imagem_sob_demanda(imagem_micro.imagem.path)
+    if img is None:
+        img = decodificar_imagem(imagem_micro.imagem.path)
+    img = _imagem_8bits_rgb(img[::passo, ::passo])
+
+    # Borda: pixel rotulado com algum vizinho (4-conectado) de rótulo diferente
+    borda = np.zeros(rotulos.shape, dtype=bool)
+    diferentes = rotulos[:, 1:] != rotulos[:, :-1]
+    borda[:, 1:] |= diferentes
+    borda[:, :-1] |= diferentes
+    diferentes = rotulos[1:, :] != rotulos[:-1, :]
+    borda[1:, :] |= diferentes
+    borda[:-1, :] |= diferentes
+    borda &= rotulos > 0
+
+    img[borda] = COR_CONTORNO
+    if levedura_id is not None:
+        selecionada = rotulos == levedura_id
+        img[selecionada] = (0.6 * img[selecionada] + 0.4 * np.array(COR_DESTAQUE)).astype(np.uint8)
+        img[selecionada & borda] = COR_DESTAQUE
+
+    sucesso, png = cv2.imencode('.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+    if not sucesso:
+        raise ValueError("Erro ao codificar o overlay")
+    return png.tobytes()
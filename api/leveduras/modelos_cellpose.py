@@ -0,0 +1,112 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Registro de modelos Cellpose por processo: cada combinação (model_type, dispositivo)
+# é carregada uma única vez e compartilhada entre os jobs do mesmo processo. Só os
+# workers da fila carregam modelos; os tempos de cada job ficam em metadata['modelo'].
+_registro = {}
+_registro_lock = threading.Lock()
+_dispositivo = None
+
+
+def _usar_gpu():
+    return getattr(settings, 'LEVEDURAS_CELLPOSE_GPU', True)
+
+
+def resolver_dispositivo(gpu=None):
+    """
+    Resolve o dispositivo de inferência ('gpu' ou 'cpu'), sondando a GPU apenas uma vez por processo
+    """
+    global _dispositivo
+    if gpu is None:
+        gpu = _usar_gpu()
+    if not gpu:
+        return 'cpu'
+
+    with _registro_lock:
+        if _dispositivo is None:
+            from cellpose import core
+            _dispositivo = 'gpu' if core.use_gpu() else 'cpu'
+            print(f"Dispositivo Cellpose resolvido: {_dispositivo}")
+    return _dispositivo
+
+
+def _obter_entrada(model_type, dispositivo):
+    chave = (model_type, dispositivo)
+
+    with _registro_lock:
+        entrada = _registro.get(chave)
+        if entrada is None:
+            entrada = {
+                'modelo': None,
+                'lock': threading.Lock(),
+                'carregamento_lock': threading.Lock(),
+                'tempo_carregamento': 0.0,
+            }
+            _registro[chave] = entrada
+
+    # Carrega fora do lock global para não bloquear outras combinações
+    with entrada['carregamento_lock']:
+        if entrada['modelo'] is None:
+            from cellpose import models
+
+            inicio = time.perf_counter()
+            entrada['modelo'] = models.CellposeModel(gpu=(dispositivo == 'gpu'), model_type=model_type)
+            entrada['tempo_carregamento'] = time.perf_counter() - inicio
+            print(f"Modelo Cellpose '{model_type}' carregado em {dispositivo} "
+                  f"({entrada['tempo_carregamento']:.2f}s)")
+    return entrada
+
+
+def obter_modelo(model_type='cyto', gpu=None):
+    """
+    Retorna o modelo Cellpose compartilhado do processo, carregando-o na primeira chamada
+    """
+    dispositivo = resolver_dispositivo(gpu)
+    return _obter_entrada(model_type, dispositivo)['modelo']
+
+
+@contextmanager
+def usar_modelo(model_type='cyto', gpu=None):
+    """
+    Empresta o modelo compartilhado com acesso exclusivo durante a inferência.
+
+    O dicionário de tempos produzido recebe 'tempo_carregamento' (zero quando o
+    modelo já estava em memória) e 'tempo_inferencia' ao final do bloco.
+    """
+    dispositivo = resolver_dispositivo(gpu)
+    ja_carregado = (model_type, dispositivo) in _registro and _registro[(model_type, dispositivo)]['modelo'] is not None
+
+    inicio = time.perf_counter()
+    entrada = _obter_entrada(model_type, dispositivo)
+    tempos = {
+        'model_type': model_type,
+        'dispositivo': dispositivo,
+        'tempo_carregamento': 0.0 if ja_carregado else time.perf_counter() - inicio,
+        'tempo_inferencia': 0.0,
+    }
+
+    with entrada['lock']:
+        inicio = time.perf_counter()
+        try:
+            yield entrada['modelo'], tempos
+        finally:
+            tempos['tempo_inferencia'] = time.perf_counter() - inicio
+
+
+def aquecer_modelos(model_types=None, gpu=None):
+    """
+    Pré-carrega os modelos configurados para que o primeiro job não pague o carregamento
+    """
+    if model_types is None:
+        model_types = getattr(settings, 'LEVEDURAS_CELLPOSE_MODELOS_AQUECER', ['cyto'])
+
+    for model_type in model_types:
+        try:
+            obter_modelo(model_type, gpu)
+        except Exception as e:
+            print(f"Erro ao aquecer modelo '{model_type}': {str(e)}")
+
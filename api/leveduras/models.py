@@ -44,6 +44,33 @@ class ImagemMicroscopica(models.Model):
     task_id = models.CharField(max_length=255, blank=True, null=True)
     iniciado_em = models.DateTimeField(null=True, blank=True)
     concluido_em = models.DateTimeField(null=True, blank=True)
+    pacote_recortes = models.FileField(
+        upload_to='leveduras/pacotes/%Y/%m/%d/',
+        max_length=500,
+        null=True,
+        blank=True,
+        help_text="ZIP com os recortes de todas as leveduras (armazenamento em pacote)"
+    )
+    resumo = models.JSONField(null=True, blank=True, help_text="Estatísticas gerais gravadas na conclusão do processamento")
+    preview = models.ImageField(
+        upload_to='leveduras/previews/%Y/%m/%d/',
+        max_length=500,
+        null=True,
+        blank=True,
+        help_text="Miniatura JPEG gerada pelo worker ao reivindicar o job, para exibição na interface"
+    )
+    mascara = models.FileField(
+        upload_to='leveduras/mascaras/%Y/%m/%d/',
+        max_length=500,
+        null=True,
+        blank=True,
+        help_text="Máscara de rótulos completa do Cellpose (npz comprimido), para reanálise sem nova inferência"
+    )
+    atualizado_em = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Última alteração das leveduras depois da conclusão (ex.: recalcular_caracteristicas)"
+    )
     def __str__(self):
         return f"Microscópica - {self.analise.nome_amostra}"
 
@@ -57,6 +84,45 @@ class ImagemColonia(models.Model):
         return f"Colônia - {self.analise.nome_amostra}"
     
 
+class UploadFragmentado(models.Model):
+    """
+    Upload retomável: o arquivo chega em fragmentos (PUT com Content-Range) gravados
+    direto num arquivo parcial no storage, que vira a imagem quando o último chega
+    """
+    TIPO_CHOICES = [
+        ('microscopica', 'Microscópica'),
+        ('colonia', 'Colônia'),
+    ]
+    STATUS_CHOICES = [
+        ('recebendo', 'Recebendo'),
+        ('concluido', 'Concluído'),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    analise = models.ForeignKey(AnaliseLevedura, on_delete=models.CASCADE, related_name='uploads_fragmentados')
+    tipo = models.CharField(max_length=20, choices=TIPO_CHOICES, default='microscopica')
+    nome_arquivo = models.CharField(max_length=255)
+    tipo_conteudo = models.CharField(max_length=100)
+    tamanho = models.BigIntegerField(help_text="Tamanho total do arquivo, em bytes")
+    recebido = models.BigIntegerField(default=0, help_text="Bytes já gravados (offset do próximo fragmento)")
+    arquivo_parcial = models.CharField(max_length=500, help_text="Nome do arquivo parcial no storage")
+    fragmentos = models.JSONField(default=list, blank=True, help_text="Início, fim e SHA-256 de cada fragmento recebido")
+    reserva = models.CharField(max_length=32, blank=True, help_text="Fragmento sendo gravado no arquivo parcial")
+    reservado_em = models.DateTimeField(null=True, blank=True)
+    modo_caracteristicas = models.CharField(max_length=20, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='recebendo')
+    imagem_microscopica = models.ForeignKey(
+        ImagemMicroscopica, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    imagem_colonia = models.ForeignKey(
+        ImagemColonia, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    criado_em = models.DateTimeField(default=timezone.now)
+    atualizado_em = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Upload {self.nome_arquivo} - {self.recebido}/{self.tamanho}"
+
+
 class LeveduraSegmentada(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     analise = models.ForeignKey('AnaliseLevedura', on_delete=models.CASCADE, related_name='leveduras_segmentadas')
@@ -64,12 +130,16 @@ class LeveduraSegmentada(models.Model):
     levedura_id = models.IntegerField(help_text="ID da levedura na segmentação")
     imagem = models.ImageField(
         upload_to='leveduras_segmentadas/%Y/%m/%d/',
-        max_length=500
+        max_length=500,
+        blank=True  # vazio quando o recorte está no pacote da imagem original
     )
     nome_arquivo = models.CharField(max_length=255)
+    pacote_offset = models.BigIntegerField(null=True, blank=True, help_text="Offset do recorte no pacote da imagem")
+    pacote_tamanho = models.IntegerField(null=True, blank=True, help_text="Tamanho do recorte no pacote, em bytes")
     bounding_box = models.JSONField(help_text="Coordenadas da bounding box {x, y, width, height}")
     metadata = models.JSONField(default=dict)
     criado_em = models.DateTimeField(auto_now_add=True)
+    atualizado_em = models.DateTimeField(auto_now=True)
     caracteristicas = models.JSONField(default=dict, blank=True)
     diametro_equivalente = models.FloatField(null=True, blank=True)  # em micrômetros
     circularidade = models.FloatField(null=True, blank=True)
@@ -77,10 +147,37 @@ class LeveduraSegmentada(models.Model):
     relacao_aspecto = models.FloatField(null=True, blank=True)
     area_pixels = models.FloatField(null=True, blank=True)
     area_microns = models.FloatField(null=True, blank=True)
+    perimetro_microns = models.FloatField(null=True, blank=True)
+    eixo_maior_microns = models.FloatField(null=True, blank=True)
+    eixo_menor_microns = models.FloatField(null=True, blank=True)
+    angulacao_graus = models.FloatField(null=True, blank=True)
+    centroide_x = models.IntegerField(null=True, blank=True)  # em pixels, na imagem original
+    centroide_y = models.IntegerField(null=True, blank=True)
 
     class Meta:
         db_table = 'leveduras_segmentadas'
-        ordering = ['levedura_id']
+        # Sem ordering padrão: as consultas que precisam de ordem usam order_by explícito
+        indexes = [
+            models.Index(fields=['imagem_original', 'levedura_id'], name='levedura_imagem_id_idx'),
+            models.Index(fields=['analise', 'area_microns'], name='levedura_analise_area_idx'),
+            models.Index(fields=['analise', 'circularidade'], name='levedura_analise_circ_idx'),
+            models.Index(fields=['analise', 'relacao_aspecto'], name='levedura_analise_aspecto_idx'),
+        ]
     
     def __str__(self):
-        return f"Levedura {self.levedura_id} - {self.analise}"
\ No newline at end of file
+        return f"Levedura {self.levedura_id} - {self.analise}"
+
+
+class CacheSegmentacao(models.Model):
+    chave = models.CharField(max_length=64, unique=True, help_text="SHA-256 do conteúdo da imagem e dos parâmetros")
+    hash_imagem = models.CharField(max_length=64, db_index=True)
+    parametros = models.JSONField(default=dict)
+    mascara = models.FileField(upload_to='leveduras/cache/%Y/%m/%d/', max_length=500)
+    caracteristicas = models.JSONField(default=dict, blank=True, help_text="Características por levedura_id")
+    tamanho_bytes = models.BigIntegerField(default=0)
+    acertos = models.IntegerField(default=0)
+    criado_em = models.DateTimeField(default=timezone.now)
+    ultimo_acesso = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Cache {self.chave[:12]} - {self.acertos} acertos"
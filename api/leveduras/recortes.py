@@ -0,0 +1,204 @@
+import io
+import mimetypes
+import struct
+import tempfile
+import threading
+import zipfile
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+FORMATOS_RECORTE = {
+    'png': ('.png', 'PNG'),
+    'webp': ('.webp', 'WEBP'),
+    'jpeg': ('.jpg', 'JPEG'),
+}
+
+MODOS_ARMAZENAMENTO = ('arquivos', 'pacote')
+
+# Tamanho do cabeçalho local de um membro ZIP, antes do nome e do campo extra
+_TAMANHO_CABECALHO_ZIP = 30
+
+
+def armazenamento_recortes():
+    """
+    'arquivos' grava um arquivo por levedura; 'pacote' grava um único ZIP por imagem
+    """
+    modo = getattr(settings, 'LEVEDURAS_ARMAZENAMENTO_RECORTES', 'arquivos')
+    if modo not in MODOS_ARMAZENAMENTO:
+        raise ValueError(f"Modo de armazenamento de recortes inválido: {modo}")
+    return modo
+
+
+def configuracao_recorte():
+    formato = getattr(settings, 'LEVEDURAS_RECORTE_FORMATO', 'png')
+    if formato not in FORMATOS_RECORTE:
+        raise ValueError(f"Formato de recorte inválido: {formato}")
+    return {
+        'formato': formato,
+        'compressao_png': getattr(settings, 'LEVEDURAS_RECORTE_PNG_COMPRESSAO', 3),
+        'qualidade': getattr(settings, 'LEVEDURAS_RECORTE_QUALIDADE', 90),
+    }
+
+
+def codificar_recorte(imagem_array, config=None):
+    """
+    Codifica o recorte em memória no formato configurado.
+
+    Retorna (bytes, extensão, nome do formato). Recortes RGB são convertidos para
+    a ordem BGR esperada pelo OpenCV.
+    """
+    if config is None:
+        config = configuracao_recorte()
+    extensao, nome_formato = FORMATOS_RECORTE[config['formato']]
+
+    if len(imagem_array.shape) == 3:
+        imagem_array = cv2.cvtColor(imagem_array, cv2.COLOR_RGB2BGR)
+
+    if config['formato'] == 'png':
+        parametros = [cv2.IMWRITE_PNG_COMPRESSION, config['compressao_png']]
+    else:
+        # WebP e JPEG só aceitam 8 bits
+        if imagem_array.dtype != np.uint8:
+            imagem_array = cv2.normalize(imagem_array, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+        if config['formato'] == 'webp':
+            parametros = [cv2.IMWRITE_WEBP_QUALITY, config['qualidade']]
+        else:
+            parametros = [cv2.IMWRITE_JPEG_QUALITY, config['qualidade']]
+
+    success, buffer = cv2.imencode(extensao, imagem_array, parametros)
+    if not success:
+        raise ValueError(f"Erro ao codificar recorte em {nome_formato}")
+    return buffer.tobytes(), extensao, nome_formato
+
+
+class PacoteRecortes:
+    """
+    Acumula os recortes codificados de uma imagem num ZIP sem compressão.
+
+    Como os membros não são comprimidos, cada recorte pode ser lido depois
+    diretamente pelo offset e tamanho dos seus bytes dentro do pacote.
+    """
+
+    def __init__(self):
+        limite_memoria = getattr(settings, 'LEVEDURAS_PACOTE_LIMITE_MEMORIA', 64 * 1024 * 1024)
+        self.arquivo = tempfile.SpooledTemporaryFile(max_size=limite_memoria)
+        self.zip = zipfile.ZipFile(self.arquivo, 'w', zipfile.ZIP_STORED)
+        self._lock = threading.Lock()
+
+    def adicionar(self, nome, conteudo):
+        # Chamado pelas threads do pós-processamento; a posição de cada recorte é lida por nome
+        with self._lock:
+            self.zip.writestr(nome, conteudo)
+
+    def finalizar(self):
+        """
+        Fecha o pacote e retorna (arquivo, {nome: (offset, tamanho)})
+        """
+        self.zip.close()
+
+        posicoes = {}
+        for info in self.zip.infolist():
+            # O offset dos dados depende do cabeçalho local, que pode diferir do diretório central
+            self.arquivo.seek(info.header_offset)
+            cabecalho = self.arquivo.read(_TAMANHO_CABECALHO_ZIP)
+            tamanho_nome, tamanho_extra = struct.unpack('<HH', cabecalho[26:30])
+            offset = info.header_offset + _TAMANHO_CABECALHO_ZIP + tamanho_nome + tamanho_extra
+            posicoes[info.filename] = (offset, info.file_size)
+
+        self.arquivo.seek(0)
+        return self.arquivo, posicoes
+
+    def descartar(self):
+        self.arquivo.close()
+
+
+def url_recorte(levedura):
+    """URL do recorte, seja um arquivo próprio ou um trecho do pacote da imagem"""
+    return url_recorte_por_nome(levedura.id, levedura.imagem.name)
+
+
+def url_recorte_por_nome(levedura_id, nome_imagem):
+    """URL do recorte a partir das colunas id e imagem, sem instanciar o modelo"""
+    if nome_imagem:
+        return default_storage.url(nome_imagem)
+    return f'/api/leveduras/{levedura_id}/recorte/'
+
+
+def ler_recorte(levedura):
+    """
+    Retorna (bytes, content_type) do recorte, lendo apenas o trecho necessário do pacote
+    """
+    content_type = mimetypes.guess_type(levedura.nome_arquivo)[0] or 'application/octet-stream'
+
+    if levedura.imagem:
+        with levedura.imagem.open('rb') as arquivo:
+            return arquivo.read(), content_type
+
+    pacote = levedura.imagem_original.pacote_recortes
+    if not pacote or levedura.pacote_offset is None:
+        raise ValueError(f"Recorte da levedura {levedura.levedura_id} não encontrado")
+
+    with pacote.open('rb') as arquivo:
+        arquivo.seek(levedura.pacote_offset)
+        return arquivo.read(levedura.pacote_tamanho), content_type
+
+
+class LeitorRecortes:
+    """
+    Lê recortes em sequência a partir das colunas da levedura, mantendo aberto o
+    pacote da imagem atual em vez de reabri-lo a cada recorte
+    """
+
+    def __init__(self):
+        self.nome_pacote = None
+        self.pacote = None
+
+    def ler(self, nome_imagem, nome_pacote, offset, tamanho):
+        if nome_imagem:
+            with default_storage.open(nome_imagem, 'rb') as arquivo:
+                return arquivo.read()
+
+        if not nome_pacote or offset is None:
+            raise ValueError("Recorte não encontrado")
+        if nome_pacote != self.nome_pacote:
+            self.fechar()
+            self.pacote = default_storage.open(nome_pacote, 'rb')
+            self.nome_pacote = nome_pacote
+        self.pacote.seek(offset)
+        return self.pacote.read(tamanho)
+
+    def fechar(self):
+        if self.pacote is not None:
+            self.pacote.close()
+        self.nome_pacote = None
+        self.pacote = None
+
+
+class SaidaStream(io.RawIOBase):
+    """
+    Destino de escrita sem seek (ZipFile, ParquetWriter) cujos bytes são drenados
+    para uma resposta em stream
+    """
+
+    def __init__(self):
+        self.partes = []
+        self.posicao = 0
+
+    def writable(self):
+        return True
+
+    def write(self, dados):
+        self.partes.append(bytes(dados))
+        self.posicao += len(dados)
+        return len(dados)
+
+    def tell(self):
+        return self.posicao
+
+    def drenar(self):
+        dados = b''.join(self.partes)
+        self.partes = []
+        return dados
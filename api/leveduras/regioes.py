@@ -0,0 +1,63 @@
+import cv2
+import numpy as np
+from scipy import ndimage
+
+# Linhas da máscara lidas por vez nas passadas que percorrem a imagem inteira
+LINHAS_POR_LOTE = 1024
+
+
+def lotes_de_linhas(masks, linhas=LINHAS_POR_LOTE):
+    """
+    Percorre a máscara em faixas de linhas, limitando a memória das passadas
+    globais (a máscara pode estar mapeada em disco)
+    """
+    for inicio in range(0, masks.shape[0], linhas):
+        yield inicio, np.asarray(masks[inicio:inicio + linhas])
+
+
+def contar_pixels(masks, total_rotulos):
+    """Área em pixels de cada rótulo"""
+    areas = np.zeros(total_rotulos + 1, dtype=np.int64)
+    for _, faixa in lotes_de_linhas(masks):
+        areas += np.bincount(faixa.ravel(), minlength=total_rotulos + 1)[:total_rotulos + 1]
+    return areas
+
+
+def extrair_regioes(masks):
+    """
+    Extrai bounding box, área e contorno de todas as leveduras da imagem de rótulos.
+
+    As fatias de cada rótulo são obtidas em uma única passada (find_objects) e as
+    áreas em outra (bincount por faixas de linhas); o contorno de cada levedura é calculado apenas na
+    janela local dela, nunca na imagem inteira.
+    """
+    fatias = ndimage.find_objects(masks)
+    areas = contar_pixels(masks, len(fatias))
+
+    regioes = []
+    for indice, fatia in enumerate(fatias):
+        if fatia is None:  # Rótulo sem pixels
+            continue
+
+        levedura_id = indice + 1
+        fatia_y, fatia_x = fatia
+        janela = (masks[fatia] == levedura_id).astype(np.uint8)
+
+        # O offset devolve os contornos em coordenadas da imagem inteira
+        contours, _ = cv2.findContours(
+            janela, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+            offset=(fatia_x.start, fatia_y.start)
+        )
+        if not contours:
+            continue
+
+        cnt = max(contours, key=cv2.contourArea)
+        regioes.append({
+            'levedura_id': levedura_id,
+            'bounding_box': cv2.boundingRect(cnt),
+            'area_pixels': int(areas[levedura_id]),
+            'contorno': cnt,
+            'fatia': fatia,
+        })
+
+    return regioes
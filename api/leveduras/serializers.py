@@ -4,7 +4,7 @@ from .models import AnaliseLevedura, ImagemMicroscopica, ImagemColonia, Levedura
 class ImagemMicroscopicaSerializer(serializers.ModelSerializer):
     class Meta:
         model = ImagemMicroscopica
-        fields = ['id', 'imagem', 'criado_em', 'metadata']
+        fields = ['id', 'imagem', 'preview', 'mascara', 'criado_em', 'metadata']
         read_only_fields = ['id', 'criado_em']
 
 class ImagemColoniaSerializer(serializers.ModelSerializer):
@@ -1,3 +1,945 @@
-from django.test import TestCase
+import csv
+import hashlib
+import io
+import json
+import os
+import select
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+import tifffile
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import DatabaseError, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import cache_segmentacao, uploads, views
+from .benchmark import ModeloStub
+from .blocos import (
+    TiffSobDemanda, abrir_imagem_sob_demanda, dimensoes_imagem, intervalos_blocos, permitir_imagens_grandes,
+    segmentar_em_blocos
+)
+from .caracteristicas import extrair_caracteristicas_mascara
+from .decodificacao import salvar_preview, sondar_imagem
+from .escala import ampliar_mascara, calcular_escala, comparar_mascaras, reduzir_imagem
+from .exportacao import COLUNAS_EXPORTACAO, gerar_zip_recortes
+from .fila import (
+    JobPerdido, abrir_escuta_notificacoes, fila_cheia, notificar_workers, posicao_na_fila, recuperar_jobs_orfaos,
+    reivindicar_jobs
+)
+from .models import AnaliseLevedura, CacheSegmentacao, ImagemMicroscopica, LeveduraSegmentada, UploadFragmentado
+from .regioes import extrair_regioes
+from .uploads import (
+    FragmentoInvalido, gravar_fragmento, iniciar_upload, interpretar_content_range, reservar_fragmento
+)
+from .views import persistir_leveduras_segmentadas, salvar_levedura_segmentada
+
+
+@override_settings(LEVEDURAS_FILA_NOTIFICACAO=('127.0.0.1', 28765), LEVEDURAS_FILA_WORKERS=4)
+class NotificacaoWorkersTests(SimpleTestCase):
+
+    def setUp(self):
+        self.escutas = [abrir_escuta_notificacoes() for _ in range(4)]
+        for escuta in self.escutas:
+            self.addCleanup(escuta.close)
+
+    def test_cada_worker_escuta_uma_porta(self):
+        portas = {escuta.getsockname()[1] for escuta in self.escutas}
+        self.assertEqual(portas, {28765, 28766, 28767, 28768})
+
+    def test_todos_os_workers_ociosos_sao_acordados(self):
+        notificar_workers(1)
+        for escuta in self.escutas:
+            prontos, _, _ = select.select([escuta], [], [], 1)
+            self.assertEqual(prontos, [escuta])
+            self.assertEqual(escuta.recv(64), b'job')
+
+    def test_worker_alem_do_limite_fica_sem_escuta(self):
+        self.assertIsNone(abrir_escuta_notificacoes())
+
+
+def campo_sintetico(altura=300, largura=420, celulas=60, semente=0):
+    """Imagem em cinza com discos escuros sobre fundo claro, sem discos encostados"""
+    gerador = np.random.default_rng(semente)
+    imagem = np.full((altura, largura), 220, dtype=np.uint8)
+    centros = []
+    while len(centros) < celulas:
+        centro = gerador.integers((12, 12), (altura - 12, largura - 12))
+        if all(np.hypot(*(centro - outro)) > 22 for outro in centros):
+            centros.append(centro)
+            cv2.circle(imagem, (int(centro[1]), int(centro[0])), int(gerador.integers(5, 9)), 40, -1)
+    return imagem
+
+
+def segmentar_por_limiar(imagem):
+    _, binaria = cv2.threshold(imagem, 128, 255, cv2.THRESH_BINARY_INV)
+    _, rotulos = cv2.connectedComponents(binaria)
+    return rotulos.astype(np.uint32)
+
+
+class IntervalosBlocosTests(SimpleTestCase):
+
+    def test_bloco_unico_quando_cabe(self):
+        self.assertEqual(intervalos_blocos(100, 100, 20), [(0, 100, 0, 100)])
+        self.assertEqual(intervalos_blocos(100, 150, 20), [(0, 100, 0, 100)])
+
+    def test_nucleos_particionam_o_eixo(self):
+        for total, tamanho, sobreposicao in [(1000, 256, 64), (1001, 300, 100), (513, 512, 10), (90, 40, 25)]:
+            intervalos = intervalos_blocos(total, tamanho, sobreposicao)
+            self.assertEqual(intervalos[0][2], 0)
+            self.assertEqual(intervalos[-1][3], total)
+            for anterior, seguinte in zip(intervalos, intervalos[1:]):
+                self.assertEqual(anterior[3], seguinte[2])
+                # Vizinhos se sobrepõem pelo menos 'sobreposicao' pixels
+                self.assertGreaterEqual(anterior[1] - seguinte[0], sobreposicao)
+            for inicio, fim, inicio_nucleo, fim_nucleo in intervalos:
+                self.assertEqual(fim - inicio, tamanho)
+                self.assertTrue(0 <= inicio <= inicio_nucleo < fim_nucleo <= fim <= total)
+
+
+class SegmentacaoEmBlocosTests(SimpleTestCase):
+
+    def setUp(self):
+        self.diretorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.diretorio)
+        self.config = {'tamanho': 96, 'sobreposicao': 32, 'diretorio': self.diretorio}
+
+    def assertMesmasRegioes(self, masks, referencia):
+        """Mesmas células, só com outra numeração"""
+        self.assertTrue(np.array_equal(masks > 0, referencia > 0))
+        pares = np.unique(np.stack([masks[referencia > 0], referencia[referencia > 0]]), axis=1)
+        self.assertEqual(pares.shape[1], len(np.unique(referencia[referencia > 0])))
+        self.assertEqual(pares.shape[1], len(np.unique(masks[masks > 0])))
+
+    def test_costura_igual_a_imagem_inteira(self):
+        imagem = campo_sintetico()
+        masks, _ = segmentar_em_blocos(imagem, segmentar_por_limiar, self.config)
+        self.assertMesmasRegioes(np.asarray(masks), segmentar_por_limiar(imagem))
+
+    def test_tiff_comprimido_em_tiles(self):
+        imagem = campo_sintetico(semente=1)
+        caminho = os.path.join(self.diretorio, 'campo.tif')
+        tifffile.imwrite(caminho, imagem, tile=(64, 64), compression='zlib')
+        lida = abrir_imagem_sob_demanda(caminho)
+        self.assertIsInstance(lida, TiffSobDemanda)
+        masks, _ = segmentar_em_blocos(lida, segmentar_por_limiar, self.config)
+        self.assertMesmasRegioes(np.asarray(masks), segmentar_por_limiar(imagem))
+
+
+class TiffSobDemandaTests(SimpleTestCase):
+
+    def setUp(self):
+        self.diretorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.diretorio)
+
+    def gravar(self, imagem, **opcoes):
+        caminho = os.path.join(self.diretorio, 'imagem.tif')
+        tifffile.imwrite(caminho, imagem, **opcoes)
+        lida = abrir_imagem_sob_demanda(caminho)
+        if isinstance(lida, TiffSobDemanda):
+            self.addCleanup(lida.fechar)
+        return lida
+
+    def assertJanelasIguais(self, lida, imagem):
+        self.assertEqual(lida.shape, imagem.shape)
+        for janela in [np.s_[:, :], np.s_[10:75, 33:200], np.s_[::7, ::5], np.s_[250:, 1:301:3], np.s_[5:6, 7:8]]:
+            self.assertTrue(np.array_equal(lida[janela], imagem[janela]), janela)
+
+    def test_tiles_comprimidos(self):
+        imagem = (np.arange(300 * 500 * 3) % 251).astype(np.uint8).reshape(300, 500, 3)
+        lida = self.gravar(imagem, tile=(64, 128), compression='zlib')
+        self.assertIsInstance(lida, TiffSobDemanda)
+        self.assertJanelasIguais(lida, imagem)
+        self.assertTrue(np.array_equal(lida[20:40, 30:90, 1], imagem[20:40, 30:90, 1]))
+
+    def test_strips_comprimidos_16_bits(self):
+        imagem = (np.arange(300 * 500) * 7 % 65000).astype(np.uint16).reshape(300, 500)
+        lida = self.gravar(imagem, rowsperstrip=16, compression='zlib', predictor=True)
+        self.assertIsInstance(lida, TiffSobDemanda)
+        self.assertJanelasIguais(lida, imagem)
+
+    def test_tiff_nao_comprimido_continua_mapeado(self):
+        imagem = np.zeros((64, 64), dtype=np.uint8)
+        self.assertIsInstance(self.gravar(imagem), np.memmap)
+
+
+class MidiaTemporariaTestCase(TestCase):
+    """MEDIA_ROOT num diretório temporário, removido ao fim de cada teste"""
+
+    def setUp(self):
+        diretorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, diretorio)
+        configuracao = override_settings(MEDIA_ROOT=diretorio)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+
+
+class UploadFragmentadoTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conteudo = bytes(range(256)) * 4
+        analise = AnaliseLevedura.objects.create(nome_amostra='upload')
+        self.upload = iniciar_upload(analise, 'microscopica', 'campo.png', 'image/png', len(self.conteudo), 'mascara')
+        self.url = reverse('leveduras:upload-fragmentado', args=[self.upload.id])
+
+    def enviar(self, inicio, fim, content_range=None, **cabecalhos):
+        return self.client.put(
+            self.url, self.conteudo[inicio:fim], content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=content_range or f'bytes {inicio}-{fim - 1}/{len(self.conteudo)}', **cabecalhos
+        )
+
+    def recebido(self):
+        self.upload.refresh_from_db()
+        return self.upload.recebido
+
+    def tamanho_parcial(self):
+        return default_storage.size(self.upload.arquivo_parcial)
+
+    def test_fragmentos_em_ordem_concluem_o_upload(self):
+        self.assertEqual(self.enviar(0, 400).status_code, 200)
+        self.assertEqual(self.enviar(400, 1024).status_code, 201)
+        self.upload.refresh_from_db()
+        self.assertEqual(self.upload.status, 'concluido')
+        self.assertEqual(self.upload.reserva, '')
+        with self.upload.imagem_microscopica.imagem.open('rb') as imagem:
+            self.assertEqual(imagem.read(), self.conteudo)
+
+    def test_fragmento_fora_de_ordem_e_recusado(self):
+        resposta = self.enviar(400, 800)
+        self.assertEqual(resposta.status_code, 409)
+        self.assertEqual(resposta.json()['recebido'], 0)
+        self.assertEqual(self.tamanho_parcial(), 0)
+
+    def test_fragmento_repetido_ou_sobreposto_e_recusado(self):
+        self.enviar(0, 400)
+        self.assertEqual(self.enviar(0, 400).status_code, 409)
+        self.assertEqual(self.enviar(200, 600).status_code, 409)
+        self.assertEqual(self.recebido(), 400)
+        self.assertEqual(len(self.upload.fragmentos), 1)
+        with default_storage.open(self.upload.arquivo_parcial, 'rb') as parcial:
+            self.assertEqual(parcial.read(), self.conteudo[:400])
+
+    def test_content_range_invalido(self):
+        for cabecalho in ['bytes 0-399', 'bytes=0-399/1024', 'bytes 0-399/2048', 'bytes 400-0/1024',
+                          'bytes 0-1024/1024']:
+            with self.assertRaises(FragmentoInvalido, msg=cabecalho):
+                interpretar_content_range(cabecalho, len(self.conteudo))
+        self.assertEqual(interpretar_content_range('bytes 0-399/1024', 1024), (0, 400))
+
+        self.assertEqual(self.enviar(0, 400, content_range='bytes 0-399/2048').status_code, 400)
+        self.assertEqual(self.client.put(self.url, b'x', content_type='application/octet-stream').status_code, 400)
+        self.assertEqual(self.recebido(), 0)
+
+    def test_sha256_divergente_descarta_o_fragmento(self):
+        resposta = self.enviar(0, 400, HTTP_X_CHUNK_SHA256=hashlib.sha256(b'outro').hexdigest())
+        self.assertEqual(resposta.status_code, 400)
+        self.assertEqual(self.recebido(), 0)
+        self.assertEqual(self.tamanho_parcial(), 0)
+
+    def test_retomada_apos_gravacao_parcial(self):
+        self.enviar(0, 400)
+        # A conexão cai no meio do corpo: só 100 dos 400 bytes chegam
+        with self.assertRaises(FragmentoInvalido):
+            gravar_fragmento(self.upload.id, io.BytesIO(self.conteudo[400:500]), 400, 800)
+        self.assertEqual(self.recebido(), 400)
+        self.assertEqual(self.upload.reserva, '')
+        self.assertEqual(self.tamanho_parcial(), 400)
+
+        self.assertEqual(self.enviar(400, 800).status_code, 200)
+        self.assertEqual(self.enviar(800, 1024).status_code, 201)
+        self.upload.refresh_from_db()
+        with self.upload.imagem_microscopica.imagem.open('rb') as imagem:
+            self.assertEqual(imagem.read(), self.conteudo)
+
+    def test_parcial_removido_so_apos_o_commit(self):
+        self.enviar(0, 400)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.enviar(400, 1024)
+            self.assertTrue(default_storage.exists(self.upload.arquivo_parcial))
+        self.assertFalse(default_storage.exists(self.upload.arquivo_parcial))
+
+    def test_falha_no_commit_mantem_o_upload_retomavel(self):
+        self.enviar(0, 400)
+        atomic = transaction.atomic
+        transacoes = []
+
+        @contextmanager
+        def commit_falha_na_finalizacao():
+            # A reserva é confirmada; a transação que conclui o upload falha no commit
+            transacoes.append(None)
+            with atomic():
+                yield
+                if len(transacoes) == 2:
+                    raise DatabaseError('commit falhou')
+
+        transacao = SimpleNamespace(atomic=commit_falha_na_finalizacao, on_commit=transaction.on_commit)
+        with mock.patch.object(uploads, 'transaction', transacao):
+            with self.assertRaises(DatabaseError):
+                gravar_fragmento(self.upload.id, io.BytesIO(self.conteudo[400:]), 400, 1024)
+        self.assertEqual(self.recebido(), 400)
+        self.assertEqual(self.upload.status, 'recebendo')
+        self.assertEqual(self.upload.reserva, '')
+        self.assertFalse(ImagemMicroscopica.objects.exists())
+        self.assertEqual(self.tamanho_parcial(), 1024)
+        destino = ImagemMicroscopica._meta.get_field('imagem').generate_filename(None, 'campo.png')
+        self.assertEqual(default_storage.listdir(os.path.dirname(destino))[1], [])
+
+        self.assertEqual(self.enviar(400, 1024).status_code, 201)
+
+    def test_fragmento_em_gravacao_bloqueia_outro(self):
+        reservar_fragmento(self.upload.id, 0)
+        self.assertEqual(self.enviar(0, 400).status_code, 409)
+
+    @override_settings(LEVEDURAS_UPLOAD_TIMEOUT_FRAGMENTO=60)
+    def test_reserva_expirada_e_retomada(self):
+        reservar_fragmento(self.upload.id, 0)
+        UploadFragmentado.objects.filter(id=self.upload.id).update(
+            reservado_em=timezone.now() - timezone.timedelta(seconds=120)
+        )
+        self.assertEqual(self.enviar(0, 400).status_code, 200)
+        self.assertEqual(self.recebido(), 400)
+
+
+class UploadLoteZipTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.analise = AnaliseLevedura.objects.create(nome_amostra='lote')
+        self.url = reverse('leveduras:upload_lote_microscopica', args=[self.analise.id])
+        _, png = cv2.imencode('.png', campo_sintetico(60, 80, celulas=3))
+        self.png = png.tobytes()
+
+    def enviar_zip(self, membros):
+        arquivo = io.BytesIO()
+        with zipfile.ZipFile(arquivo, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for nome, conteudo in membros.items():
+                zf.writestr(nome, conteudo)
+        arquivo.seek(0)
+        arquivo.name = 'lote.zip'
+        return self.client.post(self.url, {'arquivo_zip': arquivo})
+
+    def test_imagens_do_zip_sao_gravadas(self):
+        resposta = self.enviar_zip({'a.png': self.png, 'pasta/b.png': self.png, 'leia.txt': b'texto'})
+        self.assertEqual(resposta.status_code, 202)
+        self.assertEqual(sorted(imagem['nome_arquivo'] for imagem in resposta.json()['imagens']), ['a.png', 'b.png'])
+        for imagem_micro in ImagemMicroscopica.objects.all():
+            self.assertEqual(imagem_micro.metadata['tamanho'], len(self.png))
+            with imagem_micro.imagem.open('rb') as imagem:
+                self.assertEqual(imagem.read(), self.png)
+
+    def test_membro_acima_do_limite_e_recusado_sem_extrair(self):
+        with override_settings(LEVEDURAS_LOTE_ZIP_MAX_MEMBRO=len(self.png) - 1):
+            resposta = self.enviar_zip({'a.png': self.png})
+        self.assertEqual(resposta.status_code, 400)
+        self.assertIn('a.png', resposta.json()['erro'])
+        self.assertFalse(ImagemMicroscopica.objects.exists())
+
+    def test_total_acima_do_limite_e_recusado(self):
+        with override_settings(LEVEDURAS_LOTE_ZIP_MAX_TOTAL=2 * len(self.png)):
+            resposta = self.enviar_zip({'a.png': self.png, 'b.png': self.png, 'c.png': self.png})
+        self.assertEqual(resposta.status_code, 400)
+        self.assertFalse(ImagemMicroscopica.objects.exists())
+
+    def test_zip_corrompido(self):
+        arquivo = io.BytesIO(b'nao e um zip')
+        arquivo.name = 'lote.zip'
+        self.assertEqual(self.client.post(self.url, {'arquivo_zip': arquivo}).status_code, 400)
+
+
+def criar_leveduras(analise, imagem_micro, quantidade, caracteristicas=None):
+    """Leveduras ainda não salvas, com recortes gravados no storage"""
+    recorte = np.full((20, 20), 128, dtype=np.uint8)
+    return [
+        salvar_levedura_segmentada(
+            recorte, levedura_id, analise, imagem_micro, (levedura_id * 30, 0, 20, 20),
+            caracteristicas(levedura_id) if caracteristicas else {}
+        )
+        for levedura_id in range(1, quantidade + 1)
+    ]
+
+
+class PersistenciaLeveduraTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.analise = AnaliseLevedura.objects.create(nome_amostra='persistencia')
+        self.imagem_micro = ImagemMicroscopica.objects.create(
+            analise=self.analise, imagem='campo.png', status_processamento='processando', task_id='host:1'
+        )
+
+    def leveduras(self, quantidade):
+        return criar_leveduras(self.analise, self.imagem_micro, quantidade)
+
+    def test_leveduras_gravadas_em_lote_com_a_conclusao(self):
+        persistir_leveduras_segmentadas(self.imagem_micro, self.leveduras(3))
+        self.assertEqual(self.imagem_micro.leveduras_segmentadas.count(), 3)
+        self.imagem_micro.refresh_from_db()
+        self.assertEqual((self.imagem_micro.status_processamento, self.imagem_micro.progresso), ('concluido', 100))
+        self.assertEqual(self.imagem_micro.resumo['total_leveduras'], 3)
+
+    @override_settings(LEVEDURAS_BULK_TAMANHO_LOTE=2)
+    def test_insercao_dividida_em_lotes(self):
+        bulk_create = LeveduraSegmentada.objects.bulk_create
+        with mock.patch.object(LeveduraSegmentada.objects, 'bulk_create', side_effect=bulk_create) as inserir:
+            persistir_leveduras_segmentadas(self.imagem_micro, self.leveduras(5))
+        self.assertEqual([len(chamada.args[0]) for chamada in inserir.call_args_list], [2, 2, 1])
+        self.assertEqual(self.imagem_micro.leveduras_segmentadas.count(), 5)
+
+    @override_settings(LEVEDURAS_BULK_TAMANHO_LOTE=2)
+    def test_falha_num_lote_desfaz_a_imagem_inteira(self):
+        bulk_create = LeveduraSegmentada.objects.bulk_create
+        chamadas = []
+
+        def inserir(leveduras):
+            chamadas.append(len(leveduras))
+            if len(chamadas) == 2:
+                raise DatabaseError('falha simulada')
+            return bulk_create(leveduras)
+
+        with mock.patch.object(LeveduraSegmentada.objects, 'bulk_create', side_effect=inserir):
+            with self.assertRaises(DatabaseError):
+                persistir_leveduras_segmentadas(self.imagem_micro, self.leveduras(5))
+        self.assertFalse(self.imagem_micro.leveduras_segmentadas.exists())
+        self.assertEqual(ImagemMicroscopica.objects.get(id=self.imagem_micro.id).status_processamento, 'processando')
+
+    def test_worker_que_perdeu_o_job_nao_grava(self):
+        # Timeout: o job voltou para a fila e outro worker o reivindicou
+        ImagemMicroscopica.objects.filter(id=self.imagem_micro.id).update(task_id='host:2')
+        with self.assertRaises(JobPerdido):
+            persistir_leveduras_segmentadas(self.imagem_micro, self.leveduras(3))
+        self.assertFalse(self.imagem_micro.leveduras_segmentadas.exists())
+        self.assertEqual(ImagemMicroscopica.objects.get(id=self.imagem_micro.id).status_processamento, 'processando')
+
+    def test_nova_tentativa_substitui_as_leveduras(self):
+        anteriores = self.leveduras(2)
+        LeveduraSegmentada.objects.bulk_create(anteriores)
+        with self.captureOnCommitCallbacks(execute=True):
+            persistir_leveduras_segmentadas(self.imagem_micro, self.leveduras(3))
+        self.assertEqual(self.imagem_micro.leveduras_segmentadas.count(), 3)
+        for levedura in anteriores:
+            self.assertFalse(default_storage.exists(levedura.imagem.name))
+
+    def test_conclusao_preserva_colunas_gravadas_por_outros_processos(self):
+        # Preview gravado depois que o worker carregou a instância
+        ImagemMicroscopica.objects.filter(id=self.imagem_micro.id).update(preview='preview_1.jpg')
+        persistir_leveduras_segmentadas(self.imagem_micro, [])
+        self.imagem_micro.refresh_from_db()
+        self.assertEqual(self.imagem_micro.status_processamento, 'concluido')
+        self.assertEqual(self.imagem_micro.preview.name, 'preview_1.jpg')
+
+
+class PreviewTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        analise = AnaliseLevedura.objects.create(nome_amostra='preview')
+        _, png = cv2.imencode('.png', campo_sintetico(60, 80, celulas=3))
+        self.imagem_micro = ImagemMicroscopica(analise=analise)
+        self.imagem_micro.imagem.save('campo.png', ContentFile(png.tobytes()))
+
+    def test_endpoint_nao_gera_a_miniatura(self):
+        resposta = self.client.get(reverse('leveduras:preview-imagem', args=[self.imagem_micro.id]))
+        self.assertEqual(resposta.status_code, 302)
+        self.assertEqual(resposta['Location'], self.imagem_micro.imagem.url)
+        self.imagem_micro.refresh_from_db()
+        self.assertFalse(self.imagem_micro.preview)
+
+    def test_miniatura_gerada_pelo_worker_e_servida(self):
+        salvar_preview(self.imagem_micro)
+        resposta = self.client.get(reverse('leveduras:preview-imagem', args=[self.imagem_micro.id]))
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta['Content-Type'], 'image/jpeg')
+
+    def test_segunda_geracao_nao_deixa_arquivo_orfao(self):
+        outra = ImagemMicroscopica.objects.get(id=self.imagem_micro.id)
+        salvar_preview(self.imagem_micro)
+        salvar_preview(outra)
+        self.assertEqual(outra.preview.name, self.imagem_micro.preview.name)
+        _, arquivos = default_storage.listdir(os.path.dirname(self.imagem_micro.preview.name))
+        self.assertEqual(arquivos, [os.path.basename(self.imagem_micro.preview.name)])
+
+
+class LimitePixelsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.diretorio = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.diretorio)
+        self.caminho = os.path.join(self.diretorio, 'campo.png')
+        cv2.imwrite(self.caminho, np.zeros((100, 200), dtype=np.uint8))
+
+    def test_sondagem_nao_altera_o_limite_do_pillow(self):
+        limite = Image.MAX_IMAGE_PIXELS
+        self.assertEqual(sondar_imagem(self.caminho)['largura'], 200)
+        self.assertEqual(Image.MAX_IMAGE_PIXELS, limite)
+
+    def test_dimensoes_nao_alteram_o_limite_do_pillow(self):
+        limite = Image.MAX_IMAGE_PIXELS
+        self.assertEqual(dimensoes_imagem(self.caminho), (100, 200))
+        self.assertEqual(Image.MAX_IMAGE_PIXELS, limite)
+
+    @override_settings(LEVEDURAS_MAX_PIXELS=100 * 199)
+    def test_imagem_acima_do_limite_e_recusada(self):
+        with self.assertRaises(ValueError):
+            sondar_imagem(self.caminho)
+        with self.assertRaises(ValueError):
+            dimensoes_imagem(self.caminho)
+
+    @override_settings(LEVEDURAS_MAX_PIXELS=1000 * 1000)
+    def test_worker_eleva_o_limite_do_pillow_ate_o_configurado(self):
+        limite = Image.MAX_IMAGE_PIXELS
+        self.addCleanup(setattr, Image, 'MAX_IMAGE_PIXELS', limite)
+        permitir_imagens_grandes()
+        self.assertEqual(Image.MAX_IMAGE_PIXELS, 1000 * 1000)
+
+
+class ProgressoTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        analise = AnaliseLevedura.objects.create(nome_amostra='progresso')
+        self.imagem_micro = ImagemMicroscopica.objects.create(
+            analise=analise, imagem='campo.png', status_processamento='processando', progresso=40
+        )
+        self.url = reverse('leveduras:progresso-processamento', args=[self.imagem_micro.id])
+
+    def test_etag_responde_304(self):
+        resposta = self.client.get(self.url)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta.json()['progresso'], 40)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=resposta['ETag']).status_code, 304)
+
+        ImagemMicroscopica.objects.filter(id=self.imagem_micro.id).update(progresso=60)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=resposta['ETag']).status_code, 200)
+
+    @mock.patch.object(views, 'ESPERA_MAXIMA_PROGRESSO_SINCRONA', 0.2)
+    def test_espera_da_view_sincrona_e_limitada(self):
+        etag = self.client.get(self.url)['ETag']
+        inicio = time.monotonic()
+        resposta = self.client.get(self.url, {'aguardar': 30}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resposta.status_code, 304)
+        self.assertLess(time.monotonic() - inicio, 2)
+
+
+class StatusProcessamentoTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        analise = AnaliseLevedura.objects.create(nome_amostra='status')
+        self.imagem_micro = ImagemMicroscopica.objects.create(
+            analise=analise, imagem='campo.png', status_processamento='processando'
+        )
+        persistir_leveduras_segmentadas(
+            self.imagem_micro,
+            criar_leveduras(analise, self.imagem_micro, 5, lambda levedura_id: {'area_microns': levedura_id * 10.0})
+        )
+        self.url = reverse('leveduras:status-processamento', args=[self.imagem_micro.id])
+
+    def test_paginacao_por_cursor(self):
+        ids, cursor = [], 0
+        while cursor is not None:
+            dados = self.client.get(self.url, {'limite': 2, 'cursor': cursor}).json()
+            self.assertLessEqual(len(dados['leveduras_segmentadas']), 2)
+            ids += [levedura['levedura_id'] for levedura in dados['leveduras_segmentadas']]
+            cursor = dados['proximo_cursor']
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+    def test_campos_pedidos(self):
+        dados = self.client.get(self.url, {'campos': 'levedura_id,area_pixels'}).json()
+        self.assertEqual(dados['leveduras_segmentadas'][0], {'levedura_id': 1, 'area_pixels': 400})
+
+        resposta = self.client.get(self.url, {'campos': 'levedura_id,inexistente'})
+        self.assertEqual(resposta.status_code, 400)
+        self.assertIn('campos_disponiveis', resposta.json())
+
+    def test_limite_zero_devolve_so_o_resumo(self):
+        dados = self.client.get(self.url, {'limite': 0}).json()
+        self.assertNotIn('leveduras_segmentadas', dados)
+        self.assertEqual(dados['total_leveduras'], 5)
+        self.assertEqual(dados['estatisticas_gerais']['media_area_microns'], 30.0)
+
+    def test_resumo_gravado_na_conclusao(self):
+        # Sem agregar as leveduras a cada consulta: o resumo vem da própria imagem
+        with self.assertNumQueries(1):
+            self.client.get(self.url, {'limite': 0})
+        # A página de leveduras é uma única consulta
+        with self.assertNumQueries(2):
+            self.client.get(self.url, {'limite': 3})
+
+    def test_etag_do_status(self):
+        resposta = self.client.get(self.url, {'limite': 2})
+        etag = resposta['ETag']
+        self.assertEqual(self.client.get(self.url, {'limite': 2}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Outra página é outra representação
+        self.assertEqual(self.client.get(self.url, {'limite': 2, 'cursor': 2}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # Características recalculadas depois da conclusão
+        ImagemMicroscopica.objects.filter(id=self.imagem_micro.id).update(atualizado_em=timezone.now())
+        self.assertEqual(self.client.get(self.url, {'limite': 2}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_resumo_de_imagens_antigas_calculado_uma_vez(self):
+        ImagemMicroscopica.objects.filter(id=self.imagem_micro.id).update(resumo=None)
+        self.assertEqual(self.client.get(self.url, {'limite': 0}).json()['total_leveduras'], 5)
+        self.imagem_micro.refresh_from_db()
+        self.assertEqual(self.imagem_micro.resumo['total_leveduras'], 5)
+        self.assertEqual(self.imagem_micro.resumo['estatisticas_gerais']['media_area_microns'], 30.0)
+
+
+class ExportacaoCaracteristicasTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.analises, self.imagens = [], []
+        for nome, quantidade in (('primeira', 3), ('segunda', 2)):
+            analise = AnaliseLevedura.objects.create(nome_amostra=nome)
+            imagem_micro = ImagemMicroscopica.objects.create(
+                analise=analise, imagem='campo.png', status_processamento='processando'
+            )
+            persistir_leveduras_segmentadas(
+                imagem_micro,
+                criar_leveduras(analise, imagem_micro, quantidade, lambda levedura_id: {'area_microns': levedura_id * 10.0})
+            )
+            self.analises.append(analise)
+            self.imagens.append((imagem_micro.id, quantidade))
+        self.url = reverse('leveduras:exportar-leveduras')
+
+    def exportar_csv(self, **parametros):
+        resposta = self.client.get(self.url, parametros)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertTrue(resposta.streaming)
+        linhas = list(csv.reader(io.StringIO(b''.join(resposta.streaming_content).decode())))
+        self.assertEqual(linhas[0], COLUNAS_EXPORTACAO)
+        return [dict(zip(linhas[0], linha)) for linha in linhas[1:]]
+
+    @override_settings(LEVEDURAS_EXPORTACAO_TAMANHO_BLOCO=2)
+    def test_csv_percorre_todos_os_blocos(self):
+        linhas = self.exportar_csv()
+        self.assertEqual(
+            [(linha['imagem_original_id'], linha['levedura_id']) for linha in linhas],
+            [(str(imagem), str(levedura)) for imagem, quantidade in self.imagens for levedura in range(1, quantidade + 1)]
+        )
+        self.assertEqual(linhas[1]['bbox_x'], '60')
+        self.assertEqual(linhas[1]['area_microns'], '20.0')
+
+    def test_filtros(self):
+        linhas = self.exportar_csv(analises=str(self.analises[1].id))
+        self.assertEqual({linha['analise_id'] for linha in linhas}, {str(self.analises[1].id)})
+        self.assertEqual(len(linhas), 2)
+
+        linhas = self.exportar_csv(area_microns_min='15', area_microns_max='25')
+        self.assertEqual([linha['levedura_id'] for linha in linhas], ['2', '2'])
+
+    def test_filtro_invalido(self):
+        self.assertEqual(self.client.get(self.url, {'imagens': 'a'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'desde': 'ontem'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'formato': 'xlsx'}).status_code, 400)
+
+    def test_parquet(self):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest('pyarrow não instalado')
+        resposta = self.client.get(self.url, {'formato': 'parquet'})
+        tabela = pq.read_table(io.BytesIO(b''.join(resposta.streaming_content)))
+        self.assertEqual(tabela.column_names, COLUNAS_EXPORTACAO)
+        self.assertEqual(tabela.num_rows, 5)
+
+
+class ExportacaoRecortesTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        analise = AnaliseLevedura.objects.create(nome_amostra='exportacao')
+        imagem_micro = ImagemMicroscopica.objects.create(
+            analise=analise, imagem='campo.png', status_processamento='processando'
+        )
+        persistir_leveduras_segmentadas(imagem_micro, criar_leveduras(analise, imagem_micro, 5))
+        self.leveduras = LeveduraSegmentada.objects.all()
+
+    def exportar(self):
+        return zipfile.ZipFile(io.BytesIO(b''.join(gerar_zip_recortes(self.leveduras))))
+
+    def test_zip_com_recortes_e_manifesto(self):
+        with self.exportar() as arquivo_zip:
+            manifesto = [json.loads(linha) for linha in arquivo_zip.read('manifesto.jsonl').splitlines()]
+            self.assertEqual(sorted(item['levedura_id'] for item in manifesto), [1, 2, 3, 4, 5])
+            for item in manifesto:
+                self.assertEqual(cv2.imdecode(np.frombuffer(arquivo_zip.read(item['arquivo']), np.uint8),
+                                              cv2.IMREAD_UNCHANGED).shape[:2], (20, 20))
+
+    def test_manifesto_gravado_com_zip64(self):
+        dados = b''.join(gerar_zip_recortes(self.leveduras))
+        info = zipfile.ZipFile(io.BytesIO(dados)).getinfo('manifesto.jsonl')
+        # Cabeçalho local: o campo extra começa com o id 0x0001 (ZIP64)
+        tamanho_nome, tamanho_extra = struct.unpack('<HH', dados[info.header_offset + 26:info.header_offset + 30])
+        inicio_extra = info.header_offset + 30 + tamanho_nome
+        self.assertGreater(tamanho_extra, 0)
+        self.assertEqual(struct.unpack('<H', dados[inicio_extra:inicio_extra + 2])[0], 0x0001)
+
+
+class FilaJobsTests(TestCase):
+
+    def setUp(self):
+        self.analise = AnaliseLevedura.objects.create(nome_amostra='fila')
+
+    def criar_job(self, minutos_atras=0, **campos):
+        campos.setdefault('status_processamento', 'pendente')
+        return ImagemMicroscopica.objects.create(
+            analise=self.analise, imagem='campo.png',
+            criado_em=timezone.now() - timedelta(minutes=minutos_atras), **campos
+        )
+
+    def test_reivindica_o_job_mais_antigo(self):
+        novo = self.criar_job(minutos_atras=1)
+        antigo = self.criar_job(minutos_atras=5)
+        self.assertEqual((posicao_na_fila(antigo), posicao_na_fila(novo)), (1, 2))
+
+        jobs = reivindicar_jobs('host:1')
+        self.assertEqual([job.id for job in jobs], [antigo.id])
+        antigo.refresh_from_db()
+        self.assertEqual((antigo.status_processamento, antigo.task_id), ('processando', 'host:1'))
+        self.assertIsNone(posicao_na_fila(antigo))
+
+        self.assertEqual([job.id for job in reivindicar_jobs('host:2')], [novo.id])
+        self.assertEqual(reivindicar_jobs('host:3'), [])
+
+    def test_reivindica_junto_os_jobs_do_mesmo_lote(self):
+        lote = [self.criar_job(minutos_atras=5 - indice, metadata={'lote': 'a'}) for indice in range(3)]
+        avulso = self.criar_job(minutos_atras=4.5)
+        jobs = reivindicar_jobs('host:1', limite=2)
+        self.assertEqual([job.id for job in jobs], [lote[0].id, lote[1].id])
+        self.assertEqual(ImagemMicroscopica.objects.get(id=avulso.id).status_processamento, 'pendente')
+
+    @override_settings(LEVEDURAS_FILA_MAX=2)
+    def test_fila_cheia(self):
+        self.criar_job()
+        self.assertFalse(fila_cheia())
+        self.criar_job(status_processamento='processando')
+        self.assertTrue(fila_cheia())
+        self.criar_job(status_processamento='concluido')
+        self.assertFalse(fila_cheia(0))
+
+    @override_settings(LEVEDURAS_FILA_TIMEOUT=60, LEVEDURAS_FILA_TENTATIVAS=2)
+    def test_recupera_jobs_de_workers_mortos_ou_expirados(self):
+        processo = subprocess.Popen(['true'])
+        processo.wait()
+        vivo = f"{socket.gethostname()}:{os.getpid()}"
+        morto = f"{socket.gethostname()}:{processo.pid}"
+        agora = timezone.now()
+
+        em_andamento = self.criar_job(status_processamento='processando', task_id=vivo, iniciado_em=agora)
+        abandonado = self.criar_job(status_processamento='processando', task_id=morto, iniciado_em=agora)
+        expirado = self.criar_job(
+            status_processamento='processando', task_id=vivo, iniciado_em=agora - timedelta(minutes=5)
+        )
+        esgotado = self.criar_job(
+            status_processamento='processando', task_id=morto, iniciado_em=agora, metadata={'tentativas': 1}
+        )
+        outra_maquina = self.criar_job(
+            status_processamento='processando', task_id='outra-maquina:1', iniciado_em=agora
+        )
+
+        self.assertEqual(recuperar_jobs_orfaos(), 3)
+        estados = {
+            job.id: (job.status_processamento, (job.metadata or {}).get('tentativas'))
+            for job in ImagemMicroscopica.objects.all()
+        }
+        self.assertEqual(estados[em_andamento.id], ('processando', None))
+        self.assertEqual(estados[outra_maquina.id], ('processando', None))
+        self.assertEqual(estados[abandonado.id], ('pendente', 1))
+        self.assertEqual(estados[expirado.id], ('pendente', 1))
+        self.assertEqual(estados[esgotado.id], ('erro', 2))
+
+
+class CaracteristicasMascaraTests(SimpleTestCase):
+
+    def setUp(self):
+        self.masks = np.zeros((200, 300), dtype=np.uint32)
+        cv2.circle(self.masks, (60, 50), 20, 1, -1)
+        cv2.ellipse(self.masks, (170, 105), (40, 10), 0, 0, 360, 3, -1)
+        # Menor que AREA_MINIMA_PIXELS
+        self.masks[180:185, 10:15] = 4
+        self.regioes = {regiao['levedura_id']: regiao for regiao in extrair_regioes(self.masks)}
+
+    def test_regioes_de_cada_rotulo(self):
+        self.assertEqual(sorted(self.regioes), [1, 3, 4])
+        self.assertEqual(self.regioes[3]['bounding_box'], (130, 95, 81, 21))
+        for levedura_id, regiao in self.regioes.items():
+            self.assertEqual(regiao['area_pixels'], int((self.masks == levedura_id).sum()))
+
+    def test_caracteristicas_em_coordenadas_da_imagem(self):
+        caracteristicas = extrair_caracteristicas_mascara(self.masks, list(self.regioes.values()), 0.5)
+        self.assertIsNone(caracteristicas[4])
+
+        disco = caracteristicas[1]
+        self.assertEqual((disco['centroide_x'], disco['centroide_y']), (60, 50))
+        self.assertGreater(disco['circularidade'], 0.85)
+        self.assertAlmostEqual(disco['relacao_aspecto'], 1, delta=0.05)
+        self.assertAlmostEqual(disco['area_microns'], disco['area_pixels'] * 0.25)
+
+        alongada = caracteristicas[3]
+        self.assertAlmostEqual(alongada['relacao_aspecto'], 4, delta=0.3)
+        self.assertAlmostEqual(alongada['angulacao_graus'] % 180, 90, delta=2)
+        self.assertEqual((alongada['centroide_x'], alongada['centroide_y']), (170, 105))
+        self.assertEqual(alongada['area_pixels_mascara'], int((self.masks == 3).sum()))
+
+
+def substituir_modelo(modelo):
+    """Troca o modelo compartilhado do Cellpose por 'modelo' durante o bloco"""
+    @contextmanager
+    def usar_modelo(model_type):
+        yield modelo, {'tempo_carregamento': 0.0, 'tempo_inferencia': 0.0}
+
+    return mock.patch.object(views, 'usar_modelo', usar_modelo)
+
+
+class CacheSegmentacaoTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.analise = AnaliseLevedura.objects.create(nome_amostra='cache')
+        _, png = cv2.imencode('.png', campo_sintetico(120, 160, celulas=8))
+        self.conteudo = png.tobytes()
+        self.modelo = mock.Mock(wraps=ModeloStub())
+
+    def imagem(self, conteudo, task_id):
+        imagem_micro = ImagemMicroscopica(analise=self.analise, task_id=task_id)
+        imagem_micro.imagem.save('campo.png', ContentFile(conteudo))
+        return imagem_micro
+
+    def processar(self, imagem_micro):
+        with substituir_modelo(self.modelo), self.captureOnCommitCallbacks(execute=True):
+            views.processar_em_background(imagem_micro.id)
+        imagem_micro.refresh_from_db()
+        return imagem_micro
+
+    def bounding_boxes(self, imagem_micro):
+        return list(imagem_micro.leveduras_segmentadas.order_by('levedura_id').values_list('bounding_box', flat=True))
+
+    def test_reenvio_reaproveita_a_segmentacao(self):
+        primeira = self.processar(self.imagem(self.conteudo, 'host:1'))
+        self.assertEqual(primeira.metadata['cache'], 'falha')
+        self.assertEqual(self.modelo.eval.call_count, 1)
+
+        segunda = self.processar(self.imagem(self.conteudo, 'host:2'))
+        self.assertEqual(self.modelo.eval.call_count, 1)
+        self.assertEqual(segunda.status_processamento, 'concluido')
+        self.assertEqual(segunda.metadata['cache'], 'acerto')
+        self.assertEqual(segunda.metadata['sha256'], primeira.metadata['sha256'])
+        self.assertEqual(segunda.resumo['total_leveduras'], 8)
+        self.assertEqual(self.bounding_boxes(segunda), self.bounding_boxes(primeira))
+        # A entrada referencia a máscara da primeira imagem em vez de gravar outra cópia
+        self.assertEqual(segunda.mascara.name, primeira.mascara.name)
+        self.assertEqual(CacheSegmentacao.objects.get().acertos, 1)
+
+    def test_conteudo_diferente_nao_acerta(self):
+        self.processar(self.imagem(self.conteudo, 'host:1'))
+        _, png = cv2.imencode('.png', campo_sintetico(120, 160, celulas=8, semente=1))
+        outra = self.processar(self.imagem(png.tobytes(), 'host:2'))
+        self.assertEqual(outra.metadata['cache'], 'falha')
+        self.assertEqual(self.modelo.eval.call_count, 2)
+
+    @override_settings(LEVEDURAS_CACHE_ATIVO=False)
+    def test_cache_desativado(self):
+        self.processar(self.imagem(self.conteudo, 'host:1'))
+        self.processar(self.imagem(self.conteudo, 'host:2'))
+        self.assertEqual(self.modelo.eval.call_count, 2)
+        self.assertFalse(CacheSegmentacao.objects.exists())
+
+    def test_despejo_remove_a_entrada_usada_ha_mais_tempo(self):
+        masks = segmentar_por_limiar(campo_sintetico(120, 160, celulas=8))
+        primeira = cache_segmentacao.armazenar('a', 'a', {}, masks, {})
+        despejada = cache_segmentacao.armazenar('b', 'b', {}, masks, {})
+        # Acerto em 'a': 'b' passa a ser a usada há mais tempo
+        self.assertIsNotNone(cache_segmentacao.buscar('a'))
+
+        limite_mb = primeira.tamanho_bytes * 2.5 / (1024 * 1024)
+        with override_settings(LEVEDURAS_CACHE_MAX_MB=limite_mb):
+            cache_segmentacao.armazenar('c', 'c', {}, masks, {})
+
+        self.assertEqual(sorted(CacheSegmentacao.objects.values_list('chave', flat=True)), ['a', 'c'])
+        self.assertIsNone(cache_segmentacao.buscar('b'))
+        self.assertFalse(default_storage.exists(despejada.mascara.name))
+
+
+class EscalaSegmentacaoTests(MidiaTemporariaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.campo = campo_sintetico(120, 160, celulas=8)
+        self.modelo = mock.Mock(wraps=ModeloStub())
+
+    def test_fator_pelo_diametro_esperado(self):
+        configuracao = {'diametro_microns': 30, 'diametro_alvo': 30, 'comparar': False}
+        escala = calcular_escala(0.5, configuracao)
+        self.assertEqual((escala['diametro_pixels'], escala['fator'], escala['diametro_reduzido']), (60, 0.5, 30))
+        # Células menores que o alvo: a imagem nunca é ampliada
+        self.assertEqual(calcular_escala(2.0, configuracao)['fator'], 1.0)
+        self.assertIsNone(calcular_escala(0.5, {**configuracao, 'diametro_microns': None}))
+
+    def test_ampliacao_preserva_os_rotulos(self):
+        masks = np.zeros((4, 6), dtype=np.uint32)
+        masks[:2, :3] = 70000
+        masks[2:, 3:] = 2
+        ampliada = ampliar_mascara(masks, (8, 12))
+        self.assertEqual((ampliada.shape, ampliada.dtype), ((8, 12), np.uint32))
+        self.assertTrue((ampliada[:4, :6] == 70000).all())
+        self.assertTrue((ampliada[4:, 6:] == 2).all())
+        self.assertEqual(int((ampliada == 0).sum()), 48)
+
+    def test_inferencia_reduzida_volta_a_resolucao_original(self):
+        escala = {'fator': 0.5, 'diametro_reduzido': 7.0}
+        masks = views.inferir_mascaras(self.modelo, self.campo, escala)
+        imagem_reduzida = self.modelo.eval.call_args.args[0]
+        self.assertEqual(imagem_reduzida.shape, (60, 80))
+        self.assertEqual(self.modelo.eval.call_args.kwargs['diameter'], 7.0)
+        self.assertEqual(masks.shape, self.campo.shape)
+
+        comparacao = comparar_mascaras(masks, segmentar_por_limiar(self.campo))
+        self.assertEqual(comparacao['diferenca_contagem'], 0)
+        self.assertGreater(comparacao['iou_medio_celulas'], 0.7)
+        self.assertEqual(comparacao['fracao_celulas_correspondidas'], 1.0)
+
+        lista = views.inferir_mascaras(self.modelo, [self.campo, reduzir_imagem(self.campo, 0.5)], escala)
+        self.assertEqual([m.shape for m in lista], [(120, 160), (60, 80)])
+
+    def test_comparacao_de_mascaras_identicas(self):
+        masks = segmentar_por_limiar(self.campo)
+        comparacao = comparar_mascaras(masks, masks)
+        self.assertEqual((comparacao['leveduras'], comparacao['diferenca_contagem']), (8, 0))
+        self.assertEqual((comparacao['iou_primeiro_plano'], comparacao['iou_medio_celulas']), (1.0, 1.0))
+
+    @override_settings(
+        LEVEDURAS_DIAMETRO_ESPERADO_MICRONS=0.49, LEVEDURAS_DIAMETRO_ALVO_PIXELS=7,
+        LEVEDURAS_ESCALA_COMPARAR=True, LEVEDURAS_CACHE_ATIVO=False
+    )
+    def test_job_registra_a_comparacao_com_a_resolucao_completa(self):
+        _, png = cv2.imencode('.png', self.campo)
+        analise = AnaliseLevedura.objects.create(nome_amostra='escala')
+        imagem_micro = ImagemMicroscopica(analise=analise)
+        imagem_micro.imagem.save('campo.png', ContentFile(png.tobytes()))
+
+        with substituir_modelo(self.modelo), self.captureOnCommitCallbacks(execute=True):
+            views.processar_em_background(imagem_micro.id)
+        imagem_micro.refresh_from_db()
+
+        self.assertEqual(self.modelo.eval.call_count, 2)
+        self.assertEqual(imagem_micro.status_processamento, 'concluido')
+        self.assertEqual(imagem_micro.resumo['total_leveduras'], 8)
+        escala = imagem_micro.metadata['escala']
+        self.assertAlmostEqual(escala['fator'], 0.5)
+        self.assertEqual((escala['leveduras'], escala['leveduras_resolucao_completa']), (8, 8))
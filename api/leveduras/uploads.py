@@ -0,0 +1,246 @@
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from .fila import enfileirar_apos_commit
+from .models import ImagemColonia, ImagemMicroscopica, UploadFragmentado
+
+# Os fragmentos são gravados por offset no arquivo parcial e o arquivo final é ligado ao
+# destino da imagem sem reler os bytes: o upload fragmentado requer storage em sistema
+# de arquivos (Storage.path), tanto no default_storage quanto no campo 'imagem'
+DIRETORIO_PARCIAIS = 'leveduras/uploads/parciais/'
+
+# Bytes lidos da requisição por vez ao gravar um fragmento
+TAMANHO_LEITURA = 1024 * 1024
+
+_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+MODELOS_IMAGEM = {
+    'microscopica': ImagemMicroscopica,
+    'colonia': ImagemColonia,
+}
+
+
+class FragmentoInvalido(ValueError):
+    pass
+
+
+class ConflitoFragmento(Exception):
+    """O fragmento não começa onde o upload parou (ou o upload já foi concluído)"""
+
+    def __init__(self, upload, mensagem=None):
+        super().__init__(mensagem or f"O próximo fragmento deve começar no byte {upload.recebido}")
+        self.upload = upload
+
+
+def configuracao_upload():
+    return {
+        'tamanho_fragmento': getattr(settings, 'LEVEDURAS_UPLOAD_TAMANHO_FRAGMENTO', 8 * 1024 * 1024),
+        'tamanho_maximo': getattr(settings, 'LEVEDURAS_UPLOAD_TAMANHO_MAXIMO', 4 * 1024 ** 3),
+        'timeout_fragmento': getattr(settings, 'LEVEDURAS_UPLOAD_TIMEOUT_FRAGMENTO', 600),
+    }
+
+
+def interpretar_content_range(cabecalho, tamanho):
+    """'bytes inicio-fim/total' -> (inicio, fim exclusivo)"""
+    encontrado = _CONTENT_RANGE.match((cabecalho or '').strip())
+    if not encontrado:
+        raise FragmentoInvalido("Content-Range deve ter o formato 'bytes inicio-fim/total'")
+    inicio, ultimo, total = (int(valor) for valor in encontrado.groups())
+    if total != tamanho:
+        raise FragmentoInvalido(f"O total do Content-Range difere do tamanho do upload ({tamanho})")
+    if ultimo < inicio or ultimo >= tamanho:
+        raise FragmentoInvalido("Intervalo do Content-Range inválido")
+    return inicio, ultimo + 1
+
+
+def caminho_local(storage, nome):
+    try:
+        return storage.path(nome)
+    except NotImplementedError:
+        raise ImproperlyConfigured("O upload fragmentado requer um storage em sistema de arquivos")
+
+
+def iniciar_upload(analise, tipo, nome_arquivo, tipo_conteudo, tamanho, modo_caracteristicas=''):
+    """Cria o registro do upload e o arquivo parcial, vazio, no storage"""
+    caminho_local(default_storage, '')
+    caminho_local(MODELOS_IMAGEM[tipo]._meta.get_field('imagem').storage, '')
+    arquivo_parcial = default_storage.save(
+        f"{DIRETORIO_PARCIAIS}{uuid.uuid4().hex}.part", ContentFile(b'')
+    )
+    return UploadFragmentado.objects.create(
+        analise=analise,
+        tipo=tipo,
+        nome_arquivo=os.path.basename(nome_arquivo),
+        tipo_conteudo=tipo_conteudo,
+        tamanho=tamanho,
+        arquivo_parcial=arquivo_parcial,
+        modo_caracteristicas=modo_caracteristicas,
+    )
+
+
+def reservar_fragmento(upload_id, inicio):
+    """
+    Reserva o upload para gravar o fragmento que começa em 'inicio'. O registro só
+    fica travado durante a verificação: a reserva impede que outro fragmento seja
+    gravado no arquivo parcial enquanto este é transferido, e expira após
+    LEVEDURAS_UPLOAD_TIMEOUT_FRAGMENTO se a requisição morrer no meio.
+    """
+    limite = timezone.now() - timedelta(seconds=configuracao_upload()['timeout_fragmento'])
+    with transaction.atomic():
+        upload = UploadFragmentado.objects.select_for_update().get(id=upload_id)
+        if upload.status != 'recebendo' or inicio != upload.recebido:
+            raise ConflitoFragmento(upload)
+        if upload.reserva and upload.reservado_em and upload.reservado_em >= limite:
+            raise ConflitoFragmento(upload, f"Outro fragmento a partir do byte {upload.recebido} está sendo gravado")
+        upload.reserva = uuid.uuid4().hex
+        upload.reservado_em = timezone.now()
+        upload.save(update_fields=['reserva', 'reservado_em'])
+    return upload
+
+
+def liberar_reserva(upload_id, reserva):
+    UploadFragmentado.objects.filter(id=upload_id, reserva=reserva).update(reserva='', reservado_em=None)
+
+
+def gravar_fragmento(upload_id, stream, inicio, fim, sha256_esperado=None):
+    """
+    Grava em stream o fragmento [inicio, fim) no arquivo parcial, calculando o
+    SHA-256 enquanto lê a requisição. Os fragmentos são sequenciais: o fragmento
+    precisa começar onde o anterior parou, e a transferência do corpo acontece sob a
+    reserva do upload (reservar_fragmento), sem travar o registro no banco.
+
+    Quando o último byte chega o arquivo parcial vira a imagem (finalizar_upload).
+    Retorna o upload atualizado.
+    """
+    upload = reservar_fragmento(upload_id, inicio)
+    reserva = upload.reserva
+    try:
+        sha256 = hashlib.sha256()
+        with open(caminho_local(default_storage, upload.arquivo_parcial), 'r+b') as parcial:
+            parcial.seek(inicio)
+            restante = fim - inicio
+            while restante:
+                dados = stream.read(min(TAMANHO_LEITURA, restante)) if stream is not None else b''
+                if not dados:
+                    break
+                sha256.update(dados)
+                parcial.write(dados)
+                restante -= len(dados)
+
+            hash_fragmento = sha256.hexdigest()
+            erro = None
+            if restante:
+                erro = f"Fragmento incompleto: faltaram {restante} bytes"
+            elif sha256_esperado and sha256_esperado.lower() != hash_fragmento:
+                erro = "SHA-256 do fragmento não confere"
+            if erro:
+                # Descarta o que foi gravado; o cliente reenvia a partir de 'recebido'
+                parcial.truncate(inicio)
+                raise FragmentoInvalido(erro)
+            parcial.truncate(fim)
+
+        destino = None
+        try:
+            with transaction.atomic():
+                upload = UploadFragmentado.objects.select_for_update().get(id=upload_id)
+                if upload.reserva != reserva or upload.recebido != inicio:
+                    # A reserva expirou e outro fragmento tomou o lugar deste
+                    raise ConflitoFragmento(upload)
+                upload.recebido = fim
+                upload.fragmentos = upload.fragmentos + [{'inicio': inicio, 'fim': fim, 'sha256': hash_fragmento}]
+                upload.reserva = ''
+                upload.reservado_em = None
+                upload.save(update_fields=['recebido', 'fragmentos', 'reserva', 'reservado_em', 'atualizado_em'])
+
+                if upload.recebido == upload.tamanho:
+                    destino = finalizar_upload(upload)
+        except Exception:
+            # Falha no commit depois da finalização: o upload continua 'recebendo', com o
+            # arquivo parcial intacto, e a cópia no destino da imagem é descartada
+            if destino is not None and os.path.exists(destino):
+                os.remove(destino)
+            raise
+    except Exception:
+        liberar_reserva(upload_id, reserva)
+        raise
+    return upload
+
+
+def finalizar_upload(upload):
+    """
+    Cria a imagem a partir do arquivo parcial e, se for microscópica, a enfileira após
+    o commit. Deve rodar dentro da transação que conclui o upload.
+
+    O arquivo chega ao destino por hard link (sem reler os bytes) e o parcial só é
+    removido depois do commit: se a transação não for confirmada o upload continua
+    retomável. Retorna o caminho do destino, para o chamador descartá-lo nesse caso.
+    """
+    modelo = MODELOS_IMAGEM[upload.tipo]
+    campo = modelo._meta.get_field('imagem')
+    nome = campo.storage.get_available_name(campo.generate_filename(None, upload.nome_arquivo))
+    origem = caminho_local(default_storage, upload.arquivo_parcial)
+    destino = caminho_local(campo.storage, nome)
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    try:
+        os.link(origem, destino)
+    except OSError:
+        # Storages em sistemas de arquivos diferentes
+        shutil.copyfile(origem, destino)
+
+    metadata = {
+        'nome_arquivo': upload.nome_arquivo,
+        'tamanho': upload.tamanho,
+        'tipo_conteudo': upload.tipo_conteudo,
+        'upload_fragmentado': str(upload.id),
+    }
+    try:
+        if upload.tipo == 'microscopica':
+            metadata['modo_caracteristicas'] = upload.modo_caracteristicas
+            upload.imagem_microscopica = ImagemMicroscopica.objects.create(
+                analise_id=upload.analise_id,
+                imagem=nome,
+                status_processamento='pendente',
+                metadata=metadata
+            )
+            enfileirar_apos_commit()
+        else:
+            upload.imagem_colonia = ImagemColonia.objects.create(
+                analise_id=upload.analise_id,
+                imagem=nome,
+                metadata=metadata
+            )
+        upload.status = 'concluido'
+        upload.save(update_fields=['status', 'imagem_microscopica', 'imagem_colonia', 'atualizado_em'])
+    except Exception:
+        os.remove(destino)
+        raise
+    transaction.on_commit(lambda: default_storage.delete(upload.arquivo_parcial))
+    return destino
+
+
+def cancelar_upload(upload):
+    if upload.status == 'recebendo':
+        default_storage.delete(upload.arquivo_parcial)
+    upload.delete()
+
+
+def remover_uploads_abandonados(horas):
+    """Remove uploads não concluídos sem fragmentos novos há mais de 'horas'"""
+    limite = timezone.now() - timedelta(hours=horas)
+    abandonados = UploadFragmentado.objects.filter(status='recebendo', atualizado_em__lt=limite)
+    total = 0
+    for upload in abandonados.iterator():
+        cancelar_upload(upload)
+        total += 1
+    return total
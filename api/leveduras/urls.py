@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import views, views_async
 
 app_name = 'leveduras'
 
@@ -7,7 +7,30 @@ urlpatterns = [
     path('analises/', views.criar_analise, name='criar_analise'),
     path('analises/<uuid:analise_id>/', views.status_analise, name='status_analise'),
     path('analises/<uuid:analise_id>/microscopica/', views.upload_imagem_microscopica, name='upload_microscopica'),
+    path('analises/<uuid:analise_id>/microscopica/lote/', views.upload_lote_microscopica, name='upload_lote_microscopica'),
+    path('analises/<uuid:analise_id>/recortes/', views.download_recortes_analise, name='download-recortes-analise'),
     path('analises/<uuid:analise_id>/colonia/', views.upload_imagem_colonia, name='upload_colonia'),
+    path('analises/<uuid:analise_id>/uploads/', views.iniciar_upload_fragmentado, name='iniciar-upload-fragmentado'),
+    path('uploads/<uuid:upload_id>/', views.upload_fragmentado, name='upload-fragmentado'),
     path('analises/<int:imagem_id>/status/', views.status_processamento, name='status-processamento'),
+    path('analises/<int:imagem_id>/progresso/', views.progresso_processamento, name='progresso-processamento'),
+    path('analises/<int:imagem_id>/progresso/stream/', views.stream_progresso, name='stream-progresso'),
+    path('analises/<int:imagem_id>/recortes/', views.download_recortes_imagem, name='download-recortes-imagem'),
     path('analises/<int:imagem_id>/levedura_segmentada/', views.estatisticas_caracteristicas, name='leveduras-processamento'),
+    path('analises/<int:imagem_id>/preview/', views.preview_imagem, name='preview-imagem'),
+    path('analises/<int:imagem_id>/mascara/', views.mascara_imagem, name='mascara-imagem'),
+    path('analises/<int:imagem_id>/overlay/', views.overlay_mascara, name='overlay-mascara'),
+    path('leveduras/<uuid:levedura_id>/recorte/', views.recorte_levedura, name='recorte-levedura'),
+    path('leveduras/exportar/', views.exportar_leveduras, name='exportar-leveduras'),
+    path('estatisticas/populacao/', views.estatisticas_populacao_leveduras, name='estatisticas-populacao'),
+    path('metricas/', views.metricas, name='metricas'),
+    path('modelos/estatisticas/', views.estatisticas_modelos_cellpose, name='estatisticas-modelos'),
+    path('cache/estatisticas/', views.estatisticas_cache_segmentacao, name='estatisticas-cache'),
+
+    # Mesmos endpoints em views assíncronas, para servidores ASGI
+    path('async/analises/<uuid:analise_id>/microscopica/', views_async.upload_imagem_microscopica, name='upload_microscopica-async'),
+    path('async/analises/<int:imagem_id>/status/', views_async.status_processamento, name='status-processamento-async'),
+    path('async/analises/<int:imagem_id>/progresso/', views_async.progresso_processamento, name='progresso-processamento-async'),
+    path('async/analises/<int:imagem_id>/progresso/stream/', views_async.stream_progresso, name='stream-progresso-async'),
+    path('async/analises/<int:imagem_id>/levedura_segmentada/', views_async.estatisticas_caracteristicas, name='leveduras-processamento-async'),
 ]
\ No newline at end of file
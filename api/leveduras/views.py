@@ -1,24 +1,82 @@
 import cv2, numpy as np, os
-from cellpose import models, core, io, plot
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from .models import AnaliseLevedura, ImagemMicroscopica, ImagemColonia, LeveduraSegmentada
+from django.conf import settings
+from .models import AnaliseLevedura, ImagemMicroscopica, ImagemColonia, LeveduraSegmentada, UploadFragmentado
 from .serializers import AnaliseLeveduraSerializer
-from django.core.files.base import ContentFile
-from django.utils import timezone
-import tempfile
+from .modelos_cellpose import usar_modelo
+from .fila import JobPerdido, configuracao_fila, enfileirar_apos_commit, fila_cheia, posicao_na_fila, tamanho_fila
+from .regioes import extrair_regioes
+from .cache_segmentacao import (
+    armazenar as armazenar_resultado, buscar as buscar_no_cache, cache_ativo, chave_cache,
+    estatisticas_cache, hash_arquivo
+)
+from .estatisticas import (
+    AGRUPAMENTOS, BINS_PADRAO, CAMPOS_ESTATISTICAS, CAMPOS_PADRAO as CAMPOS_ESTATISTICAS_PADRAO,
+    MAX_BINS, PERCENTIS_PADRAO, estatisticas_populacao
+)
+from .exportacao import (
+    FORMATOS_EXPORTACAO, FiltroInvalido, filtrar_leveduras, gerar_csv, gerar_parquet, gerar_zip_recortes,
+    parquet_disponivel
+)
+from .uploads import (
+    ConflitoFragmento, FragmentoInvalido, MODELOS_IMAGEM, cancelar_upload, configuracao_upload,
+    gravar_fragmento, iniciar_upload, interpretar_content_range
+)
+from .instrumentacao import (
+    Instrumentacao, encerrar_pico_rss, estatisticas_modelos, etapa, iniciar_pico_rss, metricas_prometheus,
+    registrar_instrumentacao
+)
+from .blocos import abrir_imagem_sob_demanda, remover_mascara_temporaria, segmentar_em_blocos, usar_blocos
+from .decodificacao import converter_cinza, decodificar_imagem, url_preview
+from .mascaras import (
+    carregar_mascara, configuracao_mascaras, gerar_overlay, mascara_referenciada, remover_mascara, salvar_mascara,
+    url_mascara
+)
+from .escala import ampliar_mascara, calcular_escala, comparar_mascaras, configuracao_escala, reduzir_imagem
+from .recortes import PacoteRecortes, armazenamento_recortes, codificar_recorte, ler_recorte, url_recorte, url_recorte_por_nome
+from .caracteristicas import (
+    AREA_MINIMA_PIXELS, COLUNAS_CARACTERISTICAS, MODOS_CARACTERISTICAS, caracteristicas_contorno, colunas_caracteristicas,
+    extrair_caracteristicas_mascara, modo_caracteristicas
+)
 from django.core.files import File
-import math
-# Cria um nome de arquivo único
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.utils import timezone
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import shutil
+import time
 import uuid
-from django.db.models import Avg, StdDev, Min, Max
-import threading
+import zipfile
+import mimetypes
+from django.db import transaction
+from django.db.models import Avg, StdDev, Min, Max, Count, Q
 
 MICRONS_PER_PIXEL = 0.035
 
+# Modelo e parâmetros de segmentação do Cellpose
+MODEL_TYPE = 'cyto'
+PARAMETROS_SEGMENTACAO = {
+    'channels': [0, 0],  # (canal_de_segmentacao, canal_do_nucleo)
+    'batch_size': 32,
+    'flow_threshold': 0.2,
+    'cellprob_threshold': 0.2,
+    'normalize': {'tile_norm_blocksize': 0},
+}
+
+# Marcos de progresso (0-100%) de um job
+PROGRESSO_INICIADO = 10
+PROGRESSO_CARREGADA = 20
+PROGRESSO_INFERENCIA = 30
+PROGRESSO_SEGMENTADA = 60
+PROGRESSO_RECORTES = 90
+PROGRESSO_GRAVACAO = 95
+
 @api_view(['POST'])
 def criar_analise(request):
     serializer = AnaliseLeveduraSerializer(data=request.data)
@@ -60,45 +118,362 @@ def upload_imagem_microscopica(request, analise_id):
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    try:
-        # Salva a imagem primeiro
-        imagem_micro = ImagemMicroscopica.objects.create(
-            analise=analise,
-            imagem=imagem,
-            status_processamento='pendente',
-            metadata={
-                'nome_arquivo': imagem.name,
-                'tamanho': imagem.size,
-                'tipo_conteudo': imagem.content_type,
-            }
+    modo = request.data.get('modo_caracteristicas', getattr(settings, 'LEVEDURAS_MODO_CARACTERISTICAS', 'mascara'))
+    if modo not in MODOS_CARACTERISTICAS:
+        return Response(
+            {'erro': f'modo_caracteristicas deve ser um de: {", ".join(MODOS_CARACTERISTICAS)}'}, 
+            status=status.HTTP_400_BAD_REQUEST
         )
+    
+    # Backpressure: recusa novos jobs enquanto a fila estiver cheia
+    if fila_cheia():
+        response = Response(
+            {'erro': 'Fila de processamento cheia, tente novamente mais tarde',
+             'tamanho_fila': tamanho_fila()},
+            status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+        response['Retry-After'] = str(configuracao_fila()['intervalo'] * 30)
+        return response
+    
+    try:
+        imagem_micro = criar_imagem_microscopica(analise, imagem, modo)
+        return Response(dados_upload_microscopica(imagem_micro), status=status.HTTP_202_ACCEPTED)
         
-        # Força o save para garantir que o arquivo seja escrito
-        imagem_micro.save()
-        
-        # Inicia o processamento em thread separada
-        import threading
-        thread = threading.Thread(
-            target=processar_em_background,
-            args=(str(imagem_micro.id),)
-        )
-        thread.daemon = True
-        thread.start()
-        
-        return Response({
+    except Exception as e:
+        return Response(
+            {'erro': f'Erro ao salvar imagem: {str(e)}'}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+
+def gravar_arquivo_microscopica(imagem):
+    """Grava o arquivo enviado no storage das imagens microscópicas; retorna o nome gravado"""
+    campo = ImagemMicroscopica._meta.get_field('imagem')
+    return campo.storage.save(campo.generate_filename(None, imagem.name), imagem, max_length=campo.max_length)
+
+def criar_imagem_microscopica(analise, imagem, modo, nome=None):
+    """
+    Salva a imagem; o job fica 'pendente' até um worker reivindicá-lo. 'nome' é o
+    arquivo já gravado por gravar_arquivo_microscopica (a view assíncrona grava o
+    arquivo fora da thread do ORM); sem ele o arquivo é gravado aqui.
+    """
+    if nome is None:
+        nome = gravar_arquivo_microscopica(imagem)
+    try:
+        with transaction.atomic():
+            imagem_micro = ImagemMicroscopica.objects.create(
+                analise=analise,
+                imagem=nome,
+                status_processamento='pendente',
+                metadata={
+                    'nome_arquivo': imagem.name,
+                    'tamanho': imagem.size,
+                    'tipo_conteudo': imagem.content_type,
+                    'modo_caracteristicas': modo,
+                }
+            )
+            enfileirar_apos_commit()
+    except Exception:
+        ImagemMicroscopica._meta.get_field('imagem').storage.delete(nome)
+        raise
+    return imagem_micro
+
+def dados_upload_microscopica(imagem_micro):
+    return {
+        'id': str(imagem_micro.id),
+        'mensagem': 'Imagem recebida e na fila de processamento',
+        'analise_id': str(imagem_micro.analise_id),
+        'status': 'pendente',
+        'posicao_fila': posicao_na_fila(imagem_micro),
+        'url_imagem': imagem_micro.imagem.url,
+        'url_preview': url_preview(imagem_micro),
+        'endpoint_status': f'/api/analises/{imagem_micro.id}/status/'
+    }
+
+@api_view(['POST'])
+def upload_lote_microscopica(request, analise_id):
+    """
+    Recebe várias imagens microscópicas (campo 'imagens' repetido e/ou um 'arquivo_zip')
+    e as enfileira como um lote, segmentado pelo Cellpose numa única chamada
+    """
+    analise = get_object_or_404(AnaliseLevedura, id=analise_id)
+    
+    arquivos = [
+        imagem for imagem in request.FILES.getlist('imagens')
+        if imagem.content_type.startswith('image/')
+    ]
+    
+    extraidas = []
+    if 'arquivo_zip' in request.FILES:
+        try:
+            extraidas = extrair_imagens_zip(request.FILES['arquivo_zip'])
+        except zipfile.BadZipFile:
+            return Response(
+                {'erro': 'Arquivo zip inválido'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        except LoteZipInvalido as e:
+            return Response(
+                {'erro': str(e)}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+    
+    try:
+        return enfileirar_lote_microscopica(analise, arquivos + extraidas, request.data)
+    finally:
+        # Remove os temporários das imagens extraídas (os já gravados foram movidos para o storage)
+        for imagem in extraidas:
+            imagem.close()
+
+def enfileirar_lote_microscopica(analise, arquivos, dados):
+    """Valida e enfileira as imagens do lote; 'dados' são os campos do formulário"""
+    if not arquivos:
+        return Response(
+            {'erro': 'Nenhuma imagem fornecida'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    max_imagens = getattr(settings, 'LEVEDURAS_LOTE_MAX_IMAGENS', 384)
+    if len(arquivos) > max_imagens:
+        return Response(
+            {'erro': f'O lote aceita no máximo {max_imagens} imagens'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    modo = dados.get('modo_caracteristicas', getattr(settings, 'LEVEDURAS_MODO_CARACTERISTICAS', 'mascara'))
+    if modo not in MODOS_CARACTERISTICAS:
+        return Response(
+            {'erro': f'modo_caracteristicas deve ser um de: {", ".join(MODOS_CARACTERISTICAS)}'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    # Backpressure: o lote inteiro precisa caber na fila
+    if fila_cheia(len(arquivos)):
+        response = Response(
+            {'erro': 'Fila de processamento cheia, tente novamente mais tarde',
+             'tamanho_fila': tamanho_fila()},
+            status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+        response['Retry-After'] = str(configuracao_fila()['intervalo'] * 30)
+        return response
+    
+    lote = uuid.uuid4().hex
+    try:
+        with transaction.atomic():
+            imagens_micro = [
+                ImagemMicroscopica.objects.create(
+                    analise=analise,
+                    imagem=imagem,
+                    status_processamento='pendente',
+                    metadata={
+                        'nome_arquivo': imagem.name,
+                        'tamanho': imagem.size,
+                        'tipo_conteudo': getattr(imagem, 'content_type', None),
+                        'modo_caracteristicas': modo,
+                        'lote': lote,
+                    }
+                )
+                for imagem in arquivos
+            ]
+            enfileirar_apos_commit(len(imagens_micro))
+    except Exception as e:
+        return Response(
+            {'erro': f'Erro ao salvar imagens: {str(e)}'}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+    
+    return Response({
+        'lote': lote,
+        'mensagem': f'{len(imagens_micro)} imagens recebidas e na fila de processamento',
+        'analise_id': str(analise.id),
+        'posicao_fila': posicao_na_fila(imagens_micro[0]),
+        'imagens': [
+            {
+                'id': str(imagem_micro.id),
+                'nome_arquivo': imagem_micro.metadata['nome_arquivo'],
+                'status': 'pendente',
+                'url_imagem': imagem_micro.imagem.url,
+                'url_preview': url_preview(imagem_micro),
+                'endpoint_status': f'/api/analises/{imagem_micro.id}/status/'
+            }
+            for imagem_micro in imagens_micro
+        ]
+    }, status=status.HTTP_202_ACCEPTED)
+
+class LoteZipInvalido(ValueError):
+    pass
+
+def extrair_imagens_zip(arquivo_zip):
+    """
+    Extrai as imagens contidas num arquivo zip enviado no upload para arquivos
+    temporários, em stream, sem carregar nenhum membro inteiro na memória.
+
+    Os tamanhos declarados no zip são conferidos antes de qualquer extração:
+    LEVEDURAS_LOTE_ZIP_MAX_MEMBRO limita cada imagem e LEVEDURAS_LOTE_ZIP_MAX_TOTAL
+    a soma (LoteZipInvalido). O zipfile não lê além do tamanho declarado de um membro.
+    """
+    max_membro = getattr(settings, 'LEVEDURAS_LOTE_ZIP_MAX_MEMBRO', 512 * 1024 ** 2)
+    max_total = getattr(settings, 'LEVEDURAS_LOTE_ZIP_MAX_TOTAL', 4 * 1024 ** 3)
+    imagens = []
+    with zipfile.ZipFile(arquivo_zip) as zf:
+        membros = []
+        total = 0
+        for info in zf.infolist():
+            nome = os.path.basename(info.filename)
+            if info.is_dir() or nome.startswith('.'):
+                continue
+            content_type = mimetypes.guess_type(nome)[0] or ''
+            if not content_type.startswith('image/'):
+                continue
+            if info.file_size > max_membro:
+                raise LoteZipInvalido(f'{nome} excede o tamanho máximo de {max_membro} bytes por imagem')
+            total += info.file_size
+            if total > max_total:
+                raise LoteZipInvalido(f'As imagens do zip excedem o total de {max_total} bytes')
+            membros.append((info, nome, content_type))
+
+        try:
+            for info, nome, content_type in membros:
+                # Temporário em disco: o storage move o arquivo em vez de copiá-lo
+                imagem = TemporaryUploadedFile(nome, content_type, info.file_size, None)
+                imagens.append(imagem)
+                with zf.open(info) as membro:
+                    shutil.copyfileobj(membro, imagem, 1024 * 1024)
+                imagem.seek(0)
+        except Exception:
+            for imagem in imagens:
+                imagem.close()
+            raise
+    return imagens
+
+def dados_upload_fragmentado(upload):
+    """Estado de um upload fragmentado; o cliente retoma a partir de 'recebido'"""
+    dados = {
+        'id': str(upload.id),
+        'tipo': upload.tipo,
+        'nome_arquivo': upload.nome_arquivo,
+        'status': upload.status,
+        'tamanho': upload.tamanho,
+        'recebido': upload.recebido,
+        'tamanho_fragmento': configuracao_upload()['tamanho_fragmento'],
+        'fragmentos': upload.fragmentos,
+        'endpoint_upload': f'/api/uploads/{upload.id}/',
+    }
+    if upload.imagem_microscopica_id is not None:
+        imagem_micro = upload.imagem_microscopica
+        dados['imagem'] = {
             'id': str(imagem_micro.id),
-            'mensagem': 'Imagem recebida e em processamento',
-            'analise_id': str(analise_id),
-            'status': 'pendente',
+            'status': imagem_micro.status_processamento,
+            'posicao_fila': posicao_na_fila(imagem_micro),
             'url_imagem': imagem_micro.imagem.url,
+            'url_preview': url_preview(imagem_micro),
             'endpoint_status': f'/api/analises/{imagem_micro.id}/status/'
-        }, status=status.HTTP_202_ACCEPTED)
+        }
+    elif upload.imagem_colonia_id is not None:
+        dados['imagem'] = {
+            'id': str(upload.imagem_colonia_id),
+            'url_imagem': upload.imagem_colonia.imagem.url,
+        }
+    return dados
+
+@api_view(['POST'])
+def iniciar_upload_fragmentado(request, analise_id):
+    """
+    Inicia um upload retomável de uma imagem grande. Corpo: nome_arquivo, tamanho
+    (bytes), tipo ('microscopica' ou 'colonia') e, opcionalmente, tipo_conteudo e
+    modo_caracteristicas. Os fragmentos seguem por PUT em /api/uploads/<id>/.
+    """
+    analise = get_object_or_404(AnaliseLevedura, id=analise_id)
+    
+    nome_arquivo = request.data.get('nome_arquivo')
+    tipo = request.data.get('tipo', 'microscopica')
+    if not nome_arquivo:
+        return Response(
+            {'erro': 'nome_arquivo é obrigatório'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if tipo not in MODELOS_IMAGEM:
+        return Response(
+            {'erro': f'tipo deve ser um de: {", ".join(MODELOS_IMAGEM)}'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    tamanho_maximo = configuracao_upload()['tamanho_maximo']
+    try:
+        tamanho = int(request.data.get('tamanho'))
+    except (TypeError, ValueError):
+        tamanho = 0
+    if not 0 < tamanho <= tamanho_maximo:
+        return Response(
+            {'erro': f'tamanho deve estar entre 1 e {tamanho_maximo} bytes'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    tipo_conteudo = request.data.get('tipo_conteudo') or mimetypes.guess_type(nome_arquivo)[0] or ''
+    if not tipo_conteudo.startswith('image/'):
+        return Response(
+            {'erro': 'Arquivo não é uma imagem válida'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    modo = ''
+    if tipo == 'microscopica':
+        modo = request.data.get('modo_caracteristicas', getattr(settings, 'LEVEDURAS_MODO_CARACTERISTICAS', 'mascara'))
+        if modo not in MODOS_CARACTERISTICAS:
+            return Response(
+                {'erro': f'modo_caracteristicas deve ser um de: {", ".join(MODOS_CARACTERISTICAS)}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-    except Exception as e:
+        # Backpressure antes de aceitar o envio: o job entra na fila com o último fragmento
+        if fila_cheia():
+            response = Response(
+                {'erro': 'Fila de processamento cheia, tente novamente mais tarde',
+                 'tamanho_fila': tamanho_fila()},
+                status=status.HTTP_429_TOO_MANY_REQUESTS
+            )
+            response['Retry-After'] = str(configuracao_fila()['intervalo'] * 30)
+            return response
+    
+    upload = iniciar_upload(analise, tipo, nome_arquivo, tipo_conteudo, tamanho, modo)
+    return Response(dados_upload_fragmentado(upload), status=status.HTTP_201_CREATED)
+
+@api_view(['GET', 'PUT', 'DELETE'])
+def upload_fragmentado(request, upload_id):
+    """
+    GET: estado do upload (offset em 'recebido'). PUT: próximo fragmento, com o corpo
+    bruto, Content-Range 'bytes inicio-fim/total' e, opcionalmente, X-Chunk-SHA256.
+    DELETE: cancela o upload e remove o arquivo parcial.
+    """
+    upload = get_object_or_404(UploadFragmentado, id=upload_id)
+    
+    if request.method == 'GET':
+        return Response(dados_upload_fragmentado(upload))
+    
+    if request.method == 'DELETE':
+        cancelar_upload(upload)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    
+    try:
+        inicio, fim = interpretar_content_range(request.headers.get('Content-Range'), upload.tamanho)
+        # O corpo é lido direto do stream da requisição, sem passar pelos parsers do DRF
+        upload = gravar_fragmento(
+            upload.id, request.stream, inicio, fim, request.headers.get('X-Chunk-SHA256')
+        )
+    except FragmentoInvalido as e:
+        upload.refresh_from_db()
         return Response(
-            {'erro': f'Erro ao salvar imagem: {str(e)}'}, 
-            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            {'erro': str(e), **dados_upload_fragmentado(upload)}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    except ConflitoFragmento as e:
+        return Response(
+            {'erro': str(e), **dados_upload_fragmentado(e.upload)}, 
+            status=status.HTTP_409_CONFLICT
         )
+    
+    if upload.status == 'concluido':
+        return Response(dados_upload_fragmentado(upload), status=status.HTTP_201_CREATED)
+    return Response(dados_upload_fragmentado(upload))
 
 def processar_em_background(imagem_micro_id):
     """Processa a segmentação em background"""
@@ -108,45 +483,245 @@ def processar_em_background(imagem_micro_id):
         imagem_micro = ImagemMicroscopica.objects.get(id=imagem_micro_id)
         imagem_micro.status_processamento = 'processando'
         imagem_micro.iniciado_em = timezone.now()
-        imagem_micro.progresso = 10
-        imagem_micro.save()
-        
-        # Aguarda um pouco para garantir que o arquivo foi salvo
-        import time
-        time.sleep(2)
+        imagem_micro.progresso = PROGRESSO_INICIADO
+        imagem_micro.save(update_fields=['status_processamento', 'iniciado_em', 'progresso'])
         
-        # Verifica novamente se o arquivo existe
+        # O job só é enfileirado após o commit do upload, então o arquivo já está gravado
         if not imagem_micro.imagem or not hasattr(imagem_micro.imagem, 'path'):
             raise ValueError("Arquivo de imagem não disponível para processamento")
         
-        # Processa a segmentação
+        # Processa a segmentação (o status vai para concluído junto com a gravação das leveduras)
         leveduras_segmentadas = processar_segmentacao(
             imagem_micro, 
             imagem_micro.analise
         )
         
-        # Atualiza status para concluído
-        imagem_micro.status_processamento = 'concluido'
-        imagem_micro.progresso = 100
-        imagem_micro.concluido_em = timezone.now()
-        imagem_micro.save()
-        
         print(f"Processamento concluído para {imagem_micro_id}")
         return leveduras_segmentadas
         
+    except JobPerdido as e:
+        # O job pertence a outro worker agora; o status é dele
+        print(f"Resultado descartado: {str(e)}")
     except Exception as e:
-        imagem_micro = ImagemMicroscopica.objects.get(id=imagem_micro_id)
-        imagem_micro.status_processamento = 'erro'
-        imagem_micro.erro_processamento = str(e)
-        imagem_micro.save()
+        # Só marca o erro se o job ainda for deste worker
+        carregada = locals().get('imagem_micro')
+        ImagemMicroscopica.objects.filter(
+            id=imagem_micro_id, task_id=carregada.task_id if carregada else None
+        ).update(status_processamento='erro', erro_processamento=str(e))
         print(f"Erro no processamento: {str(e)}")
         raise e
 
+def processar_lote_em_background(imagens_micro_ids):
+    """Processa em background um lote de imagens com uma única inferência do Cellpose"""
+    imagens_micro = list(
+        ImagemMicroscopica.objects.select_related('analise').filter(id__in=imagens_micro_ids)
+    )
+    for imagem_micro in imagens_micro:
+        imagem_micro.status_processamento = 'processando'
+        imagem_micro.iniciado_em = timezone.now()
+        imagem_micro.progresso = PROGRESSO_INICIADO
+        imagem_micro.save(update_fields=['status_processamento', 'iniciado_em', 'progresso'])
+    
+    try:
+        resultados = processar_lote_segmentacao(imagens_micro)
+    except Exception as e:
+        # Erro inesperado fora da inferência: só as imagens ainda não concluídas ficam com erro
+        concluidas = set(
+            ImagemMicroscopica.objects
+            .filter(id__in=imagens_micro_ids, status_processamento='concluido')
+            .values_list('id', flat=True)
+        )
+        resultados = {imagem_micro.id: e for imagem_micro in imagens_micro if imagem_micro.id not in concluidas}
+    
+    for imagem_micro in imagens_micro:
+        resultado = resultados.get(imagem_micro.id)
+        if isinstance(resultado, JobPerdido):
+            print(f"Resultado descartado: {str(resultado)}")
+        elif isinstance(resultado, Exception):
+            ImagemMicroscopica.objects.filter(id=imagem_micro.id, task_id=imagem_micro.task_id).update(
+                status_processamento='erro',
+                erro_processamento=str(resultado)
+            )
+            print(f"Erro no processamento de {imagem_micro.id}: {str(resultado)}")
+        else:
+            print(f"Processamento concluído para {imagem_micro.id}")
+    
+    return resultados
+
+# Campos que podem ser pedidos em ?campos= na listagem de leveduras, e as colunas que cada um lê
+CAMPOS_LEVEDURA = {
+    'id': ['id'],
+    'levedura_id': ['levedura_id'],
+    'url_imagem': ['id', 'imagem'],
+    'bounding_box': ['bounding_box'],
+    'area_pixels': ['bounding_box'],
+    'caracteristicas': ['caracteristicas'],
+    'caracteristicas_formatadas': ['caracteristicas'],
+    'diametro_equivalente': ['diametro_equivalente'],
+    'circularidade': ['circularidade'],
+    'solidez': ['solidez'],
+    'relacao_aspecto': ['relacao_aspecto'],
+    'area_microns': ['area_microns'],
+    'perimetro_microns': ['perimetro_microns'],
+    'eixo_maior_microns': ['eixo_maior_microns'],
+    'eixo_menor_microns': ['eixo_menor_microns'],
+    'angulacao_graus': ['angulacao_graus'],
+    'centroide_x': ['centroide_x'],
+    'centroide_y': ['centroide_y'],
+    'metadata': ['metadata'],
+}
+
+# Campos devolvidos quando ?campos= não é informado (as demais colunas já vêm em 'caracteristicas')
+CAMPOS_PADRAO = [
+    'id', 'levedura_id', 'url_imagem', 'bounding_box', 'area_pixels', 'caracteristicas',
+    'caracteristicas_formatadas', 'diametro_equivalente', 'circularidade', 'solidez',
+    'relacao_aspecto', 'area_microns', 'metadata',
+]
+
+def formatar_caracteristicas(caracteristicas):
+    """Características em formato legível"""
+    if not caracteristicas:
+        return {nome: "N/A" for nome in [
+            'Área', 'Perímetro', 'Circularidade', 'Solidez', 'Diâmetro Equivalente', 'Eixo Maior',
+            'Eixo Menor', 'Relação de Aspecto', 'Ângulo do Eixo Principal', 'Centroide'
+        ]}
+    
+    return {
+        'Área': f"{caracteristicas.get('area_microns', 0):.2f} µm²",
+        'Perímetro': f"{caracteristicas.get('perimetro_microns', 0):.2f} µm",
+        'Circularidade': f"{caracteristicas.get('circularidade', 0):.3f}",
+        'Solidez': f"{caracteristicas.get('solidez', 0):.3f}",
+        'Diâmetro Equivalente': f"{caracteristicas.get('diametro_equivalente_microns', 0):.2f} µm",
+        'Eixo Maior': f"{caracteristicas.get('eixo_maior_microns', 0):.2f} µm",
+        'Eixo Menor': f"{caracteristicas.get('eixo_menor_microns', 0):.2f} µm",
+        'Relação de Aspecto': f"{caracteristicas.get('relacao_aspecto', 0):.2f}",
+        'Ângulo do Eixo Principal': f"{caracteristicas.get('angulacao_graus', 0):.1f}°",
+        'Centroide': f"({caracteristicas.get('centroide_x', 0)}, {caracteristicas.get('centroide_y', 0)})"
+    }
+
+def serializar_levedura(valores, campos):
+    """Monta a representação de uma levedura a partir das colunas lidas com values()"""
+    item = {}
+    for campo in campos:
+        if campo == 'id':
+            item['id'] = str(valores['id'])
+        elif campo == 'url_imagem':
+            item['url_imagem'] = url_recorte_por_nome(valores['id'], valores['imagem'])
+        elif campo == 'area_pixels':
+            item['area_pixels'] = valores['bounding_box']['width'] * valores['bounding_box']['height']
+        elif campo == 'caracteristicas':
+            item['caracteristicas'] = valores['caracteristicas'] or {}
+        elif campo == 'caracteristicas_formatadas':
+            item['caracteristicas_formatadas'] = formatar_caracteristicas(valores['caracteristicas'])
+        else:
+            item[campo] = valores[campo]
+    return item
+
+def calcular_resumo(leveduras):
+    """
+    Estatísticas gerais das leveduras de uma imagem, calculadas uma única vez
+    quando o processamento termina
+    """
+    resumo = {'total_leveduras': len(leveduras)}
+    if not leveduras:
+        return resumo
+    
+    com_caract = [levedura for levedura in leveduras if levedura.caracteristicas]
+    
+    def media(campo):
+        valores = [getattr(levedura, campo) for levedura in com_caract if getattr(levedura, campo) is not None]
+        return sum(valores) / len(valores) if valores else None
+    
+    resumo['estatisticas_gerais'] = {
+        'leveduras_com_caracteristicas': len(com_caract),
+        'taxa_sucesso_caracteristicas': f"{(len(com_caract) / len(leveduras)) * 100:.1f}%",
+        'media_area_microns': media('area_microns'),
+        'media_circularidade': media('circularidade'),
+        'media_relacao_aspecto': media('relacao_aspecto')
+    }
+    return resumo
+
+def obter_resumo(imagem_micro):
+    """
+    Resumo gravado na conclusão do job; para imagens antigas, calcula com uma única
+    consulta agregada e guarda o resultado
+    """
+    if imagem_micro.resumo is not None:
+        return imagem_micro.resumo
+    
+    sem_caract = Q(caracteristicas={})
+    agregados = imagem_micro.leveduras_segmentadas.aggregate(
+        total=Count('id'),
+        com_caract=Count('id', filter=~sem_caract),
+        media_area_microns=Avg('area_microns', filter=~sem_caract),
+        media_circularidade=Avg('circularidade', filter=~sem_caract),
+        media_relacao_aspecto=Avg('relacao_aspecto', filter=~sem_caract),
+    )
+    
+    resumo = {'total_leveduras': agregados['total']}
+    if agregados['total']:
+        resumo['estatisticas_gerais'] = {
+            'leveduras_com_caracteristicas': agregados['com_caract'],
+            'taxa_sucesso_caracteristicas': f"{(agregados['com_caract'] / agregados['total']) * 100:.1f}%",
+            'media_area_microns': agregados['media_area_microns'],
+            'media_circularidade': agregados['media_circularidade'],
+            'media_relacao_aspecto': agregados['media_relacao_aspecto']
+        }
+    
+    ImagemMicroscopica.objects.filter(id=imagem_micro.id).update(resumo=resumo)
+    return resumo
+
+class ParametroInvalido(ValueError):
+    pass
+
+def parametros_listagem(parametros):
+    """(limite, cursor, campos) da listagem de leveduras; ParametroInvalido traz o corpo do erro"""
+    try:
+        limite = min(int(parametros.get('limite', 100)), 1000)
+        cursor = int(parametros.get('cursor', 0))
+    except ValueError:
+        raise ParametroInvalido({'erro': 'limite e cursor devem ser inteiros'})
+    
+    campos = list(CAMPOS_PADRAO)
+    if parametros.get('campos'):
+        campos = [campo.strip() for campo in parametros['campos'].split(',') if campo.strip()]
+        invalidos = [campo for campo in campos if campo not in CAMPOS_LEVEDURA]
+        if invalidos:
+            raise ParametroInvalido({
+                'erro': f'Campos inválidos: {", ".join(invalidos)}',
+                'campos_disponiveis': list(CAMPOS_LEVEDURA)
+            })
+    return limite, cursor, campos
+
+def pagina_leveduras(imagem_id, limite, cursor, campos):
+    """Apenas as colunas necessárias para os campos pedidos, uma página (mais uma linha) por vez"""
+    colunas = {'levedura_id'} | {coluna for campo in campos for coluna in CAMPOS_LEVEDURA[campo]}
+    return (
+        LeveduraSegmentada.objects
+        .filter(imagem_original_id=imagem_id, levedura_id__gt=cursor)
+        .order_by('levedura_id')
+        .values(*colunas)[:limite + 1]
+    )
+
 @api_view(['GET'])
 def status_processamento(request, imagem_id):
-    """Endpoint para verificar status do processamento"""
+    """
+    Endpoint para verificar status do processamento
+
+    Parâmetros opcionais da listagem de leveduras:
+    - limite: leveduras por página (padrão 100, 0 omite a listagem)
+    - cursor: levedura_id a partir do qual continuar (valor de 'proximo_cursor')
+    - campos: lista separada por vírgulas dos campos de cada levedura
+
+    A resposta traz um ETag; com If-None-Match igual ao ETag atual devolve 304.
+    """
     imagem_micro = get_object_or_404(ImagemMicroscopica, id=imagem_id)
     
+    posicao_fila = posicao_na_fila(imagem_micro)
+    etag = etag_status(imagem_micro, request.META.get('QUERY_STRING', ''), posicao_fila)
+    if etag_confere(request, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    
     response_data = {
         'id': str(imagem_micro.id),
         'status': imagem_micro.status_processamento,
@@ -154,235 +729,735 @@ def status_processamento(request, imagem_id):
         'criado_em': imagem_micro.criado_em,
         'iniciado_em': imagem_micro.iniciado_em,
         'concluido_em': imagem_micro.concluido_em,
+        'url_preview': url_preview(imagem_micro),
     }
     
+    if imagem_micro.status_processamento == 'pendente':
+        response_data['posicao_fila'] = posicao_fila
+    
     if imagem_micro.status_processamento == 'concluido':
-        leveduras = imagem_micro.leveduras_segmentadas.all()
-        response_data['total_leveduras'] = leveduras.count()
-        response_data['leveduras_segmentadas'] = [
-            {
-                'id': str(lev.id),
-                'levedura_id': lev.levedura_id,
-                'url_imagem': lev.imagem.url,
-                'bounding_box': lev.bounding_box,
-                'area_pixels': lev.bounding_box['width'] * lev.bounding_box['height'],
-                # Características extraídas
-                'caracteristicas': lev.caracteristicas if lev.caracteristicas else {},
-                'caracteristicas_formatadas': {
-                    'Área': f"{lev.caracteristicas.get('area_microns', 0):.2f} µm²" if lev.caracteristicas else "N/A",
-                    'Perímetro': f"{lev.caracteristicas.get('perimetro_microns', 0):.2f} µm" if lev.caracteristicas else "N/A",
-                    'Circularidade': f"{lev.caracteristicas.get('circularidade', 0):.3f}" if lev.caracteristicas else "N/A",
-                    'Solidez': f"{lev.caracteristicas.get('solidez', 0):.3f}" if lev.caracteristicas else "N/A",
-                    'Diâmetro Equivalente': f"{lev.caracteristicas.get('diametro_equivalente_microns', 0):.2f} µm" if lev.caracteristicas else "N/A",
-                    'Eixo Maior': f"{lev.caracteristicas.get('eixo_maior_microns', 0):.2f} µm" if lev.caracteristicas else "N/A",
-                    'Eixo Menor': f"{lev.caracteristicas.get('eixo_menor_microns', 0):.2f} µm" if lev.caracteristicas else "N/A",
-                    'Relação de Aspecto': f"{lev.caracteristicas.get('relacao_aspecto', 0):.2f}" if lev.caracteristicas else "N/A",
-                    'Ângulo do Eixo Principal': f"{lev.caracteristicas.get('angulacao_graus', 0):.1f}°" if lev.caracteristicas else "N/A",
-                    'Centroide': f"({lev.caracteristicas.get('centroide_x', 0)}, {lev.caracteristicas.get('centroide_y', 0)})" if lev.caracteristicas else "N/A"
-                },
-                # Campos individuais para facilitar filtros
-                'diametro_equivalente': lev.diametro_equivalente,
-                'circularidade': lev.circularidade,
-                'solidez': lev.solidez,
-                'relacao_aspecto': lev.relacao_aspecto,
-                'area_microns': lev.area_microns,
-                'metadata': lev.metadata
-            }
-            for lev in leveduras
-        ]
+        try:
+            limite, cursor, campos = parametros_listagem(request.query_params)
+        except ParametroInvalido as e:
+            return Response(e.args[0], status=status.HTTP_400_BAD_REQUEST)
         
-        # Adiciona estatísticas gerais se houver leveduras
-        if leveduras.exists():
-            leveduras_com_caract = leveduras.exclude(caracteristicas={})
-            response_data['estatisticas_gerais'] = {
-                'leveduras_com_caracteristicas': leveduras_com_caract.count(),
-                'taxa_sucesso_caracteristicas': f"{(leveduras_com_caract.count() / leveduras.count()) * 100:.1f}%",
-                'media_area_microns': leveduras_com_caract.aggregate(Avg('area_microns'))['area_microns__avg'],
-                'media_circularidade': leveduras_com_caract.aggregate(Avg('circularidade'))['circularidade__avg'],
-                'media_relacao_aspecto': leveduras_com_caract.aggregate(Avg('relacao_aspecto'))['relacao_aspecto__avg']
-            }
+        resumo = obter_resumo(imagem_micro)
+        response_data['total_leveduras'] = resumo['total_leveduras']
+        if 'estatisticas_gerais' in resumo:
+            response_data['estatisticas_gerais'] = resumo['estatisticas_gerais']
+        response_data['url_mascara'] = url_mascara(imagem_micro)
+        
+        if limite > 0:
+            pagina = list(pagina_leveduras(imagem_micro.id, limite, cursor, campos))
+            tem_proxima = len(pagina) > limite
+            pagina = pagina[:limite]
+            
+            response_data['leveduras_segmentadas'] = [serializar_levedura(valores, campos) for valores in pagina]
+            response_data['proximo_cursor'] = pagina[-1]['levedura_id'] if tem_proxima else None
         
     elif imagem_micro.status_processamento == 'erro':
         response_data['erro'] = imagem_micro.erro_processamento
     
-    return Response(response_data)
+    return Response(response_data, headers={'ETag': etag})
 
-def processar_segmentacao(imagem_micro, analise):
+# Limites da espera no long-poll e no stream de progresso (segundos)
+ESPERA_MAXIMA_PROGRESSO = 30
+# Na view síncrona cada cliente esperando prende um worker WSGI: esperas longas só em /api/async/
+ESPERA_MAXIMA_PROGRESSO_SINCRONA = 2
+DURACAO_MAXIMA_STREAM = 300
+INTERVALO_CONSULTA_PROGRESSO = 0.5
+
+def etag_status(imagem_micro, consulta='', posicao_fila=None):
     """
-    Processa a segmentação da imagem e retorna as leveduras encontradas
+    ETag da resposta de status: muda com status, progresso, conclusão, características
+    recalculadas, posição na fila (jobs pendentes) e parâmetros pedidos
+    """
+    concluido_em = imagem_micro.concluido_em.timestamp() if imagem_micro.concluido_em else ''
+    atualizado_em = imagem_micro.atualizado_em.timestamp() if imagem_micro.atualizado_em else ''
+    chave = (
+        f"{imagem_micro.status_processamento}:{imagem_micro.progresso}:{concluido_em}:{atualizado_em}:"
+        f"{posicao_fila or ''}:{consulta}"
+    )
+    return f'"{hashlib.md5(chave.encode()).hexdigest()}"'
+
+def etag_progresso(estado):
+    return f'"{estado["status_processamento"]}-{estado["progresso"]}"'
+
+def etag_confere(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return etag in [valor.strip() for valor in if_none_match.split(',')]
+
+def consultar_progresso(imagem_id):
+    """Lê apenas as colunas de status e progresso da imagem"""
+    return (
+        ImagemMicroscopica.objects
+        .filter(id=imagem_id)
+        .values('status_processamento', 'progresso')
+        .first()
+    )
+
+def formatar_progresso(estado):
+    return {'status': estado['status_processamento'], 'progresso': estado['progresso']}
+
+@api_view(['GET'])
+def progresso_processamento(request, imagem_id):
+    """
+    Consulta leve de status e progresso, para polling frequente.
+
+    Com If-None-Match igual ao ETag atual devolve 304. Com ?aguardar=N (segundos,
+    até ESPERA_MAXIMA_PROGRESSO_SINCRONA) a resposta espera o progresso mudar antes
+    de responder; o long-poll de até 30 s fica em /api/async/analises/<id>/progresso/.
     """
+    estado = consultar_progresso(imagem_id)
+    if estado is None:
+        return Response({'erro': 'Imagem não encontrada'}, status=status.HTTP_404_NOT_FOUND)
+    
     try:
-        # Verifica se o arquivo de imagem está associado
-        if not imagem_micro.imagem:
-            raise ValueError("Nenhuma imagem associada ao objeto ImagemMicroscopica")
-        
-        if not hasattr(imagem_micro.imagem, 'path') or not imagem_micro.imagem.path:
-            raise ValueError("Arquivo de imagem não encontrado no sistema de arquivos")
-        
-        # 1. Carrega e prepara a imagem
-        img_path = imagem_micro.imagem.path
-        img = io.imread(img_path)
-        print(f"Shape da imagem original: {img.shape}")
+        aguardar = min(float(request.query_params.get('aguardar', 0)), ESPERA_MAXIMA_PROGRESSO_SINCRONA)
+    except ValueError:
+        return Response({'erro': 'aguardar deve ser um número'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    etag = etag_progresso(estado)
+    limite = time.monotonic() + aguardar
+    while etag_confere(request, etag) and time.monotonic() < limite:
+        time.sleep(INTERVALO_CONSULTA_PROGRESSO)
+        estado = consultar_progresso(imagem_id)
+        if estado is None:
+            return Response({'erro': 'Imagem não encontrada'}, status=status.HTTP_404_NOT_FOUND)
+        etag = etag_progresso(estado)
+    
+    if etag_confere(request, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(formatar_progresso(estado), headers={'ETag': etag})
+
+def eventos_progresso(imagem_id):
+    """Gera um evento SSE a cada mudança de progresso, até o job terminar"""
+    ultimo_etag = None
+    ultimo_envio = time.monotonic()
+    limite = ultimo_envio + DURACAO_MAXIMA_STREAM
+    while time.monotonic() < limite:
+        estado = consultar_progresso(imagem_id)
+        if estado is None:
+            yield "event: erro\ndata: {\"erro\": \"Imagem não encontrada\"}\n\n"
+            return
         
-        # Converte para escala de cinza se necessário
-        if len(img.shape) == 3:
-            img_gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        else:
-            img_gray = img
+        etag = etag_progresso(estado)
+        if etag != ultimo_etag:
+            ultimo_etag = etag
+            ultimo_envio = time.monotonic()
+            dados = json.dumps(formatar_progresso(estado))
+            yield f"id: {estado['status_processamento']}-{estado['progresso']}\ndata: {dados}\n\n"
+            if estado['status_processamento'] in ('concluido', 'erro'):
+                return
+        elif time.monotonic() - ultimo_envio > 15:
+            # Comentário SSE para manter a conexão viva através de proxies
+            ultimo_envio = time.monotonic()
+            yield ": aguardando\n\n"
+        time.sleep(INTERVALO_CONSULTA_PROGRESSO)
+
+def stream_progresso(request, imagem_id):
+    """
+    Stream de progresso em Server-Sent Events (text/event-stream). View Django
+    simples: a negociação de conteúdo do DRF não aceita text/event-stream.
+    """
+    if request.method != 'GET':
+        return HttpResponse(status=405)
+    get_object_or_404(ImagemMicroscopica.objects.only('id'), id=imagem_id)
+    
+    response = StreamingHttpResponse(eventos_progresso(imagem_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def carregar_imagem_micro(imagem_micro):
+    """
+    Valida e carrega a imagem; retorna (img, em_blocos). Imagens segmentadas em
+    blocos são lidas sob demanda quando o formato permite (TIFF mapeado em memória
+    ou lido por strip/tile); as demais são decodificadas pelo leitor próprio do
+    formato (decodificar_imagem).
+    """
+    # Verifica se o arquivo de imagem está associado
+    if not imagem_micro.imagem:
+        raise ValueError("Nenhuma imagem associada ao objeto ImagemMicroscopica")
+    
+    if not hasattr(imagem_micro.imagem, 'path') or not imagem_micro.imagem.path:
+        raise ValueError("Arquivo de imagem não encontrado no sistema de arquivos")
+    
+    img_path = imagem_micro.imagem.path
+    em_blocos = usar_blocos(img_path)
+    img = abrir_imagem_sob_demanda(img_path) if em_blocos else None
+    if img is None:
+        img = decodificar_imagem(img_path)
+    print(f"Shape da imagem original: {img.shape}")
+    return img, em_blocos
+
+def converter_para_cinza(img):
+    """Converte para escala de cinza se necessário"""
+    return converter_cinza(img)
+
+def atualizar_progresso(imagem_micro, progresso):
+    """Grava só a coluna de progresso, e apenas quando ele avança"""
+    progresso = int(progresso)
+    if progresso <= (imagem_micro.progresso or 0):
+        return
+    imagem_micro.progresso = progresso
+    ImagemMicroscopica.objects.filter(id=imagem_micro.id).update(progresso=progresso)
+
+def registrar_tempos_modelo(imagem_micro, tempos_modelo, em_blocos, escala=None):
+    imagem_micro.metadata = {**(imagem_micro.metadata or {}), 'modelo': tempos_modelo, 'em_blocos': em_blocos}
+    if escala is not None:
+        imagem_micro.metadata['escala'] = escala
+    imagem_micro.save(update_fields=['metadata'])
+
+def inferir_mascaras(model, imagens_cinza, escala=None):
+    """
+    model.eval sobre uma imagem (ou lista de imagens) em escala de cinza. Com 'escala'
+    (calcular_escala), a inferência roda em cópias reduzidas com o diâmetro das células
+    informado ao Cellpose, e as máscaras são ampliadas de volta à resolução original.
+    """
+    if escala is None:
+        masks, flows, styles = model.eval(imagens_cinza, **PARAMETROS_SEGMENTACAO)
+        return masks
+
+    lista = isinstance(imagens_cinza, list)
+    imagens = imagens_cinza if lista else [imagens_cinza]
+    reduzidas = [reduzir_imagem(img, escala['fator']) for img in imagens]
+    masks, flows, styles = model.eval(
+        reduzidas if lista else reduzidas[0],
+        diameter=escala['diametro_reduzido'],
+        **PARAMETROS_SEGMENTACAO
+    )
+    if not lista:
+        return ampliar_mascara(masks, imagens[0].shape[:2])
+    return [ampliar_mascara(m, img.shape[:2]) for m, img in zip(masks, imagens)]
+
+def parametros_segmentacao(imagem_micro):
+    """Tudo o que determina a máscara e as características de uma imagem"""
+    parametros = {
+        'model_type': MODEL_TYPE,
+        'segmentacao': PARAMETROS_SEGMENTACAO,
+        'microns_por_pixel': MICRONS_PER_PIXEL,
+        'modo_caracteristicas': modo_caracteristicas(imagem_micro),
+    }
+    escala = calcular_escala(MICRONS_PER_PIXEL)
+    if escala is not None:
+        parametros['escala'] = {'fator': escala['fator'], 'diametro_reduzido': escala['diametro_reduzido']}
+    return parametros
+
+def consultar_cache(imagem_micro, em_blocos):
+    """
+    Procura a imagem no cache de segmentação pelo hash do conteúdo e registra
+    acerto ou falha no metadata. Imagens segmentadas em blocos não usam o cache.
+    """
+    if not cache_ativo() or em_blocos:
+        return None
+    
+    hash_imagem = hash_arquivo(imagem_micro.imagem)
+    parametros = parametros_segmentacao(imagem_micro)
+    chave = chave_cache(hash_imagem, parametros)
+    resultado = buscar_no_cache(chave)
+    
+    imagem_micro.metadata = {
+        **(imagem_micro.metadata or {}),
+        'sha256': hash_imagem,
+        'cache': 'acerto' if resultado is not None else 'falha',
+    }
+    imagem_micro.save(update_fields=['metadata'])
+    
+    return {'chave': chave, 'hash_imagem': hash_imagem, 'parametros': parametros, 'resultado': resultado}
 
-        # 2. Configuração do modelo
-        model = models.CellposeModel(gpu=True, model_type='cyto')
-        channels = [0, 0]  # (canal_de_segmentacao, canal_do_nucleo)
+def armazenar_no_cache(consulta, masks, leveduras_segmentadas, mascara=None):
+    """
+    Guarda o resultado de uma inferência no cache, referenciando a máscara já gravada
+    da imagem ('mascara'); falhas aqui não afetam o job
+    """
+    if consulta is None:
+        return
+    
+    try:
+        caracteristicas = {
+            levedura['levedura_id']: levedura['caracteristicas']
+            for levedura in leveduras_segmentadas
+        }
+        armazenar_resultado(
+            consulta['chave'], consulta['hash_imagem'], consulta['parametros'], masks, caracteristicas, mascara
+        )
+    except Exception as e:
+        print(f"Erro ao armazenar resultado no cache: {str(e)}")
+
+def processar_segmentacao(imagem_micro, analise):
+    """
+    Processa a segmentação da imagem e retorna as leveduras encontradas
+    """
+    caminho_mascara = None
+    instrumentacao = Instrumentacao()
+    try:
+        # 1. Carrega a imagem (lida sob demanda quando for segmentada em blocos)
+        with instrumentacao.etapa('carregamento'):
+            img, em_blocos = carregar_imagem_micro(imagem_micro)
 
-        # 3. Parâmetros de segmentação
-        flow_threshold = 0.2 
-        cellprob_threshold = 0.2 
-        tile_norm_blocksize = 0
+        # Imagens já segmentadas com os mesmos parâmetros reaproveitam máscara e características
+        with instrumentacao.etapa('cache'):
+            consulta = consultar_cache(imagem_micro, em_blocos)
+        atualizar_progresso(imagem_micro, PROGRESSO_CARREGADA)
+        if consulta is not None and consulta['resultado'] is not None:
+            print("Resultado encontrado no cache de segmentação")
+            masks, caracteristicas_por_id, mascara = consulta['resultado']
+            return pos_processar_segmentacao(
+                imagem_micro, analise, img, masks, caracteristicas_por_id, instrumentacao, mascara
+            )
 
+        # 2. Segmentação com o modelo compartilhado entre os jobs do processo
+        config_escala = configuracao_escala()
+        escala = calcular_escala(MICRONS_PER_PIXEL, config_escala)
+        if escala is not None:
+            print(f"Inferência em resolução reduzida: fator {escala['fator']:.3f}, "
+                  f"diâmetro esperado {escala['diametro_pixels']:.0f}px")
         print("Executando segmentação com Cellpose...")
-        masks, flows, styles = model.eval(
-            img_gray, 
-            channels=channels,
-            batch_size=32, 
-            flow_threshold=flow_threshold, 
-            cellprob_threshold=cellprob_threshold, 
-            normalize={"tile_norm_blocksize": tile_norm_blocksize}
-        )
-        print("Segmentação concluída.")
-
-        # 4. Processa cada levedura segmentada
-        unique_levedura_ids = np.unique(masks)
-        total_leveduras = len(unique_levedura_ids) - 1 
+        with instrumentacao.etapa('inferencia'), usar_modelo(MODEL_TYPE) as (model, tempos_modelo):
+            atualizar_progresso(imagem_micro, PROGRESSO_INFERENCIA)
+
+            def inferir(img_gray):
+                # Na segmentação em blocos a redução é aplicada a cada bloco
+                return inferir_mascaras(model, img_gray, escala)
+
+            if em_blocos:
+                # Imagens muito grandes: blocos sobrepostos costurados numa máscara mapeada em disco
+                def progresso_blocos(fracao):
+                    atualizar_progresso(
+                        imagem_micro,
+                        PROGRESSO_INFERENCIA + fracao * (PROGRESSO_SEGMENTADA - PROGRESSO_INFERENCIA)
+                    )
+
+                masks, caminho_mascara = segmentar_em_blocos(img, inferir, progresso=progresso_blocos)
+            else:
+                masks = inferir(converter_para_cinza(img))
+        print(f"Segmentação concluída. Carregamento do modelo: {tempos_modelo['tempo_carregamento']:.2f}s, "
+              f"inferência: {tempos_modelo['tempo_inferencia']:.2f}s")
+
+        if escala is not None and config_escala['comparar'] and not em_blocos:
+            # Calibração: quanto o resultado reduzido difere da inferência em resolução completa
+            with instrumentacao.etapa('comparacao_escala'), usar_modelo(MODEL_TYPE) as (model, tempos_referencia):
+                referencia = inferir_mascaras(model, converter_para_cinza(img))
+            escala = {
+                **escala,
+                **comparar_mascaras(masks, referencia),
+                'tempo_inferencia': tempos_modelo['tempo_inferencia'],
+                'tempo_inferencia_resolucao_completa': tempos_referencia['tempo_inferencia'],
+            }
+            del referencia
+            print(f"Comparação com a resolução completa: {escala['leveduras']} x "
+                  f"{escala['leveduras_resolucao_completa']} leveduras, "
+                  f"IoU médio {escala['iou_medio_celulas'] or 0:.3f}")
+
+        registrar_tempos_modelo(imagem_micro, tempos_modelo, em_blocos, escala)
+        atualizar_progresso(imagem_micro, PROGRESSO_SEGMENTADA)
+
+        # Recortes, características e gravação
+        leveduras_segmentadas = pos_processar_segmentacao(imagem_micro, analise, img, masks, None, instrumentacao)
+        with instrumentacao.etapa('armazenar_cache'):
+            armazenar_no_cache(consulta, masks, leveduras_segmentadas, imagem_micro.mascara.name or None)
+        return leveduras_segmentadas
+
+    except Exception as e:
+        print(f"Erro durante a segmentação: {str(e)}")
+        raise e
+
+    finally:
+        if caminho_mascara is not None:
+            remover_mascara_temporaria(caminho_mascara)
+        registrar_instrumentacao(imagem_micro, instrumentacao)
+
+def processar_lote_segmentacao(imagens_micro):
+    """
+    Segmenta várias imagens com uma única chamada do Cellpose sobre a lista de imagens.
+
+    Retorna um dicionário id da imagem -> leveduras encontradas, ou a exceção que
+    interrompeu aquela imagem. Um erro na inferência do lote vale só para as imagens
+    que entraram nela; acertos no cache e imagens em blocos mantêm o seu resultado.
+    """
+    resultados = {}
+    carregadas = []
+    instrumentacoes = {}
+
+    for imagem_micro in imagens_micro:
+        instrumentacao = Instrumentacao()
+        try:
+            with instrumentacao.etapa('carregamento'):
+                img, em_blocos = carregar_imagem_micro(imagem_micro)
+        except Exception as e:
+            resultados[imagem_micro.id] = e
+            continue
+
+        if em_blocos:
+            # Imagens muito grandes não entram no lote; seguem o caminho em blocos
+            try:
+                resultados[imagem_micro.id] = processar_segmentacao(imagem_micro, imagem_micro.analise)
+            except Exception as e:
+                resultados[imagem_micro.id] = e
+            continue
+
+        try:
+            with instrumentacao.etapa('cache'):
+                consulta = consultar_cache(imagem_micro, em_blocos)
+            if consulta is not None and consulta['resultado'] is not None:
+                # Acerto no cache: a imagem não precisa entrar na inferência do lote
+                masks, caracteristicas_por_id, mascara = consulta['resultado']
+                resultados[imagem_micro.id] = pos_processar_segmentacao(
+                    imagem_micro, imagem_micro.analise, img, masks, caracteristicas_por_id, instrumentacao,
+                    mascara
+                )
+                registrar_instrumentacao(imagem_micro, instrumentacao)
+                continue
+        except Exception as e:
+            resultados[imagem_micro.id] = e
+            registrar_instrumentacao(imagem_micro, instrumentacao)
+            continue
+
+        atualizar_progresso(imagem_micro, PROGRESSO_CARREGADA)
+        carregadas.append((imagem_micro, img, consulta))
+        instrumentacoes[imagem_micro.id] = instrumentacao
+
+    if not carregadas:
+        return resultados
+
+    print(f"Executando segmentação com Cellpose em lote de {len(carregadas)} imagens...")
+    escala = calcular_escala(MICRONS_PER_PIXEL)
+    medicao_lote = iniciar_pico_rss()
+    inicio_parede, inicio_cpu = time.perf_counter(), time.process_time()
+    try:
+        with usar_modelo(MODEL_TYPE) as (model, tempos_modelo):
+            for imagem_micro, _, _ in carregadas:
+                atualizar_progresso(imagem_micro, PROGRESSO_INFERENCIA)
+            lista_masks = inferir_mascaras(
+                model, [converter_para_cinza(img) for _, img, _ in carregadas], escala
+            )
+    except Exception as e:
+        print(f"Erro na inferência do lote: {str(e)}")
+        for imagem_micro, _, _ in carregadas:
+            resultados[imagem_micro.id] = e
+            registrar_instrumentacao(imagem_micro, instrumentacoes[imagem_micro.id])
+        return resultados
+    tempo_lote, cpu_lote = time.perf_counter() - inicio_parede, time.process_time() - inicio_cpu
+    pico_lote = encerrar_pico_rss(medicao_lote)
+    print(f"Segmentação do lote concluída. Inferência: {tempos_modelo['tempo_inferencia']:.2f}s")
+
+    tempos_lote = {**tempos_modelo, 'imagens_no_lote': len(carregadas)}
+    for (imagem_micro, img, consulta), masks in zip(carregadas, lista_masks):
+        # A inferência do lote é compartilhada: cada imagem registra o tempo do lote inteiro
+        instrumentacao = instrumentacoes[imagem_micro.id]
+        instrumentacao.registrar(
+            'inferencia', tempo_lote, cpu_lote, pico_rss_mb=pico_lote, imagens_no_lote=len(carregadas)
+        )
+        try:
+            registrar_tempos_modelo(imagem_micro, tempos_lote, False, escala)
+            atualizar_progresso(imagem_micro, PROGRESSO_SEGMENTADA)
+            resultados[imagem_micro.id] = pos_processar_segmentacao(
+                imagem_micro, imagem_micro.analise, img, masks, None, instrumentacao
+            )
+            with instrumentacao.etapa('armazenar_cache'):
+                armazenar_no_cache(
+                    consulta, masks, resultados[imagem_micro.id], imagem_micro.mascara.name or None
+                )
+        except Exception as e:
+            print(f"Erro durante a segmentação da imagem {imagem_micro.id}: {str(e)}")
+            resultados[imagem_micro.id] = e
+        finally:
+            registrar_instrumentacao(imagem_micro, instrumentacao)
+
+    return resultados
+
+def pos_processamento_workers():
+    """Threads do pós-processamento por levedura (1 = serial)"""
+    return max(1, int(getattr(settings, 'LEVEDURAS_POS_PROCESSAMENTO_WORKERS', 4)))
+
+def remover_recortes(leveduras):
+    """Remove do storage os recortes de leveduras que não chegaram ao banco"""
+    for levedura_obj in leveduras:
+        if levedura_obj.imagem.name:
+            levedura_obj.imagem.storage.delete(levedura_obj.imagem.name)
+
+def pos_processar_segmentacao(imagem_micro, analise, img, masks, caracteristicas_por_id=None,
+                              instrumentacao=None, mascara_existente=None):
+    """
+    Extrai as leveduras da máscara de rótulos, grava recortes e características
+    e conclui a imagem. 'caracteristicas_por_id' permite reaproveitar características
+    já calculadas e 'mascara_existente' o arquivo da máscara (cache de segmentação);
+    'instrumentacao' mede cada etapa.
+    """
+    mascara_gravada = False
+    try:
+        # 3. Extrai as regiões de todas as leveduras em poucas passadas sobre a máscara
+        with etapa(instrumentacao, 'regioes'):
+            regioes = extrair_regioes(masks)
+        total_leveduras = len(regioes)
         print(f"\nContagem total de leveduras segmentadas: {total_leveduras}")
 
+        # 4. Características morfológicas: da máscara do Cellpose ou re-segmentando cada recorte
+        modo = modo_caracteristicas(imagem_micro)
+        if modo == 'mascara' and caracteristicas_por_id is None:
+            with etapa(instrumentacao, 'caracteristicas', total_leveduras):
+                caracteristicas_por_id = extrair_caracteristicas_mascara(masks, regioes, MICRONS_PER_PIXEL)
+
         leveduras_segmentadas = []
-        levedura_count = 0
+        leveduras_para_gravar = []
+        pacote = PacoteRecortes() if armazenamento_recortes() == 'pacote' else None
+        atualizar_progresso(imagem_micro, PROGRESSO_SEGMENTADA)
+        inicio_recortes, inicio_cpu_recortes = time.perf_counter(), time.process_time()
+        medicao_recortes = iniciar_pico_rss()
 
-        for levedura_id in unique_levedura_ids:
-            if levedura_id == 0:  # Ignora o fundo
-                continue
+        def processar_regiao(regiao):
+            """Recorte, características e gravação do recorte de uma levedura"""
+            levedura_id = regiao['levedura_id']
+            x, y, w, h = regiao['bounding_box']
 
-            levedura_count += 1
+            # Adiciona padding
+            padding = 5 
+            x_start = max(0, x - padding)
+            y_start = max(0, y - padding)
+            x_end = min(img.shape[1], x + w + padding)
+            y_end = min(img.shape[0], y + h + padding)
 
-            # Cria máscara binária para a levedura atual
-            individual_mask = (masks == levedura_id).astype(np.uint8) * 255
+            # Recorta a levedura (só a janela é lida quando a imagem é lida sob demanda)
+            cropped_levedura = np.ascontiguousarray(img[y_start:y_end, x_start:x_end])
 
-            # Encontra contornos para obter bounding box
-            contours, _ = cv2.findContours(individual_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            if caracteristicas_por_id is not None:
+                caracteristicas = caracteristicas_por_id.get(levedura_id)
+            else:
+                with etapa(instrumentacao, 'caracteristicas_recorte', 1, pico_rss=False):
+                    caracteristicas = extrair_caracteristicas_levedura(cropped_levedura)
+
+            # Grava o recorte; a linha no banco é inserida em lote ao final
+            levedura_obj = salvar_levedura_segmentada(
+                cropped_levedura, 
+                levedura_id, 
+                analise, 
+                imagem_micro,
+                (x, y, w, h),
+                caracteristicas,
+                modo,
+                pacote,
+                instrumentacao
+            )
             
-            if contours:
-                cnt = max(contours, key=cv2.contourArea)
-                x, y, w, h = cv2.boundingRect(cnt)
-                
-                # Adiciona padding
-                padding = 5 
-                x_start = max(0, x - padding)
-                y_start = max(0, y - padding)
-                x_end = min(img.shape[1], x + w + padding)
-                y_end = min(img.shape[0], y + h + padding)
-
-                # Recorta a levedura
-                if len(img.shape) == 3:
-                    cropped_levedura = img[y_start:y_end, x_start:x_end]
-                else:
-                    cropped_levedura = img_gray[y_start:y_end, x_start:x_end]
-
-                # Salva a levedura segmentada no banco de dados
-                levedura_obj = salvar_levedura_segmentada(
-                    cropped_levedura, 
-                    levedura_id, 
-                    analise, 
+            return levedura_obj, {
+                'id': str(levedura_obj.id),
+                'levedura_id': int(levedura_id),
+                'url_imagem': url_recorte(levedura_obj),
+                'bounding_box': {
+                    'x': x,
+                    'y': y,
+                    'width': w,
+                    'height': h
+                },
+                'area': w * h,
+                'caracteristicas': caracteristicas
+            }
+
+        def processar_bloco(bloco):
+            processadas = []
+            try:
+                for regiao in bloco:
+                    processadas.append(processar_regiao(regiao))
+            except Exception:
+                remover_recortes([levedura_obj for levedura_obj, _ in processadas])
+                raise
+            return processadas
+
+        # Blocos de leveduras distribuídos entre threads (OpenCV e NumPy liberam o GIL);
+        # a imagem e a máscara são compartilhadas sem cópia e a ordem do resultado é a serial
+        tamanho_bloco = getattr(settings, 'LEVEDURAS_POS_PROCESSAMENTO_BLOCO', 64)
+        blocos = [regioes[inicio:inicio + tamanho_bloco] for inicio in range(0, total_leveduras, tamanho_bloco)]
+        workers = min(pos_processamento_workers(), len(blocos))
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        futuros = [executor.submit(processar_bloco, bloco) for bloco in blocos] if executor else []
+        consumidos = 0
+        try:
+            for indice, bloco in enumerate(blocos):
+                processadas = futuros[indice].result() if executor else processar_bloco(bloco)
+                consumidos += 1
+                for levedura_obj, item in processadas:
+                    leveduras_para_gravar.append(levedura_obj)
+                    leveduras_segmentadas.append(item)
+                atualizar_progresso(
                     imagem_micro,
-                    (x, y, w, h)
+                    PROGRESSO_SEGMENTADA +
+                    (PROGRESSO_RECORTES - PROGRESSO_SEGMENTADA) * len(leveduras_para_gravar) / total_leveduras
                 )
-                
-                # Adiciona à lista de resposta
-                leveduras_segmentadas.append({
-                    'id': str(levedura_obj.id),
-                    'levedura_id': int(levedura_id),
-                    'url_imagem': levedura_obj.imagem.url,
-                    'bounding_box': {
-                        'x': x,
-                        'y': y,
-                        'width': w,
-                        'height': h
-                    },
-                    'area': w * h
-                })
-                
-                print(f"Levedura {levedura_id} processada e salva")
-
-        print(f"\nTodas as {levedura_count} leveduras foram processadas.")
+        except Exception:
+            if executor is not None:
+                # Recortes dos blocos já concluídos também precisam ser removidos
+                executor.shutdown(wait=True, cancel_futures=True)
+                for futuro in futuros[consumidos:]:
+                    if not futuro.cancelled() and futuro.exception() is None:
+                        leveduras_para_gravar.extend(levedura_obj for levedura_obj, _ in futuro.result())
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        if instrumentacao is not None:
+            # Laço inteiro; codificação, gravação dos recortes e características por recorte aparecem também separadas
+            instrumentacao.registrar(
+                'recortes', time.perf_counter() - inicio_recortes,
+                time.process_time() - inicio_cpu_recortes, total_leveduras,
+                pico_rss_mb=encerrar_pico_rss(medicao_recortes)
+            )
+        atualizar_progresso(imagem_micro, PROGRESSO_GRAVACAO)
+
+        # 5. No armazenamento em pacote, grava um único arquivo com todos os recortes
+        if pacote is not None:
+            with etapa(instrumentacao, 'pacote', total_leveduras):
+                salvar_pacote_recortes(pacote, imagem_micro, leveduras_para_gravar)
+
+        # 6. Máscara de rótulos completa, para reanálises e overlays sem nova inferência
+        if mascara_existente:
+            # Acerto no cache: a imagem referencia a máscara já gravada, sem outra cópia
+            imagem_micro.mascara.name = mascara_existente
+            mascara_gravada = True
+        elif configuracao_mascaras()['ativo']:
+            with etapa(instrumentacao, 'mascara'):
+                salvar_mascara(imagem_micro, masks)
+            mascara_gravada = True
+
+        # 7. Grava todas as leveduras de uma vez e conclui a imagem
+        with etapa(instrumentacao, 'persistencia', total_leveduras):
+            persistir_leveduras_segmentadas(imagem_micro, leveduras_para_gravar)
+
+        print(f"\nTodas as {total_leveduras} leveduras foram processadas.")
         return leveduras_segmentadas
 
     except Exception as e:
-        print(f"Erro durante a segmentação: {str(e)}")
+        # Nada foi gravado no banco; remove os recortes que já estavam no storage
+        remover_recortes(locals().get('leveduras_para_gravar', []))
+        if imagem_micro.pacote_recortes.name:
+            imagem_micro.pacote_recortes.storage.delete(imagem_micro.pacote_recortes.name)
+            imagem_micro.pacote_recortes = None
+        if mascara_gravada:
+            remover_mascara(imagem_micro)
         raise e
 
-def salvar_levedura_segmentada(imagem_array, levedura_id, analise, imagem_micro, bounding_box):
+def salvar_pacote_recortes(pacote, imagem_micro, leveduras):
+    """
+    Grava o pacote de recortes da imagem no storage e registra em cada levedura
+    a posição do seu recorte dentro dele
+    """
+    try:
+        arquivo, posicoes = pacote.finalizar()
+        nome_pacote = f"recortes_{imagem_micro.id}_{uuid.uuid4().hex[:8]}.zip"
+        imagem_micro.pacote_recortes.save(nome_pacote, File(arquivo), save=False)
+    finally:
+        pacote.descartar()
+
+    for levedura in leveduras:
+        levedura.pacote_offset, levedura.pacote_tamanho = posicoes[levedura.nome_arquivo]
+
+def persistir_leveduras_segmentadas(imagem_micro, leveduras):
+    """
+    Insere as leveduras de uma imagem em lotes de bulk_create numa única transação,
+    junto com a mudança de status da imagem para concluído (tudo ou nada).
+
+    Só grava quem ainda é dono do job: com a imagem travada, o task_id precisa ser o
+    mesmo de quando o processamento começou (JobPerdido, caso contrário). Leveduras
+    de uma tentativa anterior da mesma imagem são substituídas.
+    """
+    tamanho_lote = getattr(settings, 'LEVEDURAS_BULK_TAMANHO_LOTE', 500)
+
+    with transaction.atomic():
+        atual = (
+            ImagemMicroscopica.objects.select_for_update()
+            .only('task_id', 'status_processamento', 'mascara', 'pacote_recortes')
+            .get(id=imagem_micro.id)
+        )
+        if atual.task_id != imagem_micro.task_id or atual.status_processamento != 'processando':
+            raise JobPerdido(f"Job {imagem_micro.id} reivindicado por {atual.task_id or 'nenhum worker'}")
+
+        anteriores = list(LeveduraSegmentada.objects.filter(imagem_original_id=imagem_micro.id).only('id', 'imagem'))
+        if anteriores:
+            LeveduraSegmentada.objects.filter(id__in=[levedura.id for levedura in anteriores]).delete()
+            transaction.on_commit(lambda: remover_recortes(anteriores))
+        for campo in ('pacote_recortes', 'mascara'):
+            arquivo_anterior = getattr(atual, campo)
+            if arquivo_anterior.name and arquivo_anterior.name != getattr(imagem_micro, campo).name:
+                transaction.on_commit(lambda arquivo=arquivo_anterior: remover_arquivo_sem_referencia(arquivo))
+
+        for inicio in range(0, len(leveduras), tamanho_lote):
+            LeveduraSegmentada.objects.bulk_create(leveduras[inicio:inicio + tamanho_lote])
+
+        imagem_micro.status_processamento = 'concluido'
+        imagem_micro.progresso = 100
+        imagem_micro.concluido_em = timezone.now()
+        imagem_micro.resumo = calcular_resumo(leveduras)
+        # Leveduras recém-gravadas: nenhuma alteração posterior à conclusão
+        imagem_micro.atualizado_em = None
+        # Só as colunas do job: a instância foi carregada antes do processamento, e um
+        # save completo desfaria o que outros processos gravaram nesse meio tempo (ex.: preview)
+        imagem_micro.save(update_fields=[
+            'status_processamento', 'progresso', 'concluido_em', 'resumo', 'atualizado_em',
+            'mascara', 'pacote_recortes'
+        ])
+
+def remover_arquivo_sem_referencia(arquivo):
+    """Remove o pacote ou a máscara de uma tentativa anterior (máscaras podem estar no cache)"""
+    if arquivo.field.name == 'mascara' and mascara_referenciada(arquivo.name):
+        return
+    arquivo.storage.delete(arquivo.name)
+
+def salvar_levedura_segmentada(imagem_array, levedura_id, analise, imagem_micro, bounding_box,
+                               caracteristicas, modo_caracteristicas='mascara', pacote=None,
+                               instrumentacao=None):
     """
-    Salva uma levedura segmentada no banco de dados - Versão alternativa
+    Grava o recorte da levedura no storage (ou no pacote da imagem) e retorna o objeto
+    ainda não salvo no banco, para ser inserido em lote por persistir_leveduras_segmentadas
     """
     try:
-        caracteristicas = extrair_caracteristicas_levedura(imagem_array)
-        timestamp = timezone.now().strftime("%Y%m%d_%H%M%S")
-        unique_id = uuid.uuid4().hex[:8]
-        filename = f"levedura_{levedura_id:04d}_{timestamp}_{unique_id}.png"
+        # Codifica o recorte em memória e entrega direto ao storage
+        with etapa(instrumentacao, 'codificacao', 1, pico_rss=False):
+            conteudo, extensao, formato = codificar_recorte(imagem_array)
         
-        # Salva temporariamente no disco
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as temp_file:
-            if len(imagem_array.shape) == 2:  # Imagem em escala de cinza
-                success = cv2.imwrite(temp_file.name, imagem_array)
-            else:  # Imagem colorida
-                success = cv2.imwrite(temp_file.name, cv2.cvtColor(imagem_array, cv2.COLOR_RGB2BGR))
-            
-            if not success:
-                raise ValueError("Erro ao salvar imagem temporária")
-            
-            # Cria o objeto no banco de dados
-            with open(temp_file.name, 'rb') as file:
-                levedura = LeveduraSegmentada(
-                    analise=analise,
-                    imagem_original=imagem_micro,
-                    levedura_id=levedura_id,
-                    nome_arquivo=filename,
-                    bounding_box={
-                        'x': bounding_box[0],
-                        'y': bounding_box[1],
-                        'width': bounding_box[2],
-                        'height': bounding_box[3]
-                    },
-                    caracteristicas=caracteristicas or {},
-                    # Campos individuais para facilitar consultas
-                    diametro_equivalente=caracteristicas.get('diametro_equivalente_microns') if caracteristicas else None,
-                    circularidade=caracteristicas.get('circularidade') if caracteristicas else None,
-                    solidez=caracteristicas.get('solidez') if caracteristicas else None,
-                    relacao_aspecto=caracteristicas.get('relacao_aspecto') if caracteristicas else None,
-                    area_pixels=caracteristicas.get('area_pixels') if caracteristicas else None,
-                    area_microns=caracteristicas.get('area_microns') if caracteristicas else None,
-                    metadata={
-                        'area': bounding_box[2] * bounding_box[3],
-                        'formato': 'PNG',
-                        'dimensoes': {
-                            'altura': imagem_array.shape[0],
-                            'largura': imagem_array.shape[1]
-                        },
-                        'caracteristicas_extrahidas': bool(caracteristicas)
-                    }
-                )
-                levedura.imagem.save(filename, File(file))
-                levedura.save()
+        if pacote is not None:
+            filename = f"levedura_{levedura_id:04d}{extensao}"
+        else:
+            timestamp = timezone.now().strftime("%Y%m%d_%H%M%S")
+            unique_id = uuid.uuid4().hex[:8]
+            filename = f"levedura_{levedura_id:04d}_{timestamp}_{unique_id}{extensao}"
         
-        # Limpa o arquivo temporário
-        os.unlink(temp_file.name)
+        levedura = LeveduraSegmentada(
+            analise=analise,
+            imagem_original=imagem_micro,
+            levedura_id=levedura_id,
+            nome_arquivo=filename,
+            bounding_box={
+                'x': bounding_box[0],
+                'y': bounding_box[1],
+                'width': bounding_box[2],
+                'height': bounding_box[3]
+            },
+            caracteristicas=caracteristicas or {},
+            # Campos individuais para facilitar consultas
+            **colunas_caracteristicas(caracteristicas),
+            metadata={
+                'area': bounding_box[2] * bounding_box[3],
+                'formato': formato,
+                'tamanho_bytes': len(conteudo),
+                'dimensoes': {
+                    'altura': imagem_array.shape[0],
+                    'largura': imagem_array.shape[1]
+                },
+                'caracteristicas_extrahidas': bool(caracteristicas),
+                'modo_caracteristicas': modo_caracteristicas,
+                'armazenamento': 'pacote' if pacote is not None else 'arquivos'
+            }
+        )
+        with etapa(instrumentacao, 'armazenamento_recortes', 1, pico_rss=False):
+            if pacote is not None:
+                pacote.adicionar(filename, conteudo)
+            else:
+                levedura.imagem.save(filename, ContentFile(conteudo), save=False)
         
-        print(f"Levedura {levedura_id} salva com sucesso: {filename}")
         return levedura
         
     except Exception as e:
-        # Garante que o arquivo temporário seja removido em caso de erro
-        if 'temp_file' in locals() and os.path.exists(temp_file.name):
-            os.unlink(temp_file.name)
         print(f"Erro ao salvar levedura {levedura_id}: {str(e)}")
         raise e
     
@@ -425,6 +1500,8 @@ def upload_imagem_colonia(request, analise_id):
 def extrair_caracteristicas_levedura(imagem_array, microns_por_pixel=MICRONS_PER_PIXEL):
     """
     Extrai características morfológicas de uma levedura a partir de um array numpy
+
+    Modo legado ('recorte'): re-segmenta o recorte com CLAHE e limiarização
     """
     try:
         # Se a imagem for colorida, converte para escala de cinza
@@ -454,70 +1531,11 @@ def extrair_caracteristicas_levedura(imagem_array, microns_por_pixel=MICRONS_PER
         contour = max(contours, key=cv2.contourArea)
         
         # Filtra contornos muito pequenos
-        if cv2.contourArea(contour) < 50:
+        if cv2.contourArea(contour) < AREA_MINIMA_PIXELS:
             return None
         
-        caracteristicas = {}
-        
         # --- CÁLCULO DAS CARACTERÍSTICAS ---
-        area_pixels = cv2.contourArea(contour)
-        area_microns2 = area_pixels * (microns_por_pixel ** 2)
-        
-        perimetro_pixels = cv2.arcLength(contour, closed=True)
-        perimetro_microns = perimetro_pixels * microns_por_pixel
-        
-        # Circularidade
-        circularidade = (4 * np.pi * area_pixels) / (perimetro_pixels ** 2) if perimetro_pixels > 0 else 0.0
-        
-        # Solidez
-        hull = cv2.convexHull(contour)
-        area_hull = cv2.contourArea(hull)
-        solidez = area_pixels / area_hull if area_hull > 0 else 0.0
-        
-        # Diâmetro equivalente (diâmetro de um círculo com a mesma área)
-        diametro_equivalente_pixels = 2 * math.sqrt(area_pixels / math.pi)
-        diametro_equivalente_microns = diametro_equivalente_pixels * microns_por_pixel
-        
-        # Eixos e relação de aspecto
-        eixo_maior_microns = 0
-        eixo_menor_microns = 0
-        relacao_aspecto = 0
-        angulacao_graus = 0
-        
-        if len(contour) >= 5:
-            (center_ellipse, axes_ellipse, angle_ellipse) = cv2.fitEllipse(contour)
-            eixo_menor_pixels = min(axes_ellipse)
-            eixo_maior_pixels = max(axes_ellipse)
-            
-            eixo_maior_microns = eixo_maior_pixels * microns_por_pixel
-            eixo_menor_microns = eixo_menor_pixels * microns_por_pixel
-            relacao_aspecto = eixo_maior_pixels / eixo_menor_pixels
-            angulacao_graus = angle_ellipse
-        
-        # Centroide
-        M = cv2.moments(contour)
-        cx, cy = 0, 0
-        if M["m00"] != 0:
-            cx = int(M["m10"] / M["m00"])
-            cy = int(M["m01"] / M["m00"])
-        
-        # Compilar todas as características
-        caracteristicas_completas = {
-            'area_pixels': float(area_pixels),
-            'area_microns': float(area_microns2),
-            'perimetro_pixels': float(perimetro_pixels),
-            'perimetro_microns': float(perimetro_microns),
-            'circularidade': float(circularidade),
-            'solidez': float(solidez),
-            'diametro_equivalente_microns': float(diametro_equivalente_microns),
-            'eixo_maior_microns': float(eixo_maior_microns),
-            'eixo_menor_microns': float(eixo_menor_microns),
-            'relacao_aspecto': float(relacao_aspecto),
-            'angulacao_graus': float(angulacao_graus),
-            'centroide_x': cx,
-            'centroide_y': cy,
-            'microns_por_pixel': microns_por_pixel
-        }
+        caracteristicas_completas = caracteristicas_contorno(contour, microns_por_pixel)
         
         return caracteristicas_completas
         
@@ -525,31 +1543,322 @@ def extrair_caracteristicas_levedura(imagem_array, microns_por_pixel=MICRONS_PER
         print(f"Erro ao extrair características: {str(e)}")
         return None
     
+def agregados_caracteristicas():
+    return {
+        'total': Count('id'),
+        'area_media': Avg('area_microns'),
+        'area_desvio': StdDev('area_microns'),
+        'area_min': Min('area_microns'),
+        'area_max': Max('area_microns'),
+        'circularidade_media': Avg('circularidade'),
+        'relacao_aspecto_media': Avg('relacao_aspecto'),
+    }
+
+def formatar_estatisticas(agregados):
+    return {
+        'total_leveduras': agregados['total'],
+        'area_microns': {
+            'media': agregados['area_media'],
+            'desvio_padrao': agregados['area_desvio'],
+            'min': agregados['area_min'],
+            'max': agregados['area_max']
+        },
+        'circularidade': {
+            'media': agregados['circularidade_media'],
+        },
+        'relacao_aspecto': {
+            'media': agregados['relacao_aspecto_media'],
+        }
+    }
+
 @api_view(['GET'])
 def estatisticas_caracteristicas(request, imagem_id):
     """
     Retorna estatísticas das características das leveduras de uma imagem
     """
     try:
-        leveduras = LeveduraSegmentada.objects.filter(imagem_original_id=imagem_id)
-        
-        estatisticas = {
-            'total_leveduras': leveduras.count(),
-            'area_microns': {
-                'media': leveduras.aggregate(Avg('area_microns'))['area_microns__avg'],
-                'desvio_padrao': leveduras.aggregate(StdDev('area_microns'))['area_microns__stddev'],
-                'min': leveduras.aggregate(Min('area_microns'))['area_microns__min'],
-                'max': leveduras.aggregate(Max('area_microns'))['area_microns__max']
-            },
-            'circularidade': {
-                'media': leveduras.aggregate(Avg('circularidade'))['circularidade__avg'],
-            },
-            'relacao_aspecto': {
-                'media': leveduras.aggregate(Avg('relacao_aspecto'))['relacao_aspecto__avg'],
-            }
-        }
-        
-        return Response(estatisticas)
+        # Todas as estatísticas numa única consulta
+        agregados = LeveduraSegmentada.objects.filter(imagem_original_id=imagem_id).aggregate(
+            **agregados_caracteristicas()
+        )
+        return Response(formatar_estatisticas(agregados))
         
     except Exception as e:
-        return Response({'erro': str(e)}, status=400)
\ No newline at end of file
+        return Response({'erro': str(e)}, status=400)
+
+def lista_parametro(dados, nome):
+    """Lista vinda de JSON ou de texto separado por vírgulas"""
+    valor = dados.get(nome)
+    if not valor:
+        return []
+    if isinstance(valor, str):
+        return [item.strip() for item in valor.split(',') if item.strip()]
+    return list(valor)
+
+@api_view(['GET', 'POST'])
+def estatisticas_populacao_leveduras(request):
+    """
+    Histogramas, percentis e estatísticas agrupadas das leveduras de várias análises
+    e/ou imagens. Parâmetros (query string no GET, JSON no POST):
+    - analises, imagens: ids das análises e das imagens microscópicas
+    - campos: características (padrão: area_microns, circularidade, relacao_aspecto)
+    - agrupar: 'analise' (padrão) ou 'imagem'
+    - bins: intervalos dos histogramas (padrão 30)
+    - percentis: lista de percentis (padrão 5, 25, 50, 75, 95)
+    """
+    dados = request.data if request.method == 'POST' else request.query_params
+    
+    try:
+        analises_ids = [uuid.UUID(str(analise_id)) for analise_id in lista_parametro(dados, 'analises')]
+        imagens_ids = [int(imagem_id) for imagem_id in lista_parametro(dados, 'imagens')]
+        percentis = [float(p) for p in lista_parametro(dados, 'percentis')] or list(PERCENTIS_PADRAO)
+        bins = int(dados.get('bins') or BINS_PADRAO)
+    except (TypeError, ValueError):
+        return Response(
+            {'erro': 'analises devem ser UUIDs; imagens, bins e percentis devem ser numéricos'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    if not analises_ids and not imagens_ids:
+        return Response(
+            {'erro': 'Informe ao menos uma análise ou imagem'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if not 1 <= bins <= MAX_BINS or any(not 0 <= p <= 100 for p in percentis):
+        return Response(
+            {'erro': f'bins deve estar entre 1 e {MAX_BINS} e percentis entre 0 e 100'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    campos = lista_parametro(dados, 'campos') or list(CAMPOS_ESTATISTICAS_PADRAO)
+    invalidos = [campo for campo in campos if campo not in CAMPOS_ESTATISTICAS]
+    if invalidos:
+        return Response(
+            {'erro': f'Campos inválidos: {", ".join(invalidos)}',
+             'campos_disponiveis': list(CAMPOS_ESTATISTICAS)}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    agrupar = dados.get('agrupar') or 'analise'
+    if agrupar not in AGRUPAMENTOS:
+        return Response(
+            {'erro': f'agrupar deve ser um de: {", ".join(AGRUPAMENTOS)}'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    return Response(estatisticas_populacao(analises_ids, imagens_ids, campos, agrupar, bins, percentis))
+
+@api_view(['GET'])
+def exportar_leveduras(request):
+    """
+    Exporta as características das leveduras em CSV ou Parquet, em stream e com
+    memória constante. Parâmetros:
+    - formato: 'csv' (padrão) ou 'parquet' (requer pyarrow)
+    - analises, imagens: ids separados por vírgulas
+    - desde, ate: intervalo da data de criação
+    - <caracteristica>_min, <caracteristica>_max: faixas (ex.: area_microns_min=1.5)
+    """
+    formato = request.query_params.get('formato', 'csv')
+    if formato not in FORMATOS_EXPORTACAO:
+        return Response(
+            {'erro': f'formato deve ser um de: {", ".join(FORMATOS_EXPORTACAO)}'}, 
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if formato == 'parquet' and not parquet_disponivel():
+        return Response(
+            {'erro': 'Exportação em Parquet requer o pacote pyarrow'}, 
+            status=status.HTTP_501_NOT_IMPLEMENTED
+        )
+    
+    try:
+        leveduras = filtrar_leveduras(request.query_params)
+    except FiltroInvalido as e:
+        return Response({'erro': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    nome = f"leveduras_{timezone.now().strftime('%Y%m%d_%H%M%S')}.{formato}"
+    if formato == 'parquet':
+        response = StreamingHttpResponse(gerar_parquet(leveduras), content_type='application/vnd.apache.parquet')
+    else:
+        response = StreamingHttpResponse(gerar_csv(leveduras), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{nome}"'
+    return response
+
+def resposta_zip_recortes(leveduras, nome, agrupar_por_imagem=False):
+    response = StreamingHttpResponse(
+        gerar_zip_recortes(leveduras, agrupar_por_imagem),
+        content_type='application/zip'
+    )
+    response['Content-Disposition'] = f'attachment; filename="{nome}"'
+    return response
+
+@api_view(['GET'])
+def download_recortes_imagem(request, imagem_id):
+    """
+    ZIP em stream com os recortes de todas as leveduras da imagem e um manifesto
+    (manifesto.jsonl) com bounding box e características de cada uma
+    """
+    imagem_micro = get_object_or_404(ImagemMicroscopica, id=imagem_id)
+    if imagem_micro.status_processamento != 'concluido':
+        return Response(
+            {'erro': 'Processamento da imagem ainda não concluído', 'status': imagem_micro.status_processamento}, 
+            status=status.HTTP_409_CONFLICT
+        )
+    
+    leveduras = LeveduraSegmentada.objects.filter(imagem_original_id=imagem_micro.id)
+    return resposta_zip_recortes(leveduras, f"recortes_imagem_{imagem_micro.id}.zip")
+
+@api_view(['GET'])
+def download_recortes_analise(request, analise_id):
+    """
+    ZIP em stream com os recortes de todas as imagens da análise, uma pasta por imagem
+    """
+    analise = get_object_or_404(AnaliseLevedura, id=analise_id)
+    leveduras = LeveduraSegmentada.objects.filter(analise_id=analise.id)
+    return resposta_zip_recortes(leveduras, f"recortes_analise_{analise.id}.zip", agrupar_por_imagem=True)
+
+def metricas(request):
+    """
+    Métricas no formato de texto do Prometheus: profundidade da fila, jobs por
+    segundo e quantis p50/p95 de duração dos jobs e de cada etapa do pipeline
+    """
+    return HttpResponse(metricas_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api_view(['GET'])
+def estatisticas_modelos_cellpose(request):
+    """
+    Retorna os tempos de carregamento e de inferência dos modelos Cellpose gravados
+    pelos workers nos jobs concluídos recentemente (LEVEDURAS_METRICAS_JANELA)
+    """
+    return Response({'modelos': estatisticas_modelos()})
+
+@api_view(['GET'])
+def recorte_levedura(request, levedura_id):
+    """
+    Serve o recorte de uma levedura, lendo-o do arquivo próprio ou do pacote da imagem original
+    """
+    levedura = get_object_or_404(
+        LeveduraSegmentada.objects.select_related('imagem_original'),
+        id=levedura_id
+    )
+    
+    try:
+        conteudo, content_type = ler_recorte(levedura)
+    except (ValueError, OSError) as e:
+        return Response({'erro': str(e)}, status=status.HTTP_404_NOT_FOUND)
+    
+    response = HttpResponse(conteudo, content_type=content_type)
+    response['Cache-Control'] = 'max-age=86400'
+    return response
+
+@api_view(['GET'])
+def preview_imagem(request, imagem_id):
+    """
+    Miniatura JPEG da imagem, gerada pelo worker ao reivindicar o job. Enquanto ela
+    não existir (ou se não puder ser gerada), redireciona para a imagem original.
+    """
+    imagem_micro = get_object_or_404(ImagemMicroscopica, id=imagem_id)
+    if not imagem_micro.preview:
+        return HttpResponseRedirect(imagem_micro.imagem.url)
+    
+    response = FileResponse(imagem_micro.preview.open('rb'), content_type='image/jpeg')
+    response['Cache-Control'] = 'max-age=86400'
+    return response
+
+@api_view(['GET'])
+def mascara_imagem(request, imagem_id):
+    """
+    Download da máscara de rótulos completa da imagem (npz; np.load(arquivo)['masks'])
+    """
+    imagem_micro = get_object_or_404(ImagemMicroscopica, id=imagem_id)
+    if not imagem_micro.mascara:
+        return Response({'erro': 'Imagem sem máscara gravada'}, status=status.HTTP_404_NOT_FOUND)
+    
+    return FileResponse(
+        imagem_micro.mascara.open('rb'),
+        as_attachment=True,
+        filename=f"mascara_{imagem_micro.id}.npz",
+        content_type='application/octet-stream'
+    )
+
+@api_view(['GET'])
+def overlay_mascara(request, imagem_id):
+    """
+    PNG com os contornos das leveduras sobre a imagem original, desenhado a partir
+    da máscara gravada (sem nova inferência)
+    
+    Parâmetros opcionais:
+    - lado: maior lado do PNG em pixels (padrão LEVEDURAS_OVERLAY_LADO, no máximo
+      LEVEDURAS_OVERLAY_LADO_MAXIMO)
+    - levedura_id: levedura destacada
+    """
+    imagem_micro = get_object_or_404(ImagemMicroscopica, id=imagem_id)
+    try:
+        lado = int(request.query_params.get('lado', 0)) or None
+        levedura_id = request.query_params.get('levedura_id')
+        levedura_id = int(levedura_id) if levedura_id else None
+    except ValueError:
+        return Response({'erro': 'lado e levedura_id devem ser inteiros'}, status=status.HTTP_400_BAD_REQUEST)
+    if lado is not None and lado < 0:
+        return Response({'erro': 'lado deve ser positivo'}, status=status.HTTP_400_BAD_REQUEST)
+    lado_maximo = configuracao_mascaras()['overlay_lado_maximo']
+    if lado is not None and lado > lado_maximo:
+        return Response(
+            {'erro': f'lado deve ser no máximo {lado_maximo}'}, status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    try:
+        conteudo = gerar_overlay(imagem_micro, lado, levedura_id)
+    except (ValueError, OSError) as e:
+        return Response({'erro': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    if conteudo is None:
+        return Response({'erro': 'Imagem sem máscara gravada'}, status=status.HTTP_404_NOT_FOUND)
+    
+    response = HttpResponse(conteudo, content_type='image/png')
+    response['Cache-Control'] = 'max-age=86400'
+    return response
+
+def recalcular_caracteristicas(imagem_micro):
+    """
+    Recalcula as características de todas as leveduras da imagem a partir da máscara
+    gravada, sem nova inferência, e atualiza o resumo. Retorna o número de leveduras
+    atualizadas, ou None se a imagem não tiver máscara.
+    """
+    masks = carregar_mascara(imagem_micro)
+    if masks is None:
+        return None
+    
+    regioes = extrair_regioes(masks)
+    caracteristicas_por_id = extrair_caracteristicas_mascara(masks, regioes, MICRONS_PER_PIXEL)
+    
+    leveduras = list(imagem_micro.leveduras_segmentadas.all())
+    # bulk_update não aplica auto_now; a nova data muda o ETag do status e a versão das estatísticas
+    agora = timezone.now()
+    for levedura in leveduras:
+        levedura.atualizado_em = agora
+        caracteristicas = caracteristicas_por_id.get(levedura.levedura_id)
+        levedura.caracteristicas = caracteristicas or {}
+        for coluna, valor in colunas_caracteristicas(caracteristicas).items():
+            setattr(levedura, coluna, valor)
+        levedura.metadata = {
+            **(levedura.metadata or {}),
+            'caracteristicas_extrahidas': bool(caracteristicas),
+            'modo_caracteristicas': 'mascara',
+        }
+    
+    with transaction.atomic():
+        LeveduraSegmentada.objects.bulk_update(
+            leveduras,
+            ['caracteristicas', 'metadata', 'atualizado_em', *COLUNAS_CARACTERISTICAS],
+            batch_size=getattr(settings, 'LEVEDURAS_BULK_TAMANHO_LOTE', 500)
+        )
+        imagem_micro.resumo = calcular_resumo(leveduras)
+        imagem_micro.atualizado_em = agora
+        imagem_micro.save(update_fields=['resumo', 'atualizado_em'])
+    return len(leveduras)
+
+@api_view(['GET'])
+def estatisticas_cache_segmentacao(request):
+    """
+    Retorna a taxa de acerto e a ocupação do cache de segmentação
+    """
+    return Response(estatisticas_cache())
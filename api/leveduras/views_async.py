@@ -0,0 +1,242 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+
+from .caracteristicas import MODOS_CARACTERISTICAS
+from .mascaras import url_mascara
+from .fila import configuracao_fila, fila_cheia, posicao_na_fila, tamanho_fila
+from .models import AnaliseLevedura, ImagemMicroscopica, LeveduraSegmentada
+from .views import (
+    DURACAO_MAXIMA_STREAM, ESPERA_MAXIMA_PROGRESSO, INTERVALO_CONSULTA_PROGRESSO, ParametroInvalido,
+    agregados_caracteristicas, criar_imagem_microscopica, dados_upload_microscopica, etag_confere,
+    etag_progresso, etag_status, formatar_estatisticas, formatar_progresso, gravar_arquivo_microscopica,
+    obter_resumo, pagina_leveduras, parametros_listagem, serializar_levedura, url_preview
+)
+
+# Versões assíncronas (ASGI) dos endpoints de upload, status, progresso e estatísticas,
+# servidas em /api/async/. Enquanto esperam o banco, o storage ou o próximo intervalo do
+# long-poll não ocupam uma thread, de modo que um único processo (uvicorn, daphne) atende
+# milhares de clientes lentos. As respostas são as mesmas das views síncronas do DRF.
+
+
+def nao_encontrada():
+    return JsonResponse({'erro': 'Imagem não encontrada'}, status=404)
+
+
+def nao_modificado(etag):
+    response = HttpResponse(status=304)
+    response['ETag'] = etag
+    return response
+
+
+async def upload_imagem_microscopica(request, analise_id):
+    """Mesma entrada e resposta de POST /api/analises/<id>/microscopica/"""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        analise = await AnaliseLevedura.objects.aget(id=analise_id)
+    except AnaliseLevedura.DoesNotExist:
+        return JsonResponse({'erro': 'Análise não encontrada'}, status=404)
+
+    # O corpo já foi recebido pelo servidor ASGI; o parsing do multipart lê o arquivo temporário.
+    # Trabalho de arquivo sem ORM roda no pool de threads (thread_sensitive=False), sem ocupar a
+    # thread única compartilhada pelas chamadas ao banco de todas as requisições
+    arquivos, dados = await sync_to_async(lambda: (request.FILES, request.POST), thread_sensitive=False)()
+    if 'imagem' not in arquivos:
+        return JsonResponse({'erro': 'Nenhuma imagem fornecida'}, status=400)
+
+    imagem = arquivos['imagem']
+    if not imagem.content_type.startswith('image/'):
+        return JsonResponse({'erro': 'Arquivo não é uma imagem válida'}, status=400)
+
+    modo = dados.get('modo_caracteristicas', getattr(settings, 'LEVEDURAS_MODO_CARACTERISTICAS', 'mascara'))
+    if modo not in MODOS_CARACTERISTICAS:
+        return JsonResponse(
+            {'erro': f'modo_caracteristicas deve ser um de: {", ".join(MODOS_CARACTERISTICAS)}'}, status=400
+        )
+
+    # Backpressure: recusa novos jobs enquanto a fila estiver cheia
+    if await sync_to_async(fila_cheia)():
+        response = JsonResponse(
+            {'erro': 'Fila de processamento cheia, tente novamente mais tarde',
+             'tamanho_fila': await sync_to_async(tamanho_fila)()},
+            status=429
+        )
+        response['Retry-After'] = str(configuracao_fila()['intervalo'] * 30)
+        return response
+
+    try:
+        nome = await sync_to_async(gravar_arquivo_microscopica, thread_sensitive=False)(imagem)
+        imagem_micro = await sync_to_async(criar_imagem_microscopica)(analise, imagem, modo, nome)
+        dados_resposta = await sync_to_async(dados_upload_microscopica)(imagem_micro)
+    except Exception as e:
+        return JsonResponse({'erro': f'Erro ao salvar imagem: {str(e)}'}, status=500)
+    return JsonResponse(dados_resposta, status=202)
+
+# Views de função assíncronas só aceitam o decorador csrf_exempt a partir do Django 5.0
+upload_imagem_microscopica.csrf_exempt = True
+
+
+async def status_processamento(request, imagem_id):
+    """Mesmos parâmetros, ETag e resposta de GET /api/analises/<id>/status/"""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        imagem_micro = await ImagemMicroscopica.objects.aget(id=imagem_id)
+    except ImagemMicroscopica.DoesNotExist:
+        return nao_encontrada()
+
+    posicao_fila = await sync_to_async(posicao_na_fila)(imagem_micro)
+    etag = etag_status(imagem_micro, request.META.get('QUERY_STRING', ''), posicao_fila)
+    if etag_confere(request, etag):
+        return nao_modificado(etag)
+
+    response_data = {
+        'id': str(imagem_micro.id),
+        'status': imagem_micro.status_processamento,
+        'progresso': imagem_micro.progresso,
+        'criado_em': imagem_micro.criado_em,
+        'iniciado_em': imagem_micro.iniciado_em,
+        'concluido_em': imagem_micro.concluido_em,
+        'url_preview': url_preview(imagem_micro),
+    }
+
+    if imagem_micro.status_processamento == 'pendente':
+        response_data['posicao_fila'] = posicao_fila
+
+    if imagem_micro.status_processamento == 'concluido':
+        try:
+            limite, cursor, campos = parametros_listagem(request.GET)
+        except ParametroInvalido as e:
+            return JsonResponse(e.args[0], status=400)
+
+        resumo = await sync_to_async(obter_resumo)(imagem_micro)
+        response_data['total_leveduras'] = resumo['total_leveduras']
+        if 'estatisticas_gerais' in resumo:
+            response_data['estatisticas_gerais'] = resumo['estatisticas_gerais']
+        response_data['url_mascara'] = url_mascara(imagem_micro)
+
+        if limite > 0:
+            pagina = [valores async for valores in pagina_leveduras(imagem_micro.id, limite, cursor, campos)]
+            tem_proxima = len(pagina) > limite
+            pagina = pagina[:limite]
+
+            response_data['leveduras_segmentadas'] = [serializar_levedura(valores, campos) for valores in pagina]
+            response_data['proximo_cursor'] = pagina[-1]['levedura_id'] if tem_proxima else None
+
+    elif imagem_micro.status_processamento == 'erro':
+        response_data['erro'] = imagem_micro.erro_processamento
+
+    response = JsonResponse(response_data)
+    response['ETag'] = etag
+    return response
+
+
+# Último estado lido de cada imagem: clientes esperando a mesma imagem no long-poll ou no
+# stream compartilham uma consulta por intervalo, em vez de uma consulta por cliente
+_estados_recentes = {}
+MAX_ESTADOS_RECENTES = 10000
+
+
+async def consultar_progresso(imagem_id, idade_maxima=0):
+    """Status e progresso da imagem; aceita um estado lido há menos de 'idade_maxima' segundos"""
+    recente = _estados_recentes.get(imagem_id)
+    if recente is not None and time.monotonic() - recente[0] < idade_maxima:
+        return recente[1]
+
+    estado = await (
+        ImagemMicroscopica.objects
+        .filter(id=imagem_id)
+        .values('status_processamento', 'progresso')
+        .afirst()
+    )
+    if len(_estados_recentes) >= MAX_ESTADOS_RECENTES:
+        _estados_recentes.clear()
+    _estados_recentes[imagem_id] = (time.monotonic(), estado)
+    return estado
+
+
+async def progresso_processamento(request, imagem_id):
+    """
+    Long-poll de GET /api/analises/<id>/progresso/: a espera de ?aguardar= é um
+    asyncio.sleep, sem thread presa por cliente. A primeira leitura é sempre do banco.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    estado = await consultar_progresso(imagem_id)
+    if estado is None:
+        return nao_encontrada()
+
+    try:
+        aguardar = min(float(request.GET.get('aguardar', 0)), ESPERA_MAXIMA_PROGRESSO)
+    except ValueError:
+        return JsonResponse({'erro': 'aguardar deve ser um número'}, status=400)
+
+    etag = etag_progresso(estado)
+    limite = time.monotonic() + aguardar
+    while etag_confere(request, etag) and time.monotonic() < limite:
+        await asyncio.sleep(INTERVALO_CONSULTA_PROGRESSO)
+        estado = await consultar_progresso(imagem_id, INTERVALO_CONSULTA_PROGRESSO)
+        if estado is None:
+            return nao_encontrada()
+        etag = etag_progresso(estado)
+
+    if etag_confere(request, etag):
+        return nao_modificado(etag)
+    response = JsonResponse(formatar_progresso(estado))
+    response['ETag'] = etag
+    return response
+
+
+async def eventos_progresso(imagem_id):
+    """Gerador assíncrono dos mesmos eventos SSE de views.eventos_progresso"""
+    ultimo_etag = None
+    ultimo_envio = time.monotonic()
+    limite = ultimo_envio + DURACAO_MAXIMA_STREAM
+    while time.monotonic() < limite:
+        estado = await consultar_progresso(imagem_id, INTERVALO_CONSULTA_PROGRESSO)
+        if estado is None:
+            yield "event: erro\ndata: {\"erro\": \"Imagem não encontrada\"}\n\n"
+            return
+
+        etag = etag_progresso(estado)
+        if etag != ultimo_etag:
+            ultimo_etag = etag
+            ultimo_envio = time.monotonic()
+            dados = json.dumps(formatar_progresso(estado))
+            yield f"id: {estado['status_processamento']}-{estado['progresso']}\ndata: {dados}\n\n"
+            if estado['status_processamento'] in ('concluido', 'erro'):
+                return
+        elif time.monotonic() - ultimo_envio > 15:
+            ultimo_envio = time.monotonic()
+            yield ": aguardando\n\n"
+        await asyncio.sleep(INTERVALO_CONSULTA_PROGRESSO)
+
+
+async def stream_progresso(request, imagem_id):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    if not await ImagemMicroscopica.objects.filter(id=imagem_id).aexists():
+        return nao_encontrada()
+
+    response = StreamingHttpResponse(eventos_progresso(imagem_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def estatisticas_caracteristicas(request, imagem_id):
+    """Mesma resposta de GET /api/analises/<id>/levedura_segmentada/"""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        agregados = await LeveduraSegmentada.objects.filter(imagem_original_id=imagem_id).aaggregate(
+            **agregados_caracteristicas()
+        )
+        return JsonResponse(formatar_estatisticas(agregados))
+    except Exception as e:
+        return JsonResponse({'erro': str(e)}, status=400)